@@ -1,11 +1,20 @@
-from . import optimize
-from . import postprocess
-from . import preprocess
 from os import path
-import numpy as np
-import webbrowser
+import importlib
 __version__ = 'v0.1.1'
 
+# Submodules (and NumPy/OR-Tools behind them) load on first attribute access,
+# so workers and CLI calls only pay for what they use.
+_SUBMODULES = ('dispatch', 'network', 'optimize', 'postprocess', 'preprocess',
+    'ranking', 'service', 'simulate', 'telemetry')
+
+def __getattr__(name:str):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES))
+
 
 class Main:
     '''
@@ -42,8 +51,50 @@ class Main:
         selective route based off of a set of user-profile paramaters. Calculate
         score.
     '''
-    def __init__(self):
-        pass
+    def __init__(self, hooks:list=None, network=None, rankings=None, route_cache=None):
+        '''
+        Args:
+            hooks: optional callables hook(operation, metrics) called after
+            each operation (e.g. telemetry.LogHook() to write app.log or
+            telemetry.PrometheusHook(path)). Per-stage timings and solver
+            telemetry accumulate in self.metrics either way.
+            network: optional network.RoadNetwork; when set, model distances
+            are road travel distances instead of straight-line haversine.
+            rankings: ranking.Rankings shared across riders (a new one by
+            default).
+            route_cache: optional optimize.RouteCache; near-identical models
+            are then answered from earlier solves. It follows the version
+            of the litter index passed to build_model/dispatch.
+        '''
+        from . import preprocess, ranking, telemetry
+        self.distance_cache = preprocess.DistanceCache()
+        self.network = network
+        self.rankings = rankings if rankings is not None else ranking.Rankings()
+        self.metrics = telemetry.Metrics()
+        self.hooks = list(hooks or [])
+        self.route_cache = route_cache
+
+    def _emit(self, operation:str):
+        for hook in self.hooks:
+            hook(operation, self.metrics)
+
+    def _route(self, data:dict, profile:str='default'):
+        from . import optimize
+        if self.route_cache is None:
+            return optimize.route(data, profile, metrics=self.metrics)
+        return self.route_cache.route(data, profile, metrics=self.metrics)
+
+    def _use_litter(self, litter_index):
+        if self.route_cache is not None and litter_index is not None:
+            self.route_cache.set_version(litter_index.version)
+
+    def _distance_matrix(self, locations):
+        from . import preprocess
+        with self.metrics.stage('distance_matrix'):
+            if self.network is not None:
+                return self.network.distance_matrix(locations, dtype='int32')
+            return preprocess.build_distance_matrix(
+                locations, dtype='int32', cache=self.distance_cache)
 
     def initialize_rider(self, name:str, pickup:list, destination:list):
         '''
@@ -62,6 +113,79 @@ class Main:
             'destination': destination
         }
 
+    def build_model(self, litter_index, detour_km:float=1.0, k:int=25):
+        '''
+        Purpose:
+            Build the rider's model data from only the litter worth a detour
+            on their pickup -> destination trip.
+
+        Args:
+            litter_index: preprocess.LitterIndex over the city's litter.
+            detour_km: extra kilometers the trip may grow by per item.
+            k: max number of litter locations in the model.
+
+        Returns:
+            model data dict (see initialize_routes) including 'locations'
+            and the 'litter' indexes into litter_index.
+        '''
+        from . import preprocess
+        import numpy as np
+        self._use_litter(litter_index)
+        with self.metrics.stage('corridor'):
+            litter, _ = litter_index.query_corridor(
+                self.rider['origin'], self.rider['destination'], detour_km, k)
+            locations = np.vstack([
+                np.asarray(self.rider['origin'], dtype=float),
+                litter_index.grid.points[litter],
+                np.asarray(self.rider['destination'], dtype=float)])
+            data = preprocess.build_model_data(
+                len(locations), np.rint(litter_index.scores[litter]))
+        data['distance_matrix'] = self._distance_matrix(locations)
+        data['locations'] = locations
+        data['litter'] = litter
+        self._emit('build_model')
+        return data
+
+    def dispatch(self, pool, litter_index=None, k:int=3, profile:str='default', **kwargs):
+        '''
+        Purpose:
+            Route the rider with the best of the k nearest available drivers
+            (TODO B/C) and return the chosen driver id.
+
+        Args:
+            pool: dispatch.DriverPool of live drivers.
+            litter_index: optional preprocess.LitterIndex of the city's litter.
+            k: drivers to choose among.
+            profile: optimize.SOLVER_PROFILES entry.
+            kwargs: passed on to dispatch.build_dispatch_model (which
+            uses Main.network unless given another network).
+        '''
+        from . import dispatch
+        self._use_litter(litter_index)
+        kwargs.setdefault('network', self.network)
+        with self.metrics.stage('dispatch_model'):
+            data = dispatch.build_dispatch_model(
+                [self.rider], pool, k=k, litter_index=litter_index, **kwargs)
+        self.model_data = data
+        self.output = self._route(data, profile)
+        self._emit('dispatch')
+        self.driver_id = dispatch.assign_riders(data, self.output)[0]
+        return self.driver_id
+
+    def _vehicle(self, driver_id=None):
+        '''
+        Purpose:
+            Vehicle of driver_id (by default the driver dispatch chose) in
+            a dispatch model; vehicle 0 for initialize_routes models.
+        '''
+        driver_ids = self.model_data.get('driver_ids')
+        if driver_ids is None:
+            return 0
+        driver_id = getattr(self, 'driver_id', None) if driver_id is None else driver_id
+        if driver_id not in driver_ids:
+            raise ValueError('driver {!r} is not in the model'.format(driver_id))
+        return driver_ids.index(driver_id)
+
     def initialize_routes(self, data:dict):
         '''
         Purpose:
@@ -85,9 +209,59 @@ class Main:
             social media profile data.
         '''
         self.model_data = data
-        self.output = optimize.route(data)
+        self.output = self._route(data)
+        self._emit('route')
+
+    def reroute(self, added_locations:list=(), added_demands:list=(),
+        removed:list=(), position:list=None):
+        '''
+        Purpose:
+            Re-optimize the current route after a mid-trip change (new
+            litter tag, a dropped node, the driver moving) starting from the
+            current solution instead of calling initialize_routes again.
+
+        Args:
+            added_locations: list of [lat, lon] to add (appended to the
+            model so existing node indexes don't change).
+            added_demands: points for each added location.
+            removed: node indexes that should no longer be visited.
+            position: optional [lat, lon] the vehicle has moved to (updates
+            its start node). In a dispatch model that is the chosen
+            driver's vehicle.
+
+        Notes:
+            Travel times of a timed model are rebuilt for the new locations
+            and added locations get an open time window.
+        '''
+        from . import optimize, preprocess
+        import numpy as np
+        data = dict(self.model_data)
+        locations = np.array(data['locations'], dtype=float)
+        if position is not None:
+            locations[data['starts'][self._vehicle()]] = position
+        if len(added_locations):
+            locations = np.append(locations, np.asarray(added_locations, dtype=float), axis=0)
+            data['demands'] = np.append(data['demands'], np.asarray(added_demands, dtype=int))
+        data['locations'] = locations
+        data['distance_matrix'] = self._distance_matrix(locations)
+        if 'travel_times' in data:
+            data['travel_times'] = preprocess.build_travel_time_tensor(
+                locations, data.get('speeds', preprocess.HOURLY_SPEEDS_KMH))
+            if data.get('time_windows') is not None:
+                data['time_windows'] = list(data['time_windows']) + [
+                    [0, preprocess.TIME_HORIZON]] * len(added_locations)
+        if 'free_end' in data: # see dispatch.build_dispatch_model
+            data['distance_matrix'][:, data['free_end']] = 0
+            if 'travel_times' in data:
+                data['travel_times'][:, :, data['free_end']] = 0
+
+        self.model_data = data
+        self.output = optimize.reroute(
+            self.output, data, removed=removed, metrics=self.metrics)
+        self._emit('reroute')
 
-    def display_route(self, locations:list):
+    def display_route(self, locations:list, targetpath:str=None,
+        open_browser:bool=True):
         '''
         Purpose:
             Get data about route for visualization and manage its display.
@@ -95,38 +269,79 @@ class Main:
         Args:
             locations: list of location indexes. The function looks
             at the model output and visualizes what is routed.
+            targetpath: html file to write (defaults to html/route_map.html).
+            open_browser: open the map in a web browser. For batches use
+            postprocess.render_routes, which never does.
 
         Credit:
             Adam Votava (https://blog.alookanalytics.com/2017/02/05/how-to-plot-
             your-own-bikejogging-route-using-python-and-google-maps-api/)
         '''
-        # init map
-        loc_map = postprocess.Map()
-
-        # add coordinates
-        coordinates = self.model_data['locations']
-        coordinates = list(map(list(coordinates).__getitem__, locations))
-        for cs in coordinates:
-            loc_map.add_point(cs) # [lat, lon]
+        from . import postprocess
+        import numpy as np
+        import webbrowser
+        # route coordinates [lat, lon]
+        coordinates = np.asarray(self.model_data['locations'], dtype=float)[list(locations)]
 
         # save as html
-        thisdir = path.dirname(path.abspath(__file__))
-        targetdir = path.join(path.dirname(thisdir), 'html')
-        targetpath = path.join(targetdir, 'route_map.html')
-        with open(targetpath, "w") as out:
-            print(loc_map, file=out)
+        if targetpath is None:
+            thisdir = path.dirname(path.abspath(__file__))
+            targetdir = path.join(path.dirname(thisdir), 'html')
+            targetpath = path.join(targetdir, 'route_map.html')
+        with self.metrics.stage('render'):
+            postprocess.render_routes([coordinates], targetpath)
+        self._emit('display')
 
         # open in a web browser
-        webbrowser.open_new_tab(targetpath)
+        if open_browser:
+            webbrowser.open_new_tab(targetpath)
 
-    def describe_route(self):
+    def describe_route(self, vehicle:int=None):
         '''
         Purpose:
             Analyze the data about the route to represent its potential with
             respect to the platform's rankings.
 
+        Args:
+            vehicle: route to describe; by default the chosen driver's
+            (see _vehicle).
+
+        Returns:
+            dict of the route's ranking.SCORE_FIELDS plus 'rank', the rider's
+            all-time rank if they complete this ride.
+
         Notes:
             The idea with this function is to allow for a soft-touch on
             route configuration (i.e. if its not hitting enough litter -- tweak)
         '''
-        pass
+        from . import ranking
+        vehicle = self._vehicle() if vehicle is None else vehicle
+        scores = ranking.score_routes(self.output.routes,
+            self.model_data['distance_matrix'], self.model_data['demands'])
+        description = {field: float(scores[field][vehicle])
+            for field in ranking.SCORE_FIELDS}
+        riders = self.rankings.riders
+        total = riders.totals.get(self.rider['name'], 0) + int(description['points'])
+        description['rank'] = riders.rank_of(total)
+        return description
+
+    def complete_ride(self, driver_id=None, vehicle:int=None, timestamp:float=None):
+        '''
+        Purpose:
+            Credit the route's litter points to the rider (and driver) in
+            the rankings once the ride is done.
+
+        Args:
+            driver_id: driver to credit; in a dispatch model also picks the
+            route (by default the driver dispatch chose).
+            vehicle: optional route override.
+        '''
+        driver_ids = self.model_data.get('driver_ids')
+        if vehicle is None:
+            vehicle = self._vehicle(driver_id)
+        if driver_id is None and driver_ids is not None:
+            driver_id = driver_ids[vehicle]
+        description = self.describe_route(vehicle)
+        self.rankings.record(description['points'], description['distance_km'],
+            driver=driver_id, rider=self.rider['name'], timestamp=timestamp)
+        return description
@@ -0,0 +1,244 @@
+'''
+Purpose:
+    Provide engines with dispatch module to pick drivers for ride requests
+    before a model is built (Main TODO B and C: initialize riders within a set
+    of potential drivers).
+
+Notes:
+    Driver positions live in a preprocess.GeoGrid that's rebuilt lazily after
+    updates. Candidate drivers for a whole batch of riders are chosen with one
+    vectorized distance computation, then every rider and candidate driver
+    goes into a single multi-vehicle model instead of one solve per rider.
+'''
+from . import preprocess
+import numpy as np
+import time
+
+class DriverPool(object):
+    '''
+    Purpose:
+        Live driver positions, capacities and availability.
+    '''
+    def __init__(self, cell_km:float=0.5):
+        self.cell_km = cell_km
+        self._rows = {} # driver id -> row
+        self._ids = []
+        self._positions = []
+        self._capacities = []
+        self._seats = []
+        self._available = []
+        self._grid = None
+        self._grid_rows = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def update(self, driver_id, position:list, capacity:int=5, seats:int=3,
+        available:bool=True):
+        '''
+        Purpose:
+            Add a driver or update their position/state.
+
+        Args:
+            driver_id: any hashable id.
+            position: [lat, lon].
+            capacity: max litter points the driver will collect.
+            seats: open rider seats.
+            available: whether the driver can take requests.
+        '''
+        row = self._rows.get(driver_id)
+        if row is None:
+            self._rows[driver_id] = len(self._ids)
+            self._ids.append(driver_id)
+            self._positions.append(list(position))
+            self._capacities.append(capacity)
+            self._seats.append(seats)
+            self._available.append(available)
+        else:
+            self._positions[row] = list(position)
+            self._capacities[row] = capacity
+            self._seats[row] = seats
+            self._available[row] = available
+        self._grid = None
+
+    def set_available(self, driver_id, available:bool):
+        self._available[self._rows[driver_id]] = available
+        self._grid = None
+
+    def is_available(self, driver_id):
+        return self._available[self._rows[driver_id]]
+
+    def _index(self):
+        if self._grid is None:
+            rows = np.flatnonzero(np.array(self._available, dtype=bool))
+            self._grid_rows = rows
+            self._grid = preprocess.GeoGrid(
+                np.array(self._positions, dtype=float).reshape(-1, 2)[rows],
+                cell_km=self.cell_km)
+        return self._grid, self._grid_rows
+
+    def nearest(self, origins:list, k:int=5, radius_km:float=2.0):
+        '''
+        Purpose:
+            The k nearest available drivers for each origin.
+
+        Args:
+            origins: [[lat, lon], ...] rider pickup locations.
+            k: drivers per origin.
+            radius_km: initial search radius around the origins; doubled
+            until every origin's k nearest drivers are known to be inside it
+            (or the pool is exhausted).
+
+        Returns:
+            (driver rows, km) arrays of shape (len(origins), k) sorted
+            nearest first. Rows index the pool (see driver_ids).
+        '''
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        grid, rows = self._index()
+        k = min(k, len(grid))
+        if k == 0:
+            empty = np.empty((len(origins), 0))
+            return empty.astype(np.int64), empty
+        while True:
+            grow_lat = radius_km / grid.KM_PER_DEG_LAT
+            grow_lon = grow_lat / np.cos(np.radians(origins[:, 0].mean()))
+            candidates = grid.query_box(
+                origins[:, 0].min() - grow_lat, origins[:, 1].min() - grow_lon,
+                origins[:, 0].max() + grow_lat, origins[:, 1].max() + grow_lon)
+            if len(candidates) < k:
+                radius_km *= 2
+                continue
+            # one origins x candidates distance computation for the whole batch
+            points = grid.points[candidates]
+            km = preprocess.haversine_vector(
+                origins[:, 1, None], origins[:, 0, None],
+                points[None, :, 1], points[None, :, 0])
+            best = np.argpartition(km, k - 1, axis=1)[:, :k]
+            best_km = np.take_along_axis(km, best, axis=1)
+            # drivers outside the box are at least radius_km away
+            if best_km.max() <= radius_km or len(candidates) == len(grid):
+                break
+            radius_km *= 2
+        order = np.argsort(best_km, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        return rows[candidates[best]], np.take_along_axis(best_km, order, axis=1)
+
+    def driver_ids(self, rows):
+        return [self._ids[row] for row in rows]
+
+def build_dispatch_model(riders:list, pool:DriverPool, k:int=3,
+    litter_index=None, detour_km:float=1.0, litter_per_rider:int=10,
+    departure:float=None, speeds:list=preprocess.HOURLY_SPEEDS_KMH, network=None):
+    '''
+    Purpose:
+        Build one multi-vehicle model for a batch of pending riders and the
+        drivers nearest to them.
+
+    Args:
+        riders: list of {'origin': [lat, lon], 'destination': [lat, lon]}
+        (e.g. Main.rider dicts), optionally with 'pickup_window' and
+        'dropoff_window' [earliest, latest] in seconds since midnight.
+        pool: DriverPool of live drivers.
+        k: nearest drivers considered per rider.
+        litter_index: optional preprocess.LitterIndex; litter along each
+        rider's corridor is added to the model.
+        detour_km, litter_per_rider: corridor query settings.
+        departure: seconds since midnight the drivers leave. With a
+        departure (the current time of day when any rider has a window) the
+        model gets travel times for that hour and the 'Time' dimension.
+        speeds: km/h per time bucket (see build_travel_time_tensor).
+        network: optional network.RoadNetwork for road distances instead
+        of straight-line ones.
+
+    Returns:
+        model data dict for optimize.route. Nodes are laid out as
+        [driver starts..., (pickup, destination) per rider..., litter...,
+        free end] where every vehicle ends at the free end node (zero cost to
+        reach) so drivers don't pay to return anywhere. Extra keys:
+        'driver_ids' per vehicle, 'rider_nodes' [[pickup, destination], ...],
+        'free_end' (its node, whose matrix column must stay 0 when the
+        matrix is rebuilt) and 'locations'. Timed models also keep the
+        'speeds' their travel times were built with.
+    '''
+    timed = departure is not None or any(
+        'pickup_window' in rider or 'dropoff_window' in rider for rider in riders)
+    origins = np.array([rider['origin'] for rider in riders], dtype=float)
+    destinations = np.array([rider['destination'] for rider in riders], dtype=float)
+    rows, _ = pool.nearest(origins, k=k)
+    rows = np.unique(rows)
+    num_vehicles = len(rows)
+    if num_vehicles == 0:
+        raise ValueError('no available drivers')
+
+    litter, litter_demands = np.empty(0, dtype=np.int64), []
+    if litter_index is not None:
+        found = [litter_index.query_corridor(o, d, detour_km, litter_per_rider)[0]
+            for o, d in zip(origins, destinations)]
+        litter = np.unique(np.concatenate(found)) if found else litter
+        litter_demands = np.rint(litter_index.scores[litter])
+
+    starts = np.array(pool._positions, dtype=float)[rows]
+    rider_locations = np.stack([origins, destinations], axis=1).reshape(-1, 2)
+    litter_locations = (litter_index.grid.points[litter] if litter_index is not None
+        else np.empty((0, 2)))
+    locations = np.vstack([starts, rider_locations, litter_locations, starts[:1]])
+    n = len(locations)
+    end = n - 1
+
+    distance_matrix = (preprocess.build_distance_matrix(locations, dtype='int32')
+        if network is None else network.distance_matrix(locations, dtype='int32'))
+    distance_matrix[:, end] = 0 # free end: nothing to drive back to
+    first_rider = num_vehicles
+    rider_nodes = [[first_rider + 2 * i, first_rider + 2 * i + 1]
+        for i in range(len(riders))]
+    demands = np.zeros(n, dtype=np.int64)
+    demands[first_rider + 2 * len(riders):end] = litter_demands
+
+    model = {
+        'demands': demands,
+        'vehicle_capacities': np.array(pool._capacities)[rows].tolist(),
+        'vehicle_seats': np.array(pool._seats)[rows].tolist(),
+        'distance_matrix': distance_matrix,
+        'num_vehicles': num_vehicles,
+        'starts': list(range(num_vehicles)),
+        'ends': [end] * num_vehicles,
+        'pickups_deliveries': rider_nodes,
+        'rider_nodes': rider_nodes,
+        'driver_ids': pool.driver_ids(rows),
+        'litter': litter,
+        'free_end': end,
+        'locations': locations
+    }
+    if timed:
+        if departure is None:
+            now = time.localtime()
+            departure = now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec
+        travel_times = preprocess.build_travel_time_tensor(locations, speeds)
+        travel_times[:, :, end] = 0
+        windows = np.tile([0, preprocess.TIME_HORIZON], (n, 1))
+        for rider, (pickup, destination) in zip(riders, rider_nodes):
+            for node, key in ((pickup, 'pickup_window'), (destination, 'dropoff_window')):
+                if key in rider:
+                    windows[node] = rider[key]
+        model.update({
+            'travel_times': travel_times,
+            'speeds': list(speeds),
+            'vehicle_departures': [int(departure)] * num_vehicles,
+            'time_windows': windows.tolist()
+        })
+    return model
+
+def assign_riders(data:dict, result):
+    '''
+    Purpose:
+        Read which driver serves each rider from the optimize.RouteResult of a
+        dispatch model.
+
+    Returns:
+        list of driver ids (None if the rider wasn't served) per rider.
+    '''
+    served = {}
+    for vehicle, nodes in enumerate(result.routes):
+        for node in nodes.tolist():
+            served[node] = data['driver_ids'][vehicle]
+    return [served.get(pickup) for pickup, _ in data['rider_nodes']]
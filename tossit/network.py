@@ -0,0 +1,303 @@
+'''
+Purpose:
+    Road network travel distances. Straight-line haversine underestimates
+    driving distance across one-way grids and rivers, so this engine loads a
+    local street graph and builds the solver's matrices from shortest paths
+    on it.
+
+Notes:
+    The graph is a compact CSR adjacency (indptr, indices, weights in km)
+    built from a segment CSV keyed by seg_id (like the litter index) or an
+    OSM XML extract. Many-to-many matrices run a batched multi-source search:
+    every source's distance row is relaxed at once with NumPy, one frontier
+    of improved (source, node) pairs per round, until no distance improves.
+    Full rows are cached per (graph version, source) so later matrices only
+    search from new sources, and the cache is bounded by the total number
+    of cached row entries rather than by rows. A changed or grown graph has
+    a new version and never reads stale entries.
+'''
+from collections import OrderedDict
+from . import preprocess
+import csv
+import hashlib
+import numpy as np
+import xml.etree.ElementTree as ET
+
+# OSM highway values a car can drive on
+DRIVABLE = {
+    'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified',
+    'residential', 'living_street', 'service', 'motorway_link', 'trunk_link',
+    'primary_link', 'secondary_link', 'tertiary_link'}
+
+# (graph version, source node) -> float64 km row to every graph node
+_SEARCH_CACHE = OrderedDict()
+SEARCH_CACHE_NODES = 1 << 23 # cached row entries across all rows (64MB)
+SEARCH_BATCH_NODES = 1 << 22 # source rows x graph nodes searched at once
+_search_cache_nodes = 0
+
+def clear_search_cache():
+    global _search_cache_nodes
+    _SEARCH_CACHE.clear()
+    _search_cache_nodes = 0
+
+def _cache_row(key, row):
+    global _search_cache_nodes
+    if row.size > SEARCH_CACHE_NODES:
+        return
+    _SEARCH_CACHE[key] = row
+    _search_cache_nodes += row.size
+    while _search_cache_nodes > SEARCH_CACHE_NODES:
+        _search_cache_nodes -= _SEARCH_CACHE.popitem(last=False)[1].size
+
+class RoadNetwork(object):
+    '''
+    Purpose:
+        Directed street graph in CSR form.
+
+    Attributes:
+        points: float64 [[lat, lon], ...] per graph node.
+        indptr, indices, weights: CSR adjacency; the edges leaving node u
+        are indices[indptr[u]:indptr[u + 1]] with lengths (km) in weights.
+        seg_ids: int64 source segment id per edge (-1 when unknown).
+        version: digest of the graph arrays, the key of cached searches.
+    '''
+    def __init__(self, points, indptr, indices, weights, seg_ids=None):
+        self.points = preprocess._as_geo_array(points)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.seg_ids = (np.full(len(self.indices), -1, dtype=np.int64)
+            if seg_ids is None else np.asarray(seg_ids, dtype=np.int64))
+        digest = hashlib.sha1()
+        for array in (self.points, self.indptr, self.indices, self.weights):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        self.version = digest.hexdigest()[:16]
+        self._grid = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def __repr__(self):
+        return 'RoadNetwork(nodes={}, edges={}, version={})'.format(
+            len(self), len(self.indices), self.version)
+
+    @classmethod
+    def from_edges(cls, points, sources, targets, lengths=None, seg_ids=None,
+        oneway=None):
+        '''
+        Purpose:
+            Build the CSR graph from an edge list.
+
+        Args:
+            points: [[lat, lon], ...] per node.
+            sources, targets: node indexes per segment.
+            lengths: km per segment (defaults to the haversine length).
+            seg_ids: optional segment id per segment.
+            oneway: optional bool per segment; two-way segments (the
+            default) get an edge in both directions.
+        '''
+        points = preprocess._as_geo_array(points)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        if lengths is None:
+            lengths = preprocess.haversine_vector(
+                points[sources, 1], points[sources, 0],
+                points[targets, 1], points[targets, 0])
+        lengths = np.asarray(lengths, dtype=np.float64)
+        seg_ids = (np.full(len(sources), -1, dtype=np.int64) if seg_ids is None
+            else np.asarray(seg_ids, dtype=np.int64))
+        twoway = (np.ones(len(sources), dtype=bool) if oneway is None
+            else ~np.asarray(oneway, dtype=bool))
+        sources, targets = (np.concatenate([sources, targets[twoway]]),
+            np.concatenate([targets, sources[twoway]]))
+        lengths = np.concatenate([lengths, lengths[twoway]])
+        seg_ids = np.concatenate([seg_ids, seg_ids[twoway]])
+
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(points)), out=indptr[1:])
+        return cls(points, indptr, targets[order], lengths[order], seg_ids[order])
+
+    @classmethod
+    def from_segments_csv(cls, csv_path:str, precision:int=6):
+        '''
+        Purpose:
+            Load a segment file with columns seg_id, from_lat, from_lon,
+            to_lat, to_lon and optionally length_km and oneway (1 when only
+            the from -> to direction is open). Segments sharing an endpoint
+            (equal after rounding to precision decimals) are connected.
+        '''
+        rows = {name: [] for name in (
+            'seg_id', 'from_lat', 'from_lon', 'to_lat', 'to_lon', 'length_km', 'oneway')}
+        with open(csv_path, newline='') as f:
+            reader = csv.DictReader(f)
+            has_length = 'length_km' in reader.fieldnames
+            has_oneway = 'oneway' in reader.fieldnames
+            for row in reader:
+                for name in ('seg_id', 'from_lat', 'from_lon', 'to_lat', 'to_lon'):
+                    rows[name].append(row[name])
+                rows['length_km'].append(row['length_km'] if has_length else 'nan')
+                rows['oneway'].append(row['oneway'] if has_oneway else '0')
+        ends = np.column_stack([
+            np.array(rows[name], dtype=np.float64)
+            for name in ('from_lat', 'from_lon', 'to_lat', 'to_lon')]).reshape(-1, 2)
+        points, nodes = np.unique(np.round(ends, precision), axis=0, return_inverse=True)
+        nodes = nodes.reshape(-1, 2)
+        lengths = np.array(rows['length_km'], dtype=np.float64)
+        measured = preprocess.haversine_vector(
+            points[nodes[:, 0], 1], points[nodes[:, 0], 0],
+            points[nodes[:, 1], 1], points[nodes[:, 1], 0])
+        lengths = np.where(np.isnan(lengths), measured, lengths)
+        oneway = np.array([value.strip().lower() in ('1', 'yes', 'true')
+            for value in rows['oneway']], dtype=bool)
+        return cls.from_edges(points, nodes[:, 0], nodes[:, 1], lengths,
+            np.array(rows['seg_id'], dtype=np.int64), oneway)
+
+    @classmethod
+    def from_osm(cls, osm_path:str, highways:set=DRIVABLE):
+        '''
+        Purpose:
+            Load the drivable ways of an OSM XML extract (streamed with
+            iterparse). oneway=yes/1/true and oneway=-1 are honored and each
+            way's id is kept as the seg_id of its edges.
+        '''
+        coordinates = {}
+        ways = []
+        for _, element in ET.iterparse(osm_path, events=('end',)):
+            if element.tag == 'node':
+                coordinates[element.get('id')] = (
+                    float(element.get('lat')), float(element.get('lon')))
+                element.clear()
+            elif element.tag == 'way':
+                tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                if tags.get('highway') in highways:
+                    refs = [nd.get('ref') for nd in element.iter('nd')]
+                    oneway = tags.get('oneway', 'no')
+                    if oneway == '-1':
+                        refs.reverse()
+                    ways.append((int(element.get('id')), refs,
+                        oneway in ('yes', '1', 'true', '-1')))
+                element.clear()
+        used = {}
+        sources, targets, seg_ids, oneways = [], [], [], []
+        for way_id, refs, oneway in ways:
+            refs = [ref for ref in refs if ref in coordinates]
+            for ref in refs:
+                used.setdefault(ref, len(used))
+            for a, b in zip(refs[:-1], refs[1:]):
+                sources.append(used[a])
+                targets.append(used[b])
+                seg_ids.append(way_id)
+                oneways.append(oneway)
+        points = np.array([coordinates[ref] for ref in used], dtype=np.float64)
+        return cls.from_edges(points, sources, targets, seg_ids=seg_ids, oneway=oneways)
+
+    def save(self, path:str):
+        np.savez(path, points=self.points, indptr=self.indptr, indices=self.indices,
+            weights=self.weights, seg_ids=self.seg_ids)
+
+    @classmethod
+    def load(cls, path:str):
+        with np.load(path) as arrays:
+            return cls(arrays['points'], arrays['indptr'], arrays['indices'],
+                arrays['weights'], arrays['seg_ids'])
+
+    def snap(self, geo_array):
+        '''
+        Purpose:
+            Nearest graph node for each [lat, lon] and the km to it.
+        '''
+        if self._grid is None:
+            self._grid = preprocess.GeoGrid(self.points)
+        geo_array = preprocess._as_geo_array(geo_array)
+        nodes = np.array([self._grid.query_knn(lat, lon, 1)[0]
+            for lat, lon in geo_array], dtype=np.int64)
+        points = self.points[nodes]
+        offsets = preprocess.haversine_vector(
+            geo_array[:, 1], geo_array[:, 0], points[:, 1], points[:, 0])
+        return nodes, offsets
+
+    def _search(self, sources):
+        '''
+        Purpose:
+            Shortest path km from each source node to every graph node (inf
+            where unreachable) as a float64 [len(sources), len(self)] array.
+
+        Notes:
+            Label-correcting search batched over sources: each round expands
+            the edges of every (source, node) pair whose distance improved in
+            the previous round and keeps the smallest candidate per pair.
+            Rounds end when nothing improves, so every row holds shortest
+            path distances; edge sums can accumulate in a different order
+            than Dijkstra's, so the values match it to floating point
+            tolerance rather than exactly.
+        '''
+        n = len(self)
+        sources = np.asarray(sources, dtype=np.int64)
+        degree = np.diff(self.indptr)
+        indices = self.indices.astype(np.int64)
+        km = np.full(len(sources) * n, np.inf)
+        frontier = np.arange(len(sources), dtype=np.int64) * n + sources
+        km[frontier] = 0.0
+        while len(frontier):
+            rows, nodes = np.divmod(frontier, n)
+            counts = degree[nodes]
+            firsts = np.cumsum(counts) - counts
+            edges = (np.repeat(self.indptr[nodes] - firsts, counts)
+                + np.arange(counts.sum()))
+            keys = np.repeat(rows * n, counts) + indices[edges]
+            candidates = np.repeat(km[frontier], counts) + self.weights[edges]
+            better = candidates < km[keys]
+            keys = keys[better]
+            np.minimum.at(km, keys, candidates[better])
+            frontier = np.unique(keys)
+        return km.reshape(len(sources), n)
+
+    def shortest_paths(self, sources, targets):
+        '''
+        Purpose:
+            Many-to-many shortest path km between graph nodes (inf when a
+            target can't be reached). Sources without a cached row are
+            searched in batches of SEARCH_BATCH_NODES row entries.
+        '''
+        sources = np.asarray(sources, dtype=np.int64).tolist()
+        targets = np.asarray(targets, dtype=np.int64)
+        rows = {}
+        for source in sources:
+            key = (self.version, source)
+            if key in _SEARCH_CACHE:
+                _SEARCH_CACHE.move_to_end(key)
+                rows[source] = _SEARCH_CACHE[key]
+        missing = [source for source in dict.fromkeys(sources) if source not in rows]
+        batch = max(1, SEARCH_BATCH_NODES // max(len(self), 1))
+        for i in range(0, len(missing), batch):
+            for source, row in zip(missing[i:i + batch], self._search(missing[i:i + batch])):
+                rows[source] = row = row.copy() # don't pin the whole batch
+                _cache_row((self.version, source), row)
+        km = np.empty((len(sources), len(targets)))
+        for i, source in enumerate(sources):
+            km[i] = rows[source][targets]
+        return km
+
+    def distance_matrix(self, geo_array, dtype='float64'):
+        '''
+        Purpose:
+            Road network counterpart of preprocess.build_distance_matrix:
+            scaled travel distances (km * 100) between locations, each
+            snapped to its nearest graph node (the snap distance is added on
+            both ends). The matrix is asymmetric where one-way streets are.
+
+        Notes:
+            Unreachable pairs are priced like apply_candidate_arcs prices
+            forbidden arcs: ten times the longest reachable distance.
+        '''
+        geo_array = preprocess._as_geo_array(geo_array)
+        nodes, offsets = self.snap(geo_array)
+        unique, inverse = np.unique(nodes, return_inverse=True)
+        km = self.shortest_paths(unique, unique)[inverse][:, inverse]
+        km += offsets[:, None] + offsets[None, :]
+        np.fill_diagonal(km, 0)
+        unreachable = ~np.isfinite(km)
+        if unreachable.any():
+            km[unreachable] = 10 * km[~unreachable].max() + 1
+        return preprocess._scale_distances(km, dtype)
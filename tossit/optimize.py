@@ -5,28 +5,362 @@ Purpose:
 Notes:
     Starting simple, then integrating and adjusting.
 '''
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, as_completed
+from . import preprocess
+from . import telemetry
+import hashlib
+import json
+import numpy as np
+import os
+import time
+try:
+    from ortools.constraint_solver import routing_enums_pb2
+    from ortools.constraint_solver import pywrapcp
+except ImportError: # route falls back to route_from_scratch
+    routing_enums_pb2 = pywrapcp = None
 
-def route(data:dict):
+# routing.status() values reported by route_from_scratch
+HEURISTIC_SUCCESS = 1 # ROUTING_SUCCESS
+HEURISTIC_TIMEOUT = 2 # ROUTING_PARTIAL_SUCCESS_LOCAL_OPTIMUM_NOT_REACHED
+
+# Seconds a route_many request may take beyond its search time limit (model
+# build, pickling, worker start-up) before the batch gives up on it.
+RESULT_GRACE = 10
+
+# Most seconds a vehicle waits at a node for its time window to open unless
+# the model sets 'max_wait'.
+MAX_WAIT = 3600
+
+# Named search configurations. Time limits scale with problem size:
+# min(max_time, base_time + time_per_node * nodes) seconds. stall_rate turns
+# on OR-Tools' improvement limit, which ends the search once the objective
+# improves by less than that rate over the last stall_solutions solutions.
+SOLVER_PROFILES = {
+    'default': { # original codefest settings
+        'first_solution_strategy': 'PATH_CHEAPEST_ARC',
+        'local_search_metaheuristic': 'AUTOMATIC',
+        'base_time': 20,
+        'time_per_node': 0,
+        'max_time': 20,
+        'solution_limit': 100,
+        'stall_rate': None,
+        'stall_solutions': None,
+        'penalty': 1000
+    },
+    'interactive': { # sub-second rider quotes
+        'first_solution_strategy': 'PATH_CHEAPEST_ARC',
+        'local_search_metaheuristic': 'GREEDY_DESCENT',
+        'base_time': 0.1,
+        'time_per_node': 0.002,
+        'max_time': 1,
+        'solution_limit': None,
+        'stall_rate': 0.05,
+        'stall_solutions': 20,
+        'penalty': 1000
+    },
+    'reroute': { # live trip changes, warm started from the previous routes
+        'first_solution_strategy': 'PATH_CHEAPEST_ARC',
+        'local_search_metaheuristic': 'GREEDY_DESCENT',
+        'base_time': 0.02,
+        'time_per_node': 0.0002,
+        'max_time': 0.1,
+        'solution_limit': None,
+        'stall_rate': 0.05,
+        'stall_solutions': 10,
+        'penalty': 1000
+    },
+    'batch': { # overnight litter sweeps
+        'first_solution_strategy': 'PARALLEL_CHEAPEST_INSERTION',
+        'local_search_metaheuristic': 'GUIDED_LOCAL_SEARCH',
+        'base_time': 10,
+        'time_per_node': 0.1,
+        'max_time': 1800,
+        'solution_limit': None,
+        'stall_rate': 0.01,
+        'stall_solutions': 100,
+        'penalty': 1000
+    }
+}
+
+def get_time_limit(profile:dict, nodes:int):
     '''
     Purpose:
-        Generate route using model data.
+        Seconds of search a profile allows for a problem with this many nodes.
+    '''
+    return min(profile['max_time'],
+        profile['base_time'] + profile['time_per_node'] * nodes)
+
+def get_search_parameters(profile:dict, nodes:int, time_limit:float=None):
+    '''
+    Purpose:
+        Build OR-Tools search parameters from a solver profile (see
+        SOLVER_PROFILES).
 
     Args:
-        data: preprocessed data representing subject model to optimize.
-        Example: {
-        'distance_matrix': [[int], ...], all to all with index-based location
-        identification
-        'pickups_deliveries': [[int], ...], route segment pool to optimize within
-        'num_vehicles': int, must be generated in preprocessing module
-        functionality (proximity/availablilty derrived number to provide
-        potential routes)
-        'depot': 0 for initial development all drivers will return home.
+        profile: profile dict.
+        nodes: number of locations in the model (scales the time limit).
+        time_limit: optional override of the profile's adaptive time limit.
+    '''
+    if time_limit is None:
+        time_limit = get_time_limit(profile, nodes)
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+    if profile['solution_limit']:
+        search_parameters.solution_limit = profile['solution_limit']
+    search_parameters.first_solution_strategy = getattr(
+        routing_enums_pb2.FirstSolutionStrategy,
+        profile['first_solution_strategy'])
+    search_parameters.local_search_metaheuristic = getattr(
+        routing_enums_pb2.LocalSearchMetaheuristic,
+        profile['local_search_metaheuristic'])
+    if profile['stall_rate']:
+        limit = search_parameters.improvement_limit_parameters
+        limit.improvement_rate_coefficient = profile['stall_rate']
+        limit.improvement_rate_solutions_distance = profile['stall_solutions']
+    return search_parameters
+
+class RouteResult(object):
+    '''
+    Purpose:
+        Lightweight solve result extracted once, right after the search, so
+        the manager/routing/assignment SWIG objects (and the solver's memory)
+        can be freed immediately. Plain NumPy arrays and ints only, so it
+        pickles cheaply across processes and serializes to JSON.
+
+    Attributes:
+        routes: list of int32 node sequences per vehicle (start to end).
+        distances: list of int64 cumulative arc costs along each route (same
+        length as the route, starting at 0).
+        loads: list of int64 cumulative demand along each route.
+        times: list of int64 arrival times (seconds) along each route when
+        the model has travel times, otherwise empty.
+        dropped: int32 array of nodes left out of every route.
+        objective: solver objective (None when no solution was found).
+        status: routing.status() after the search.
+        profile: solver profile used.
+        solve_time: observed search time in seconds.
+        warm_start: whether the search started from previous routes.
+        error: error message when the request failed (see route_many).
+    '''
+    __slots__ = ('routes', 'distances', 'loads', 'dropped', 'objective', 'status',
+        'profile', 'solve_time', 'warm_start', 'error', 'times')
+
+    def __init__(self, routes=(), distances=(), loads=(), dropped=(), objective=None,
+        status=None, profile=None, solve_time=None, warm_start=False, error=None,
+        times=()):
+        self.routes = [np.asarray(r, dtype=np.int32) for r in routes]
+        self.distances = [np.asarray(d, dtype=np.int64) for d in distances]
+        self.loads = [np.asarray(l, dtype=np.int64) for l in loads]
+        self.times = [np.asarray(t, dtype=np.int64) for t in times]
+        self.dropped = np.asarray(dropped, dtype=np.int32)
+        self.objective = objective
+        self.status = status
+        self.profile = profile
+        self.solve_time = solve_time
+        self.warm_start = warm_start
+        self.error = error
+
+    def __bool__(self):
+        return self.error is None and self.objective is not None
+
+    def __repr__(self):
+        return 'RouteResult(vehicles={}, dropped={}, objective={}, status={})'.format(
+            len(self.routes), len(self.dropped), self.objective, self.status)
+
+    @property
+    def total_distance(self):
+        return int(sum(d[-1] for d in self.distances if len(d)))
+
+    @property
+    def total_load(self):
+        return int(sum(l[-1] for l in self.loads if len(l)))
+
+    @classmethod
+    def from_assignment(cls, data:dict, manager, routing, assignment, **kwargs):
+        '''
+        Purpose:
+            Walk each vehicle's route once. Costs and loads come from the
+            model arrays (the arc cost evaluator is the distance matrix), and
+            dropped nodes are the complement of the visited ones, so there's
+            no second pass over routing.Size(). Arrival times are the
+            earliest feasible 'Time' cumul values.
+        '''
+        if not assignment:
+            return cls(status=routing.status(), **kwargs)
+        time_dimension = (routing.GetDimensionOrDie('Time')
+            if 'Time' in routing.GetAllDimensionNames() else None)
+        routes, times = [], []
+        for vehicle_id in range(data['num_vehicles']):
+            index = routing.Start(vehicle_id)
+            nodes = [manager.IndexToNode(index)]
+            arrivals = [index]
+            while not routing.IsEnd(index):
+                index = assignment.Value(routing.NextVar(index))
+                nodes.append(manager.IndexToNode(index))
+                arrivals.append(index)
+            routes.append(nodes)
+            if time_dimension is not None:
+                times.append([assignment.Min(time_dimension.CumulVar(index))
+                    for index in arrivals])
+        distances = [np.cumsum([0] + _arc_costs(data['distance_matrix'], nodes))
+            for nodes in routes]
+        demands = np.asarray(data['demands'], dtype=np.int64)
+        loads = [np.cumsum(demands[nodes]) for nodes in routes]
+        dropped = np.ones(len(demands), dtype=bool)
+        dropped[[node for nodes in routes for node in nodes]] = False
+        return cls(routes, distances, loads, np.flatnonzero(dropped),
+            objective=assignment.ObjectiveValue(), status=routing.status(),
+            times=times, **kwargs)
+
+    def to_dict(self):
+        return {
+            'routes': [r.tolist() for r in self.routes],
+            'distances': [d.tolist() for d in self.distances],
+            'loads': [l.tolist() for l in self.loads],
+            'times': [t.tolist() for t in self.times],
+            'dropped': self.dropped.tolist(),
+            'objective': self.objective,
+            'status': self.status,
+            'profile': self.profile,
+            'solve_time': self.solve_time,
+            'warm_start': self.warm_start,
+            'error': self.error
         }
 
+    @classmethod
+    def from_dict(cls, values:dict):
+        return cls(**values)
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text:str):
+        return cls.from_dict(json.loads(text))
+
+def _arc_costs(distance_matrix, nodes:list):
+    if isinstance(distance_matrix, np.ndarray):
+        return distance_matrix[nodes[:-1], nodes[1:]].astype(np.int64).tolist()
+    return [int(distance_matrix[a][b]) for a, b in zip(nodes[:-1], nodes[1:])]
+
+def _register_transits(data:dict, manager, routing):
+    '''
+    Purpose:
+        Register the distance (arc) and demand (node) transits with the
+        routing model and return their indexes.
+
     Notes:
-        Starting with Google OR tools template code.
+        By default the matrix and demands are handed to OR-Tools as plain
+        int arrays (RegisterTransitMatrix/RegisterUnaryTransitVector), so
+        arc evaluations during search stay in C++ and never call back into
+        Python. Python callbacks are only used when data['transit_callbacks']
+        is set or the matrix is a numpy.memmap (a city-scale matrix from
+        preprocess.build_distance_matrix_tiled that shouldn't be copied
+        into memory as a whole).
+    '''
+    distance_matrix = data['distance_matrix']
+    if data.get('transit_callbacks') or isinstance(distance_matrix, np.memmap):
+        def distance_callback(from_index, to_index):
+            """Returns the distance between the two nodes."""
+            # Convert from routing variable Index to distance matrix NodeIndex.
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            # int() keeps numpy/memmap scalars from leaking into the solver.
+            return int(distance_matrix[from_node][to_node])
+
+        def demand_callback(from_index):
+            """Returns the demand of the node."""
+            # Convert from routing variable Index to demands NodeIndex.
+            from_node = manager.IndexToNode(from_index)
+            return int(data['demands'][from_node])
+
+        return (routing.RegisterTransitCallback(distance_callback),
+            routing.RegisterUnaryTransitCallback(demand_callback))
+
+    # node-indexed int arrays; OR-Tools maps routing indexes to nodes itself.
+    matrix = np.rint(np.asarray(distance_matrix, dtype=np.float64))
+    return (routing.RegisterTransitMatrix(matrix.astype(np.int64).tolist()),
+        routing.RegisterUnaryTransitVector(
+            np.asarray(data['demands']).astype(np.int64).tolist()))
+
+def _vehicle_travel_times(data:dict):
+    '''
+    Purpose:
+        Departure time and travel-time bucket per vehicle, and the tensor.
+        data['travel_times'] may be the path of a .npy tensor, which is
+        memory-mapped. Raises ValueError when the tensor doesn't cover the
+        model's nodes (OR-Tools would read past its matrices).
+    '''
+    tensor = data['travel_times']
+    if isinstance(tensor, str):
+        tensor = preprocess.load_distance_matrix(tensor)
+    n = len(data['distance_matrix'])
+    if np.ndim(tensor) != 3 or tuple(np.shape(tensor)[1:]) != (n, n):
+        raise ValueError('travel_times has shape {} for a model of {} nodes'.format(
+            np.shape(tensor), n))
+    departures = data.get('vehicle_departures')
+    departures = ([0] * data['num_vehicles'] if departures is None
+        else [int(d) for d in departures])
+    return departures, [preprocess.time_bucket(d, len(tensor)) for d in departures], tensor
+
+def _add_time_dimension(data:dict, manager, routing):
+    '''
+    Purpose:
+        'Time' dimension from the travel-time tensor with the node time
+        windows. Each vehicle's transits are the matrix of its departure
+        bucket (one registered matrix per bucket in use), so lookups stay in
+        C++ like the distance transits.
+
+    Notes:
+        OR-Tools transits can't depend on the arrival time, so a vehicle uses
+        its departure bucket for the whole route. Quotes and rides fit in
+        one or two buckets; long sweeps should set departures per shift.
+    '''
+    departures, buckets, tensor = _vehicle_travel_times(data)
+    evaluators = {}
+    for bucket in set(buckets):
+        matrix = tensor[bucket]
+        if data.get('transit_callbacks'):
+            def time_callback(from_index, to_index, matrix=matrix):
+                return int(matrix[manager.IndexToNode(from_index)][
+                    manager.IndexToNode(to_index)])
+            evaluators[bucket] = routing.RegisterTransitCallback(time_callback)
+        else:
+            evaluators[bucket] = routing.RegisterTransitMatrix(
+                np.asarray(matrix, dtype=np.int64).tolist())
+    routing.AddDimensionWithVehicleTransits(
+        [evaluators[bucket] for bucket in buckets],
+        int(data.get('max_wait', MAX_WAIT)),  # waiting allowed per node
+        preprocess.TIME_HORIZON,
+        False,  # vehicles start at their departure time
+        'Time')
+    time_dimension = routing.GetDimensionOrDie('Time')
+    for vehicle_id, departure in enumerate(departures):
+        time_dimension.CumulVar(routing.Start(vehicle_id)).SetValue(departure)
+
+    windows = data.get('time_windows')
+    if windows is None:
+        return
+    starts = set(data['starts'])
+    ends = {}
+    for vehicle_id, end in enumerate(data['ends']):
+        ends.setdefault(end, []).append(vehicle_id)
+    for node, (earliest, latest) in enumerate(windows):
+        if node in ends:
+            indexes = [routing.End(vehicle_id) for vehicle_id in ends[node]]
+        elif node in starts:
+            continue # the departure time
+        else:
+            indexes = [manager.NodeToIndex(node)]
+        for index in indexes:
+            time_dimension.CumulVar(index).SetRange(int(earliest), int(latest))
+
+def _build_model(data:dict, settings:dict, removed:list=()):
+    '''
+    Purpose:
+        Create the index manager and routing model (transits, capacity and
+        disjunctions) shared by route and reroute.
     '''
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(
@@ -38,83 +372,1329 @@ def route(data:dict):
     # Create Routing Model.
     routing = pywrapcp.RoutingModel(manager)
 
-    # Create and register a transit callback.
-    def distance_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['distance_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-
-    # Define cost of each arc.
+    # Register distance and demand transits, then define cost of each arc.
+    transit_callback_index, demand_callback_index = _register_transits(
+        data, manager, routing)
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
-
     # Add Capacity constraint.
-    def demand_callback(from_index):
-        """Returns the demand of the node."""
-        # Convert from routing variable Index to demands NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        return data['demands'][from_node]
-
-    demand_callback_index = routing.RegisterUnaryTransitCallback(
-        demand_callback)
     routing.AddDimensionWithVehicleCapacity(
         demand_callback_index,
         0,  # null capacity slack
-        data['vehicle_capacities'],  # vehicle maximum capacities
+        [int(c) for c in data['vehicle_capacities']],  # vehicle maximum capacities
         True,  # start cumul to zero
         'Capacity')
 
-    # Allow to drop nodes.
-    penalty = 1000
-    for node in range(1, len(data['distance_matrix'])-1):
-        routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
+    # Travel time with the pickup/drop-off time windows.
+    if 'travel_times' in data:
+        _add_time_dimension(data, manager, routing)
 
-    # Setting first solution heuristic.
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.time_limit.seconds = 20
-    search_parameters.solution_limit = 100
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    # Riders are picked up and dropped off by the same vehicle, in order.
+    pickups_deliveries = data.get('pickups_deliveries') or []
+    if pickups_deliveries:
+        matrix = np.asarray(data['distance_matrix'])
+        horizon = int(matrix.max()) * len(matrix)
+        routing.AddDimension(transit_callback_index, 0, horizon, True, 'Distance')
+        distance_dimension = routing.GetDimensionOrDie('Distance')
+        solver = routing.solver()
+        for pickup, delivery in pickups_deliveries:
+            pickup_index = manager.NodeToIndex(pickup)
+            delivery_index = manager.NodeToIndex(delivery)
+            routing.AddPickupAndDelivery(pickup_index, delivery_index)
+            solver.Add(
+                routing.VehicleVar(pickup_index) == routing.VehicleVar(delivery_index))
+            solver.Add(
+                distance_dimension.CumulVar(pickup_index) <=
+                distance_dimension.CumulVar(delivery_index))
 
-    # Solve the problem.
-    assignment = routing.SolveWithParameters(search_parameters)
+    # Riders take a seat from pickup to drop-off.
+    if 'vehicle_seats' in data:
+        seats = np.zeros(len(data['distance_matrix']), dtype=np.int64)
+        for pickup, delivery in pickups_deliveries:
+            seats[pickup] += 1
+            seats[delivery] -= 1
+        routing.AddDimensionWithVehicleCapacity(
+            routing.RegisterUnaryTransitVector(seats.tolist()),
+            0,
+            [int(c) for c in data['vehicle_seats']],
+            True,
+            'Seats')
 
-    return {
-        'data': data,
-        'manager': manager,
-        'routing': routing,
-        'assignment': assignment
-    }
+    # Allow to drop nodes (every node that isn't a vehicle start or end, or a
+    # rider's pickup or drop-off).
+    penalty = settings['penalty']
+    fixed = set(data['starts']) | set(data['ends'])
+    fixed.update(node for pair in pickups_deliveries for node in pair)
+    for node in range(len(data['distance_matrix'])):
+        if node not in fixed:
+            routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
+
+    # Nodes removed from the problem (e.g. by a reroute) can't be visited.
+    for node in removed:
+        routing.ActiveVar(manager.NodeToIndex(node)).SetValue(0)
+
+    return manager, routing
+
+def _remaining(settings:dict, nodes:int, time_limit:float, began:float):
+    '''
+    Purpose:
+        Seconds left of a solve's time limit (time_limit or the profile's
+        adaptive limit) since began, a time.perf_counter() value.
+    '''
+    if time_limit is None:
+        time_limit = get_time_limit(settings, nodes)
+    return max(0.0, time_limit - (time.perf_counter() - began))
 
+def _fallback(data:dict, profile:str, time_limit:float, removed:list, metrics):
+    '''
+    Purpose:
+        route_from_scratch in place of an OR-Tools solve, recorded in metrics
+        as the last solve (see telemetry.Metrics.record_fallback).
+    '''
+    with telemetry.stage(metrics, 'search'):
+        result = route_from_scratch(data, profile, time_limit, removed)
+    if metrics is not None:
+        metrics.record_fallback(result, len(data['distance_matrix']), data['num_vehicles'])
+    return result
 
-def route_from_scratch(data:dict):
+def route(data:dict, profile:str='default', time_limit:float=None, metrics=None,
+    fallback:bool=True):
     '''
     Purpose:
-        Codefest's WiFi is slow, so it's taking a while to download
-        dependancies. In case I can't utilize Google OR Tools in time, I'll
-        use this function as a sandbox for pure MIP code (python/numpy-based
-        VRP optimization from scratch).
+        Generate route using model data.
 
     Args:
         data: preprocessed data representing subject model to optimize.
         Example: {
         'distance_matrix': [[int], ...], all to all with index-based location
-        identification
-        'pickups_deliveries': [[int], ...], route segment pool to optimize within
+        identification (may be a read-only memmap from
+        preprocess.build_distance_matrix_tiled, see _register_transits)
+        'demands': [int, ...], points collected per node
+        'vehicle_capacities': [int, ...], max points per vehicle
+        'transit_callbacks': optional bool, evaluate arcs with Python
+        callbacks instead of registered matrices (see _register_transits)
+        'pickups_deliveries': optional [[pickup, delivery], ...], rider nodes
+        that must be served by the same vehicle in that order (never dropped)
+        'vehicle_seats': optional [int, ...], rider seats per vehicle
+        'travel_times': optional (buckets, n, n) seconds from
+        preprocess.build_travel_time_tensor (or its .npy path), adds the
+        'Time' dimension (see _add_time_dimension)
+        'vehicle_departures': optional [int, ...], seconds since midnight
+        each vehicle leaves (0 by default)
+        'time_windows': optional [[earliest, latest], ...] arrival seconds
+        per node on the same clock
+        'max_wait': optional seconds a vehicle may wait at a node
+        'matrix_store', 'nodes': optional preprocess.MatrixStore (or its
+        path) and the store rows of the model's nodes, in place of the
+        matrix, demands and locations (see MatrixStore.model)
         'num_vehicles': int, must be generated in preprocessing module
         functionality (proximity/availablilty derrived number to provide
         potential routes)
         'depot': 0 for initial development all drivers will return home.
         }
+        profile: name of a SOLVER_PROFILES entry ('default', 'interactive'
+        or 'batch').
+        time_limit: optional override (seconds) of the profile's adaptive
+        time limit.
+        metrics: optional telemetry.Metrics; records the 'build_model',
+        'search' and 'extract' stages and the solver telemetry (status,
+        solutions found, objective trajectory, node/vehicle counts).
+        fallback: answer with route_from_scratch when OR-Tools isn't
+        installed or finds no solution within the time limit (the heuristic
+        then gets whatever is left of that limit). Without it a missing
+        OR-Tools raises ImportError.
+
+    Returns:
+        RouteResult (routes, cumulative distances/loads, dropped nodes,
+        objective, the profile name and the observed solve_time). Fallback
+        results have the 'heuristic' profile.
 
-    Note:
-        Because of scope issues the optimization focuses on providing drivers
-        with an optimized route. Riders choose from rider-friendly routes.
-        Ideally optimization is more mutual, but I don't believe I'll be able to
-        develop this before the conclusion of the hackathon.
+    Notes:
+        Starting with Google OR tools template code.
+    '''
+    began = time.perf_counter()
+    data = preprocess.resolve_model(data)
+    settings = SOLVER_PROFILES[profile]
+    nodes = len(data['distance_matrix'])
+    if pywrapcp is None:
+        if not fallback:
+            raise ImportError('OR-Tools is not installed; pass fallback=True')
+        return _fallback(data, profile, time_limit, (), metrics)
+
+    with telemetry.stage(metrics, 'build_model'):
+        manager, routing = _build_model(data, settings)
+
+        # Setting first solution heuristic, metaheuristic and limits.
+        search_parameters = get_search_parameters(settings, nodes, time_limit)
+    if metrics is not None:
+        metrics.watch_search(routing)
+
+    # Solve the problem.
+    with telemetry.stage(metrics, 'search'):
+        start = time.perf_counter()
+        assignment = routing.SolveWithParameters(search_parameters)
+        solve_time = time.perf_counter() - start
+    if metrics is not None:
+        metrics.record_solve(routing, assignment, nodes, data['num_vehicles'])
+    if not assignment and fallback:
+        return _fallback(data, profile,
+            _remaining(settings, nodes, time_limit, began), (), metrics)
+
+    # Extract once; the solver objects are released when this returns.
+    with telemetry.stage(metrics, 'extract'):
+        return RouteResult.from_assignment(
+            data, manager, routing, assignment, profile=profile, solve_time=solve_time)
+
+def reroute(previous:dict, data:dict, removed:list=(), profile:str='reroute',
+    time_limit:float=None, metrics=None, fallback:bool=True):
+    '''
+    Purpose:
+        Incremental re-optimization for a live trip. The model is rebuilt for
+        the changed data but the search starts from the previous routes
+        (ReadAssignmentFromRoutes + SolveFromAssignmentWithParameters) with a
+        short budget instead of solving from scratch.
+
+    Args:
+        previous: RouteResult (from route, reroute or route_many) for the
+        trip before the change.
+        data: updated model data. Node indexes must be stable: keep existing
+        nodes where they are and append added nodes (the vehicle 'ends' can
+        point anywhere, so nodes may be appended after the destination).
+        Moving the rider/driver is an update of the start node's row.
+        removed: nodes that must no longer be visited (picked up already or
+        withdrawn). They stay in the matrix but are forced inactive.
+        profile: solver profile, 'reroute' by default.
+        time_limit: optional override of the profile's time limit.
+        metrics: optional telemetry.Metrics (see route).
+        fallback: answer with route_from_scratch (a cold heuristic solve,
+        see route) when OR-Tools isn't installed or finds nothing in time.
+
+    Returns:
+        RouteResult like route; warm_start is False when the previous routes
+        aren't feasible for the new data and a cold solve was run instead.
+    '''
+    began = time.perf_counter()
+    data = preprocess.resolve_model(data)
+    settings = SOLVER_PROFILES[profile]
+    size = len(data['distance_matrix'])
+    if pywrapcp is None:
+        if not fallback:
+            raise ImportError('OR-Tools is not installed; pass fallback=True')
+        return _fallback(data, profile, time_limit, removed, metrics)
+    with telemetry.stage(metrics, 'build_model'):
+        manager, routing = _build_model(data, settings, removed)
+        search_parameters = get_search_parameters(settings, size, time_limit)
+
+        # previous routes without their start/end and the removed nodes
+        removed = set(removed)
+        routes = []
+        for nodes in previous.routes:
+            routes.append([
+                manager.NodeToIndex(node) for node in nodes[1:-1].tolist()
+                if node < size and node not in removed])
+    if metrics is not None:
+        metrics.watch_search(routing)
+
+    with telemetry.stage(metrics, 'search'):
+        start = time.perf_counter()
+        routing.CloseModelWithParameters(search_parameters)
+        initial = routing.ReadAssignmentFromRoutes(routes, True)
+        if initial:
+            assignment = routing.SolveFromAssignmentWithParameters(
+                initial, search_parameters)
+        else:
+            assignment = routing.SolveWithParameters(search_parameters)
+        solve_time = time.perf_counter() - start
+    if metrics is not None:
+        metrics.record_solve(routing, assignment, size, data['num_vehicles'])
+    if not assignment and fallback:
+        return _fallback(data, profile,
+            _remaining(settings, size, time_limit, began), removed, metrics)
+
+    with telemetry.stage(metrics, 'extract'):
+        return RouteResult.from_assignment(
+            data, manager, routing, assignment, profile=profile,
+            solve_time=solve_time, warm_start=bool(initial))
+
+def _route_worker(data:dict, profile:str, time_limit:float):
+    '''
+    Purpose:
+        Process pool entry point for route_many. Errors are returned rather
+        than raised so one bad model can't take down the batch.
     '''
-    return None
+    try:
+        return route(data, profile=profile, time_limit=time_limit)
+    except Exception as e:
+        return RouteResult(
+            profile=profile, error='{}: {}'.format(type(e).__name__, e))
+
+def route_many(models:list, workers:int=None, profile:str='default',
+    time_limit:float=None, timeout:float=None):
+    '''
+    Purpose:
+        Solve many independent models (e.g. a minute of rider requests) in
+        parallel across a process pool and stream results back as they
+        finish.
+
+    Args:
+        models: list of model data dicts (see route). Each model is
+        pickled to its worker; index subsets of a preprocess.MatrixStore
+        send just their node rows and the workers share the store's matrix.
+        workers: number of processes. Defaults to the cpu count.
+        profile: solver profile for every request (see SOLVER_PROFILES).
+        time_limit: optional per request search time limit in seconds
+        (otherwise the profile's adaptive limit).
+        timeout: optional wall-clock seconds for the whole batch. Defaults
+        to the worst case schedule of the requests' time limits plus
+        RESULT_GRACE each: sum / workers + the longest one.
+
+    Returns:
+        generator of (position in models, solution) in completion order.
+        Solutions are RouteResults. A request that failed (bad model, crashed
+        worker) yields a RouteResult with only its error message set; one
+        still unfinished at the timeout yields None, and the workers still
+        searching are terminated so they don't keep using the cores.
+    '''
+    workers = workers or os.cpu_count() or 1
+    if timeout is None:
+        budgets = [_request_budget(data, profile, time_limit) for data in models]
+        timeout = sum(budgets) / workers + max(budgets, default=0)
+    pool = ProcessPoolExecutor(max_workers=workers)
+    futures = {
+        pool.submit(_route_worker, data, profile, time_limit): i
+        for i, data in enumerate(models)}
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            pending.discard(future)
+            yield futures[future], _future_result(future, profile)
+    except TimeoutError:
+        for future in list(pending):
+            pending.discard(future)
+            yield futures[future], (_future_result(future, profile)
+                if future.done() else None)
+    finally:
+        if not all(future.done() for future in futures):
+            _terminate_workers(pool) # free the cores of searches past the timeout
+        pool.shutdown(cancel_futures=True)
+
+def _terminate_workers(pool):
+    '''
+    Purpose:
+        Stop a ProcessPoolExecutor's worker processes mid task (the pool is
+        broken afterwards; shut it down).
+    '''
+    terminate = getattr(pool, 'terminate_workers', None) # Python 3.14+
+    if terminate is not None:
+        return terminate()
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    for process in list((pool._processes or {}).values()):
+        process.join()
+
+def _request_budget(data:dict, profile:str, time_limit:float):
+    if time_limit is not None:
+        return time_limit + RESULT_GRACE
+    settings = SOLVER_PROFILES[profile]
+    try:
+        nodes = len(data['nodes'] if 'nodes' in data else data['distance_matrix'])
+    except (KeyError, TypeError):
+        return settings['max_time'] + RESULT_GRACE
+    return get_time_limit(settings, nodes) + RESULT_GRACE
+
+def _future_result(future, profile:str):
+    try:
+        return future.result()
+    except Exception as e: # e.g. BrokenProcessPool
+        return RouteResult(
+            profile=profile, error='{}: {}'.format(type(e).__name__, e))
+
+def fingerprint(data:dict, profile:str='default', time_limit:float=None,
+    precision:int=5, version:str=None):
+    '''
+    Purpose:
+        Stable hash of a model and its solver settings: equal for requests
+        that would be solved the same way.
+
+    Args:
+        data: model data dict (see route).
+        profile, time_limit: solver settings (see route).
+        precision: decimals coordinates are rounded to (5 is ~1m).
+        version: optional data version (e.g. LitterIndex.version).
+
+    Returns:
+        32 character hex digest.
+
+    Notes:
+        Nodes are hashed by their rounded 'locations' when the model has
+        them (the matrix follows from them), otherwise by the matrix itself.
+        Demands, capacities, seats, starts/ends and rider pairs are hashed
+        as int64 arrays, so list and array models hash alike. Travel times
+        enter as each vehicle's departure bucket and the time windows
+        rounded down to the minute.
+    '''
+    if 'matrix_store' in data:
+        version = [version, preprocess.open_matrix_store(data['matrix_store']).version]
+        data = preprocess.resolve_model(data, matrix=False)
+    digest = hashlib.blake2b(digest_size=16)
+    def update(name, values):
+        values = np.ascontiguousarray(values, dtype=np.int64)
+        digest.update('{}{}'.format(name, values.shape).encode())
+        digest.update(values.tobytes())
+    if 'locations' in data:
+        update('locations', np.rint(preprocess._as_geo_array(data['locations'])
+            * 10**precision))
+    else:
+        update('distance_matrix', np.rint(np.asarray(data['distance_matrix'], dtype=np.float64)))
+    for key in ('demands', 'vehicle_capacities', 'vehicle_seats', 'starts', 'ends'):
+        if data.get(key) is not None:
+            update(key, data[key])
+    update('pickups_deliveries', np.reshape(data.get('pickups_deliveries') or [], (-1, 2)))
+    if 'travel_times' in data:
+        departures, buckets, _ = _vehicle_travel_times(data)
+        update('buckets', buckets)
+        if data.get('time_windows') is not None:
+            update('time_windows', np.asarray(data['time_windows'], dtype=np.int64) // 60)
+        update('max_wait', [data.get('max_wait', MAX_WAIT)])
+    digest.update(json.dumps([profile, SOLVER_PROFILES[profile], time_limit, version],
+        sort_keys=True).encode())
+    return digest.hexdigest()
+
+class RouteCache(object):
+    '''
+    Purpose:
+        Memoized route solves. Near-identical requests (the same pickups and
+        destinations around Center City with the same litter hotspots) are
+        answered from a previous solve instead of running OR-Tools again.
+
+    Notes:
+        Entries are keyed by fingerprint and expire after ttl seconds; when
+        there are more than max_entries the least recently used go first.
+        With a path, every entry is also written as JSON (RouteResult.to_dict)
+        to a 'routes-<version>' subdirectory per data version (e.g.
+        LitterIndex.version) so the cache survives restarts; the most recent
+        entries of the version are loaded back when the cache is created.
+        set_version drops every entry of other versions, in memory and on
+        disk (only the cache's own routes-* folders and entry files are
+        touched, so path may be shared). On a miss, the cached solution
+        sharing the most node locations with the model (at least
+        seed_overlap of them) warm starts the solve through reroute.
+        Cached results are shared, so don't modify them.
+    '''
+    def __init__(self, max_entries:int=1024, ttl:float=600, path:str=None,
+        precision:int=5, version:str=None, seed_overlap:float=0.5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.precision = precision
+        self.version = version
+        self.seed_overlap = seed_overlap
+        self._entries = OrderedDict() # key -> (expires, result, locations), LRU order
+        self._postings = {} # rounded (lat, lon) -> keys of entries visiting it
+        self.hits = 0
+        self.misses = 0
+        self.seeded = 0
+        self.evictions = 0
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'seeded': self.seeded,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def key(self, data:dict, profile:str='default', time_limit:float=None):
+        return fingerprint(data, profile, time_limit, self.precision, self.version)
+
+    def _locations(self, data:dict):
+        if 'locations' not in data:
+            return None
+        return np.rint(preprocess._as_geo_array(data['locations'])
+            * 10**self.precision).astype(np.int64)
+
+    FOLDER_PREFIX = 'routes-' # marks the version folders this cache owns
+
+    def _folder(self):
+        return os.path.join(self.path, self.FOLDER_PREFIX + (self.version or 'unversioned'))
+
+    def _file(self, key:str):
+        return os.path.join(self._folder(), key + '.json')
+
+    def get(self, key:str):
+        '''
+        Purpose:
+            The cached RouteResult for a fingerprint, or None.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            self._discard(key)
+            entry = None
+        if entry is None and self.path is not None:
+            entry = self._read(key)
+            if entry is not None:
+                self._store(key, *entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key:str, result, data:dict):
+        '''
+        Purpose:
+            Cache a solve (failed solves aren't cached).
+        '''
+        if not result:
+            return
+        expires = time.time() + self.ttl
+        locations = self._locations(data)
+        self._store(key, expires, result, locations)
+        if self.path is not None:
+            temp = self._file(key) + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump({'expires': expires,
+                    'locations': None if locations is None else locations.tolist(),
+                    'result': result.to_dict()}, f, separators=(',', ':'))
+            os.replace(temp, self._file(key))
+
+    def _store(self, key:str, expires:float, result, locations):
+        if key in self._entries:
+            self._discard(key, remove_file=False)
+        self._entries[key] = (expires, result, locations)
+        if locations is not None:
+            for point in map(tuple, locations.tolist()):
+                self._postings.setdefault(point, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key:str, remove_file:bool=True):
+        _, _, locations = self._entries.pop(key)
+        if locations is not None:
+            for point in map(tuple, locations.tolist()):
+                keys = self._postings.get(point)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._postings[point]
+        if remove_file and self.path is not None and os.path.exists(self._file(key)):
+            os.remove(self._file(key))
+
+    def _read(self, key:str):
+        target = self._file(key)
+        if not os.path.exists(target):
+            return None
+        with open(target) as f:
+            stored = json.load(f)
+        if stored['expires'] < time.time():
+            os.remove(target)
+            return None
+        locations = stored['locations']
+        return (stored['expires'], RouteResult.from_dict(stored['result']),
+            None if locations is None else np.array(locations, dtype=np.int64).reshape(-1, 2))
+
+    def load(self):
+        '''
+        Purpose:
+            Load the most recently written entries of the disk tier.
+        '''
+        folder = self._folder()
+        os.makedirs(folder, exist_ok=True)
+        names = [name for name in os.listdir(folder) if name.endswith('.json')]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(folder, name)))
+        for name in names[-self.max_entries:]:
+            key = name[:-len('.json')]
+            entry = self._read(key)
+            if entry is not None:
+                self._store(key, *entry)
+
+    def set_version(self, version:str):
+        '''
+        Purpose:
+            Switch to another data version (e.g. after the litter data was
+            refreshed), dropping every entry of the old one from memory and
+            disk.
+        '''
+        if version == self.version:
+            return
+        self.version = version
+        self._entries.clear()
+        self._postings.clear()
+        if self.path is not None:
+            current = os.path.basename(self._folder())
+            for name in os.listdir(self.path):
+                folder = os.path.join(self.path, name)
+                if (name == current or not name.startswith(self.FOLDER_PREFIX)
+                    or not os.path.isdir(folder)):
+                    continue
+                # only the cache's own files, then the folder if that emptied it
+                for entry in os.listdir(folder):
+                    if entry.endswith(('.json', '.json.tmp')):
+                        os.remove(os.path.join(folder, entry))
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    pass
+            self.load()
+
+    def nearest(self, data:dict):
+        '''
+        Purpose:
+            The cached solution sharing the most node locations with the
+            model, its routes mapped onto the model's nodes (shared
+            locations only), or None when no entry shares seed_overlap of
+            them.
+        '''
+        locations = self._locations(data)
+        if locations is None:
+            return None
+        fixed = set(data['starts']) | set(data['ends'])
+        nodes = {}
+        for node, point in enumerate(map(tuple, locations.tolist())):
+            if node not in fixed:
+                nodes.setdefault(point, node)
+        counts = {}
+        for point in nodes:
+            for key in self._postings.get(point, ()):
+                counts[key] = counts.get(key, 0) + 1
+        now = time.time()
+        best, best_share = None, self.seed_overlap
+        for key, count in counts.items():
+            expires, result, cached = self._entries[key]
+            share = count / max(len(cached), len(locations))
+            if (share >= best_share and expires >= now
+                and len(result.routes) == data['num_vehicles']):
+                best, best_share = key, share
+        if best is None:
+            return None
+        _, result, cached = self._entries[best]
+        # shared locations map onto their node; the other visited nodes (a
+        # rider a few meters away) onto the nearest node still unmatched
+        visited = np.concatenate([route[1:-1] for route in result.routes]).astype(np.int64)
+        mapping = {}
+        for node, point in zip(visited.tolist(), map(tuple, cached[visited].tolist())):
+            if point in nodes:
+                mapping[node] = nodes.pop(point)
+        if nodes:
+            free = np.array(list(nodes.values()), dtype=np.int64)
+            for node in [node for node in visited.tolist() if node not in mapping]:
+                if not len(free):
+                    break
+                k = int(np.argmin(((locations[free] - cached[node]) ** 2).sum(axis=1)))
+                mapping[node] = int(free[k])
+                free = np.delete(free, k)
+        routes = [[data['starts'][v]] + [mapping[node] for node in route[1:-1].tolist()
+            if node in mapping] + [data['ends'][v]] for v, route in enumerate(result.routes)]
+        return RouteResult(routes, profile=result.profile)
+
+    def route(self, data:dict, profile:str='default', time_limit:float=None, metrics=None):
+        '''
+        Purpose:
+            route through the cache: a cached result when the model was
+            solved before, otherwise a solve (warm started from the nearest
+            cached solution when there is one) that is then cached.
+        '''
+        data = preprocess.resolve_model(data, matrix=False) # locations for nearest
+        key = self.key(data, profile, time_limit)
+        result = self.get(key)
+        if result is not None:
+            return result
+        previous = self.nearest(data) if pywrapcp is not None else None
+        result = None
+        if previous is not None:
+            self.seeded += 1
+            result = reroute(previous, data, profile=profile, time_limit=time_limit,
+                metrics=metrics)
+        if not result:
+            result = route(data, profile, time_limit, metrics=metrics)
+        self.put(key, result, data)
+        return result
+
+def _smallest(values, k:int):
+    '''
+    Purpose:
+        Flat indexes of the k smallest values, smallest first.
+    '''
+    values = values.ravel()
+    if len(values) > k:
+        part = np.argpartition(values, k)[:k]
+        return part[np.argsort(values[part])]
+    return np.argsort(values)
+
+class _LocalSearch(object):
+    '''
+    Purpose:
+        Routes and move evaluation for route_from_scratch. Routes are lists
+        of nodes (start to end); every move is scored for all candidates at
+        once with NumPy and only the best improving move is applied.
+    '''
+    def __init__(self, data:dict, penalty:int, removed:list=()):
+        self.matrix = np.asarray(data['distance_matrix'], dtype=np.float64)
+        size = len(self.matrix)
+        self.demands = np.asarray(data['demands'], dtype=np.int64)
+        self.capacities = np.asarray(data['vehicle_capacities'], dtype=np.int64)
+        self.penalty = penalty
+        self.pairs = [tuple(pair) for pair in data.get('pickups_deliveries') or []]
+        self.partner = {}
+        for pickup, delivery in self.pairs:
+            self.partner[pickup] = (delivery, 1)
+            self.partner[delivery] = (pickup, -1)
+        self.seats = np.asarray(data.get('vehicle_seats',
+            [size] * data['num_vehicles']), dtype=np.int64)
+        fixed = set(data['starts']) | set(data['ends']) | set(self.partner)
+        excluded = fixed | set(removed)
+        self.optional = np.array([node for node in range(size)
+            if node not in excluded], dtype=np.int64)
+        self.num_optional = size - len(fixed)
+        self.routes = [[start, end] for start, end in zip(data['starts'], data['ends'])]
+        self.loads = np.zeros(len(self.routes), dtype=np.int64)
+        self._neighbors = None
+        self.timed = 'travel_times' in data
+        if self.timed:
+            self.departures, buckets, tensor = _vehicle_travel_times(data)
+            matrices = {bucket: np.asarray(tensor[bucket], dtype=np.int64)
+                for bucket in set(buckets)}
+            self.travel = [matrices[bucket] for bucket in buckets]
+            windows = data.get('time_windows')
+            windows = np.asarray([[0, preprocess.TIME_HORIZON]] * size if windows is None
+                else windows, dtype=np.int64)
+            self.earliest, self.latest = windows[:, 0], windows[:, 1]
+            self.max_wait = int(data.get('max_wait', MAX_WAIT))
+
+    def seed(self, routes:list):
+        '''
+        Purpose:
+            Start from existing routes (start to end node sequences).
+        '''
+        self.routes = [[int(node) for node in route] for route in routes]
+        self.loads = np.array([self.demands[route].sum() for route in self.routes],
+            dtype=np.int64)
+
+    def improve(self, deadline:float=np.inf):
+        '''
+        Purpose:
+            Repeat every move until none improves the routes or the deadline
+            (a time.perf_counter() value) passes. True when it converged.
+        '''
+        while time.perf_counter() < deadline:
+            improved = self.two_opt()
+            improved = self.or_opt() or improved
+            improved = self.drop_optional() or improved
+            improved = self.insert_optional() or improved
+            improved = self.swap_dropped() or improved
+            if not improved:
+                return True
+        return False
+
+    def neighbors(self, k:int=16):
+        '''
+        Purpose:
+            The k nearest nodes to each node (by outgoing arc cost).
+        '''
+        if self._neighbors is None:
+            k = min(k, len(self.matrix) - 1)
+            costs = self.matrix + np.diag(np.full(len(self.matrix), np.inf))
+            self._neighbors = np.argpartition(costs, k - 1, axis=1)[:, :k] if k > 0 else (
+                np.zeros((len(self.matrix), 0), dtype=np.int64))
+        return self._neighbors
+
+    def cost(self, route:list):
+        return self.matrix[route[:-1], route[1:]].sum()
+
+    def objective(self):
+        routed = sum(len(route) - 2 for route in self.routes)
+        routed -= sum(1 for route in self.routes for node in route if node in self.partner)
+        return int(round(sum(self.cost(route) for route in self.routes)
+            + self.penalty * (self.num_optional - routed)))
+
+    def arrivals(self, route:list, vehicle:int):
+        '''
+        Purpose:
+            Arrival seconds along a route (waiting up to max_wait for a
+            window to open), or None when a window is missed.
+        '''
+        travel = self.travel[vehicle]
+        nodes = np.asarray(route)
+        legs = travel[nodes[:-1], nodes[1:]].tolist()
+        earliest, latest = self.earliest[nodes].tolist(), self.latest[nodes].tolist()
+        now = self.departures[vehicle]
+        times = [now]
+        for k, leg in enumerate(legs, 1):
+            now += leg
+            if now < earliest[k]:
+                if earliest[k] - now > self.max_wait:
+                    return None
+                now = earliest[k]
+            if now > latest[k]:
+                return None
+            times.append(now)
+        return times
+
+    def valid(self, route:list, vehicle:int):
+        '''
+        Purpose:
+            Riders are picked up before they're dropped off, by the same
+            vehicle, within its seats, and every time window is met.
+        '''
+        if self.timed and self.arrivals(route, vehicle) is None:
+            return False
+        if not self.partner:
+            return True
+        position = {node: i for i, node in enumerate(route)}
+        riding = 0
+        for i, node in enumerate(route):
+            if node in self.partner:
+                other, change = self.partner[node]
+                if other not in position or (position[other] - i) * change < 0:
+                    return False
+                riding += change
+                if riding > self.seats[vehicle]:
+                    return False
+        return True
+
+    def _edges(self):
+        '''
+        Purpose:
+            Every arc of every route as flat (vehicle, position, from, to)
+            arrays.
+        '''
+        vehicles = np.concatenate([np.full(len(route) - 1, v)
+            for v, route in enumerate(self.routes)])
+        positions = np.concatenate([np.arange(len(route) - 1) for route in self.routes])
+        nodes = [np.asarray(route) for route in self.routes]
+        sources = np.concatenate([route[:-1] for route in nodes])
+        targets = np.concatenate([route[1:] for route in nodes])
+        return vehicles, positions, sources, targets
+
+    def insert_pairs(self):
+        '''
+        Purpose:
+            Cheapest insertion of each rider's pickup and drop-off.
+        '''
+        for pickup, delivery in self.pairs:
+            best = (np.inf, None)
+            demand = self.demands[pickup] + self.demands[delivery]
+            for v, route in enumerate(self.routes):
+                if self.loads[v] + demand > self.capacities[v]:
+                    continue
+                nodes = np.asarray(route)
+                before, after = nodes[:-1], nodes[1:]
+                base = self.matrix[before, after]
+                add_pickup = self.matrix[before, pickup] + self.matrix[pickup, after] - base
+                add_delivery = self.matrix[before, delivery] + self.matrix[delivery, after] - base
+                together = (self.matrix[before, pickup] + self.matrix[pickup, delivery]
+                    + self.matrix[delivery, after] - base)
+                # pickup on arc i, drop-off on arc j >= i
+                costs = add_pickup[:, None] + add_delivery[None, :]
+                np.fill_diagonal(costs, together)
+                costs[np.tril_indices(len(base), -1)] = np.inf
+                for i, j in zip(*np.unravel_index(np.argsort(costs, axis=None), costs.shape)):
+                    if costs[i, j] >= best[0]:
+                        break
+                    candidate = route[:i + 1] + [pickup] + route[i + 1:j + 1] + [delivery] + route[j + 1:]
+                    if self.valid(candidate, v):
+                        best = (costs[i, j], (v, candidate))
+                        break
+            if best[1] is not None:
+                v, self.routes[v] = best[1]
+                self.loads[v] += demand
+
+    def insert_optional(self):
+        '''
+        Purpose:
+            Greedy cheapest insertion of optional nodes while an insertion
+            costs less than the drop penalty and fits the vehicle.
+
+        Notes:
+            Insertion costs are kept per route arc (candidates x arcs). An
+            insertion splits one arc into two, so only those two columns are
+            priced again instead of the whole route.
+        '''
+        routed = {node for route in self.routes for node in route}
+        candidates = np.array([node for node in self.optional.tolist()
+            if node not in routed], dtype=np.int64)
+        if not len(candidates):
+            return False
+        active = np.ones(len(candidates), dtype=bool)
+        demands = self.demands[candidates]
+        costs = np.full((len(self.routes), len(candidates)), np.inf)
+        slots = np.zeros((len(self.routes), len(candidates)), dtype=np.int64)
+        arcs = [] # per route: [arc sources, arc targets, candidates x arcs costs, count]
+        def price(v, arc):
+            sources, targets, added, _ = arcs[v]
+            a, b = sources[arc], targets[arc]
+            added[:, arc] = (self.matrix[a, candidates] + self.matrix[candidates, b]
+                - self.matrix[a, b])
+        def best(v):
+            added, count = arcs[v][2], arcs[v][3]
+            slots[v] = np.argmin(added[:, :count], axis=1)
+            costs[v] = added[np.arange(len(candidates)), slots[v]]
+        for v, route in enumerate(self.routes):
+            count = len(route) - 1
+            size = count + 16
+            sources = np.zeros(size, dtype=np.int64)
+            targets = np.zeros(size, dtype=np.int64)
+            sources[:count], targets[:count] = route[:-1], route[1:]
+            added = np.empty((len(candidates), size))
+            added[:, :count] = (self.matrix[sources[None, :count], candidates[:, None]]
+                + self.matrix[candidates[:, None], targets[None, :count]]
+                - self.matrix[sources[:count], targets[:count]][None, :])
+            arcs.append([sources, targets, added, count])
+            best(v)
+        inserted = False
+        while True:
+            fits = self.loads[:, None] + demands[None, :] <= self.capacities[:, None]
+            feasible = np.where(fits & active[None, :] & (costs < self.penalty), costs, np.inf)
+            if not np.isfinite(feasible).any():
+                return inserted
+            # every node is worth the same penalty, so when capacity can't
+            # take them all, a node using more than the smallest demand
+            # costs the nodes it crowds out
+            if demands[active].sum() > (self.capacities - self.loads).sum():
+                feasible = feasible + self.penalty * (demands - demands[active].min())[None, :]
+            v, c = np.unravel_index(np.argmin(feasible), feasible.shape)
+            node, arc = int(candidates[c]), slots[v, c]
+            sources, targets, added, count = arcs[v]
+            route = self.routes[v]
+            position = route.index(int(sources[arc]))
+            candidate = route[:position + 1] + [node] + route[position + 1:]
+            active[c] = False
+            if not self.valid(candidate, v):
+                continue
+            self.routes[v] = candidate
+            self.loads[v] += demands[c]
+            inserted = True
+            if count == len(sources): # grow the arc arrays
+                sources, targets = np.resize(sources, 2 * count), np.resize(targets, 2 * count)
+                added = np.concatenate([added, np.empty_like(added)], axis=1)
+                arcs[v][:3] = sources, targets, added
+            # a -> b becomes a -> node (same slot) and node -> b (new slot)
+            sources[count], targets[count] = node, targets[arc]
+            targets[arc] = node
+            arcs[v][3] = count + 1
+            price(v, arc)
+            price(v, count)
+            best(v)
+
+    def drop_optional(self):
+        '''
+        Purpose:
+            Drop optional nodes whose detour costs more than the penalty.
+        '''
+        dropped = False
+        optional = set(self.optional.tolist())
+        for v, route in enumerate(self.routes):
+            while len(route) > 2:
+                nodes = np.asarray(route)
+                saved = (self.matrix[nodes[:-2], nodes[1:-1]] + self.matrix[nodes[1:-1], nodes[2:]]
+                    - self.matrix[nodes[:-2], nodes[2:]])
+                saved[[node not in optional for node in route[1:-1]]] = -np.inf
+                k = int(np.argmax(saved))
+                if saved[k] <= self.penalty:
+                    break
+                self.loads[v] -= self.demands[route[k + 1]]
+                del route[k + 1]
+                dropped = True
+        return dropped
+
+    def two_opt(self):
+        '''
+        Purpose:
+            Improving segment reversals in each route, best first. Reversed
+            segments are priced in both directions (prefix sums), so
+            asymmetric matrices are handled.
+        '''
+        improved = False
+        for v in range(len(self.routes)):
+            while len(self.routes[v]) > 3:
+                route = self.routes[v]
+                a = np.asarray(route)
+                forward = np.concatenate([[0], np.cumsum(self.matrix[a[:-1], a[1:]])])
+                backward = np.concatenate([[0], np.cumsum(self.matrix[a[1:], a[:-1]])])
+                i = np.arange(len(a) - 1)[:, None]
+                j = np.arange(len(a) - 1)[None, :]
+                delta = (self.matrix[a[i], a[j]] + self.matrix[a[i + 1], a[j + 1]]
+                    - self.matrix[a[i], a[i + 1]] - self.matrix[a[j], a[j + 1]]
+                    + (backward[j] - backward[i + 1]) - (forward[j] - forward[i + 1]))
+                delta = np.where(j >= i + 2, delta, np.inf)
+                # reversals of disjoint stretches don't change each other's
+                # deltas, so apply every one that doesn't overlap
+                applied = []
+                for index in _smallest(delta, 64):
+                    bi, bj = np.unravel_index(index, delta.shape)
+                    if delta[bi, bj] >= -1e-9:
+                        break
+                    if any(bi <= aj + 1 and ai <= bj + 1 for ai, aj in applied):
+                        continue
+                    candidate = route[:bi + 1] + route[bi + 1:bj + 1][::-1] + route[bj + 1:]
+                    if self.valid(candidate, v):
+                        route = candidate
+                        applied.append((bi, bj))
+                if not applied:
+                    break
+                self.routes[v] = route
+                improved = True
+        return improved
+
+    def or_opt(self, max_length:int=3, candidates:int=64):
+        '''
+        Purpose:
+            Relocate segments of 1 to max_length nodes to any arc of any
+            route (same direction), best moves first.
+        '''
+        improved = False
+        while True:
+            vehicles, positions, sources, targets = self._edges()
+            nodes = [np.asarray(route) for route in self.routes]
+            blocks = [] # (vehicle, first position, length) per segment
+            for v, route in enumerate(nodes):
+                for length in range(1, max_length + 1):
+                    first = np.arange(1, len(route) - length)
+                    blocks.append(np.column_stack([
+                        np.full(len(first), v), first, np.full(len(first), length)]))
+            segments = np.concatenate(blocks).astype(np.int64)
+            if not len(segments):
+                return improved
+            seg_v, seg_first, seg_length = segments.T
+            # routes laid end to end so segment ends are one fancy index
+            flat = np.concatenate(nodes)
+            offsets = np.concatenate([[0], np.cumsum([len(route) for route in nodes])[:-1]])
+            start = offsets[seg_v] + seg_first
+            end = start + seg_length - 1
+            first_node, last_node = flat[start], flat[end]
+            before, after = flat[start - 1], flat[end + 1]
+            cumulative = np.concatenate([[0], np.cumsum(self.demands[flat])])
+            demand = cumulative[end + 1] - cumulative[start]
+            saved = (self.matrix[before, first_node] + self.matrix[last_node, after]
+                - self.matrix[before, after])
+            # granular neighbourhood: insert after one of the segment's
+            # nearest nodes, i.e. on the arc leaving it
+            leaving = np.full(len(self.matrix), -1, dtype=np.int64)
+            leaving[sources] = np.arange(len(sources))
+            arcs = leaving[self.neighbors()[first_node]]
+            known = arcs >= 0
+            arcs = np.where(known, arcs, 0)
+            arc_sources, arc_targets, arc_vehicles = sources[arcs], targets[arcs], vehicles[arcs]
+            added = (self.matrix[arc_sources, first_node[:, None]]
+                + self.matrix[last_node[:, None], arc_targets]
+                - self.matrix[arc_sources, arc_targets])
+            delta = added - saved[:, None]
+            same = arc_vehicles == seg_v[:, None]
+            # arcs touching the segment itself
+            arc_positions = positions[arcs]
+            touching = same & (arc_positions >= (seg_first - 1)[:, None]) & (
+                arc_positions <= (seg_first + seg_length - 1)[:, None])
+            fits = self.loads[arc_vehicles] + demand[:, None] <= self.capacities[arc_vehicles]
+            delta = np.where(known & ~touching & (same | fits), delta, np.inf)
+
+            # apply every improving move among the best candidates whose
+            # nodes (segment, its neighbours, the target arc) no other move
+            # touched yet; their deltas are still exact
+            used = set()
+            for index in _smallest(delta, candidates):
+                s, k = np.unravel_index(index, delta.shape)
+                if delta[s, k] >= -1e-9:
+                    break
+                e = arcs[s, k]
+                segment = flat[start[s]:end[s] + 1].tolist()
+                involved = {int(before[s]), int(after[s]), int(sources[e]), int(targets[e])}
+                involved.update(segment)
+                if involved & used:
+                    continue
+                v, target_v = int(seg_v[s]), int(vehicles[e])
+                if target_v != v and self.loads[target_v] + demand[s] > self.capacities[target_v]:
+                    continue
+                route = self.routes[v]
+                first = route.index(segment[0])
+                source_route = route[:first] + route[first + len(segment):]
+                target_route = source_route if target_v == v else self.routes[target_v]
+                position = target_route.index(int(sources[e]))
+                candidate = target_route[:position + 1] + segment + target_route[position + 1:]
+                if target_v == v:
+                    if not self.valid(candidate, v):
+                        continue
+                    self.routes[v] = candidate
+                else:
+                    if not (self.valid(source_route, v) and self.valid(candidate, target_v)):
+                        continue
+                    self.routes[v], self.routes[target_v] = source_route, candidate
+                    self.loads[v] -= demand[s]
+                    self.loads[target_v] += demand[s]
+                used |= involved
+            if not used:
+                return improved
+            improved = True
+
+    def swap_dropped(self):
+        '''
+        Purpose:
+            Replace a visited optional node with a dropped one when that
+            shortens the route and fits the vehicle (the drop penalty is the
+            same either way).
+        '''
+        routed = {node for route in self.routes for node in route}
+        dropped = np.array([node for node in self.optional.tolist()
+            if node not in routed], dtype=np.int64)
+        if not len(dropped):
+            return False
+        improved = False
+        optional = set(self.optional.tolist())
+        for v, route in enumerate(self.routes):
+            nodes = np.asarray(route)
+            inner = np.array([k for k in range(1, len(route) - 1)
+                if route[k] in optional], dtype=np.int64)
+            if not len(inner) or not len(dropped):
+                continue
+            before, node, after = nodes[inner - 1], nodes[inner], nodes[inner + 1]
+            delta = (self.matrix[before[:, None], dropped[None, :]]
+                + self.matrix[dropped[None, :], after[:, None]]
+                - (self.matrix[before, node] + self.matrix[node, after])[:, None])
+            fits = (self.loads[v] - self.demands[node][:, None]
+                + self.demands[dropped][None, :] <= self.capacities[v])
+            delta = np.where(fits, delta, np.inf)
+            k, c = np.unravel_index(np.argmin(delta), delta.shape)
+            if delta[k, c] < -1e-9 and (not self.timed or self.valid(
+                route[:inner[k]] + [int(dropped[c])] + route[inner[k] + 1:], v)):
+                self.loads[v] += self.demands[dropped[c]] - self.demands[node[k]]
+                route[inner[k]], dropped[c] = int(dropped[c]), node[k]
+                improved = True
+        return improved
+
+def route_from_scratch(data:dict, profile:str='default', time_limit:float=None,
+    removed:list=()):
+    '''
+    Purpose:
+        Codefest's WiFi was slow, so this started as a sandbox in case Google
+        OR Tools couldn't be downloaded in time. It is now a pure NumPy
+        prize-collecting heuristic for the same model as route: instant
+        quotes for the rider UI and the fallback when OR-Tools is missing or
+        finds nothing in time.
+
+    Args:
+        data: model data dict (see route): 'distance_matrix', 'demands',
+        'vehicle_capacities', 'num_vehicles', 'starts', 'ends' and the
+        optional 'pickups_deliveries' and 'vehicle_seats'.
+        profile: SOLVER_PROFILES entry; only its drop penalty is used.
+        time_limit: optional seconds for the local search (it otherwise runs
+        until no move improves the routes).
+        removed: nodes that must not be visited (see reroute).
+
+    Returns:
+        RouteResult with profile 'heuristic'. The objective is priced like
+        the OR-Tools model: arc costs plus the penalty per dropped node.
+
+    Notes:
+        Riders are inserted first (cheapest feasible pickup/drop-off arcs),
+        then optional nodes by greedy cheapest insertion while that costs
+        less than the penalty. Local search then repeats 2-opt, or-opt
+        (segments of up to 3 nodes, within and across routes), drop/add and
+        swap-with-dropped moves until none improves.
+    '''
+    data = preprocess.resolve_model(data)
+    start = time.perf_counter()
+    deadline = start + time_limit if time_limit is not None else np.inf
+    search = _LocalSearch(data, SOLVER_PROFILES[profile]['penalty'], removed)
+    search.insert_pairs()
+    search.insert_optional()
+    converged = search.improve(deadline)
+    routes = search.routes
+    distances = [np.cumsum([0] + _arc_costs(data['distance_matrix'], nodes))
+        for nodes in routes]
+    loads = [np.cumsum(search.demands[nodes]) for nodes in routes]
+    dropped = np.ones(len(search.demands), dtype=bool)
+    dropped[[node for nodes in routes for node in nodes]] = False
+    times = ([search.arrivals(nodes, v) for v, nodes in enumerate(routes)]
+        if search.timed else ())
+    return RouteResult(routes, distances, loads, np.flatnonzero(dropped),
+        objective=search.objective(),
+        status=HEURISTIC_SUCCESS if converged else HEURISTIC_TIMEOUT,
+        profile='heuristic', solve_time=time.perf_counter() - start, times=times)
+
+def _submodel(data:dict, nodes, vehicles:list):
+    '''
+    Purpose:
+        Model data restricted to some nodes (sorted global indexes) and
+        vehicles. The matrix is a block of data['distance_matrix'] when
+        there is one, an index subset of data['matrix_store'] (resolved by
+        whoever solves it) when there is a store, otherwise it's built from
+        data['locations'] for just these nodes.
+    '''
+    nodes = np.asarray(nodes, dtype=np.int64)
+    if 'distance_matrix' not in data and 'matrix_store' in data:
+        model = {
+            'matrix_store': data['matrix_store'],
+            'nodes': np.asarray(data['nodes'], dtype=np.int64)[nodes]
+        }
+    elif 'distance_matrix' in data:
+        model = {'distance_matrix': np.asarray(data['distance_matrix'])[np.ix_(nodes, nodes)]}
+    else:
+        model = {'distance_matrix': preprocess.build_distance_matrix(
+            np.asarray(data['locations'])[nodes], dtype='int32')}
+    model.update({
+        'demands': np.asarray(data['demands'], dtype=np.int64)[nodes],
+        'vehicle_capacities': [data['vehicle_capacities'][v] for v in vehicles],
+        'num_vehicles': len(vehicles),
+        'starts': np.searchsorted(nodes, [data['starts'][v] for v in vehicles]).tolist(),
+        'ends': np.searchsorted(nodes, [data['ends'][v] for v in vehicles]).tolist()
+    })
+    if 'travel_times' in data:
+        departures, _, tensor = _vehicle_travel_times(data)
+        model['travel_times'] = np.asarray(tensor[:, nodes][:, :, nodes])
+        model['vehicle_departures'] = [departures[v] for v in vehicles]
+        if data.get('time_windows') is not None:
+            model['time_windows'] = np.asarray(data['time_windows'])[nodes].tolist()
+        if 'max_wait' in data:
+            model['max_wait'] = data['max_wait']
+    return model
+
+def _route_arcs(data:dict, nodes:list):
+    '''
+    Purpose:
+        Arc costs along a route, from the matrix when the model has one.
+    '''
+    if 'distance_matrix' in data:
+        return _arc_costs(data['distance_matrix'], nodes)
+    if 'matrix_store' in data:
+        rows = np.asarray(data['nodes'], dtype=np.int64)[nodes]
+        matrix = preprocess.open_matrix_store(data['matrix_store']).distance_matrix
+        return matrix[rows[:-1], rows[1:]].astype(np.int64).tolist()
+    geo = preprocess._as_geo_array(data['locations'])[nodes]
+    return preprocess._scale_distances(preprocess.haversine_vector(
+        geo[:-1, 1], geo[:-1, 0], geo[1:, 1], geo[1:, 0]), np.int64).tolist()
+
+def route_decomposed(data:dict, profile:str='batch', time_limit:float=None,
+    workers:int=None, neighbors:int=2, repair_time:float=None, slack:float=0.1,
+    seed:int=0, metrics=None):
+    '''
+    Purpose:
+        Decomposition mode for citywide litter sweeps that are too large for
+        one all to all model: partition the nodes into one spatially compact
+        cluster per vehicle, solve the clusters in parallel and repair the
+        routes along the boundaries of neighboring clusters.
+
+    Args:
+        data: model data (see route) plus 'locations' ([[lat, lon], ...] per
+        node). 'distance_matrix' is optional here: without it only the
+        cluster (and repair) matrices are built from the locations, or
+        sliced from the 'matrix_store' of a store model, whose cluster
+        models then go to the workers as node rows only. Riders
+        ('pickups_deliveries') aren't supported.
+        profile: solver profile of the cluster solves ('batch' by default).
+        time_limit: optional search time limit per cluster.
+        workers: processes solving clusters (see route_many).
+        neighbors: nearest clusters each cluster is repaired with.
+        repair_time: optional seconds for the whole repair pass (it
+        otherwise runs every pair until no move improves).
+        slack: share of its fair load a cluster may go over.
+        seed: k-means++ seed when the vehicles share a start.
+        metrics: optional telemetry.Metrics; records the 'partition',
+        'search' and 'repair' stages.
+
+    Returns:
+        RouteResult with profile 'decomposed', priced like the monolithic
+        model (arc costs plus the penalty per dropped node).
+
+    Notes:
+        Clusters come from preprocess.cluster_locations with each cluster's
+        demand limited to its vehicle's share of all demand (proportional to
+        vehicle_capacities, plus slack), so no vehicle is handed far more
+        litter than it can collect while its neighbor runs empty. Clusters
+        start from the vehicle starts when those differ; otherwise clusters
+        are matched to vehicles nearest first. Every cluster is a small
+        model solved through route_many (failures fall back to
+        route_from_scratch). The repair pass takes each pair of neighboring
+        clusters (by center distance), their routes and unrouted nodes, and
+        runs the route_from_scratch local search on them, so nodes move
+        across the boundary, dropped boundary nodes get picked up by the
+        vehicle with room, and routes are re-optimized end to end.
+    '''
+    if data.get('pickups_deliveries'):
+        raise ValueError('route_decomposed does not support riders')
+    data = preprocess.resolve_model(data, matrix=False)
+    start = time.perf_counter()
+    penalty = SOLVER_PROFILES[profile]['penalty']
+    locations = preprocess._as_geo_array(data['locations'])
+    demands = np.asarray(data['demands'], dtype=np.int64)
+    capacities = np.asarray(data['vehicle_capacities'], dtype=np.float64)
+    starts, ends = list(data['starts']), list(data['ends'])
+    vehicles = data['num_vehicles']
+
+    with telemetry.stage(metrics, 'partition'):
+        fixed = set(starts) | set(ends)
+        optional = np.array([node for node in range(len(demands)) if node not in fixed],
+            dtype=np.int64)
+        limits = demands[optional].sum() * capacities / capacities.sum() * (1 + slack)
+        distinct = len(np.unique(locations[starts], axis=0)) == vehicles
+        labels, centers = preprocess.cluster_locations(locations[optional], vehicles,
+            weights=demands[optional], limits=limits,
+            centers=locations[starts] if distinct else None, seed=seed)
+        if not distinct: # nearest cluster/vehicle pairs first
+            gap = ((locations[starts][:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+            owner = np.full(vehicles, -1, dtype=np.int64)
+            taken = set()
+            for index in np.argsort(gap, axis=None):
+                v, c = np.unravel_index(index, gap.shape)
+                if owner[v] < 0 and c not in taken:
+                    owner[v] = c
+                    taken.add(c)
+            labels = np.argsort(owner)[labels] # cluster -> vehicle
+            centers = centers[owner]
+        members = [optional[labels == v] for v in range(vehicles)]
+        clusters = [np.unique(np.concatenate([[starts[v], ends[v]], members[v]]))
+            for v in range(vehicles)]
+        models = [_submodel(data, nodes, [v]) for v, nodes in enumerate(clusters)]
+
+    with telemetry.stage(metrics, 'search'):
+        routes = [None] * vehicles
+        statuses = []
+        for v, result in route_many(models, workers, profile, time_limit):
+            if not result:
+                result = route_from_scratch(models[v], profile, time_limit)
+            routes[v] = clusters[v][result.routes[0]].tolist()
+            statuses.append(result.status)
+
+    with telemetry.stage(metrics, 'repair'):
+        deadline = (time.perf_counter() + repair_time if repair_time is not None
+            else np.inf)
+        gap = ((centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(gap, np.inf)
+        pairs = sorted({tuple(sorted((a, int(b)))) for a in range(vehicles)
+            for b in np.argsort(gap[a])[:min(neighbors, vehicles - 1)]})
+        visited = np.zeros(len(demands), dtype=bool)
+        for route in routes:
+            visited[route] = True
+        for a, b in pairs:
+            if time.perf_counter() >= deadline:
+                break
+            # the pair's routes plus its clusters' nodes no vehicle visits
+            unrouted = np.concatenate([members[a], members[b]])
+            unrouted = unrouted[~visited[unrouted]]
+            nodes = np.unique(np.concatenate([routes[a], routes[b], unrouted]))
+            search = _LocalSearch(preprocess.resolve_model(
+                _submodel(data, nodes, [a, b])), penalty)
+            search.seed([np.searchsorted(nodes, routes[v]) for v in (a, b)])
+            search.improve(deadline)
+            visited[nodes] = False
+            for v, route in zip((a, b), search.routes):
+                routes[v] = nodes[route].tolist()
+                visited[routes[v]] = True
+
+    distances = [np.cumsum([0] + _route_arcs(data, nodes)) for nodes in routes]
+    loads = [np.cumsum(demands[nodes]) for nodes in routes]
+    dropped = np.ones(len(demands), dtype=bool)
+    dropped[[node for nodes in routes for node in nodes]] = False
+    dropped = np.flatnonzero(dropped)
+    return RouteResult(routes, distances, loads, dropped,
+        objective=int(sum(d[-1] for d in distances) + penalty * len(dropped)),
+        status=max(statuses), profile='decomposed',
+        solve_time=time.perf_counter() - start)
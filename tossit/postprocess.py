@@ -6,45 +6,26 @@ TODO:
     Abstract into data models and pipelines.
 '''
 from __future__ import print_function
-import math, numpy as np
+import json, math, os, numpy as np
 
-# Google OR-tools template function
-def print_solution(data, manager, routing, assignment):
-    """Prints assignment on console."""
+# Google OR-tools template function (reads an optimize.RouteResult)
+def print_solution(result):
+    """Prints the routes of a RouteResult on console."""
     # Display dropped nodes.
-    dropped_nodes = []
     dropped_nodes_msg = 'Total dropped nodes: {}'
-    for node in range(routing.Size()):
-        if routing.IsStart(node) or routing.IsEnd(node):
-            continue
-        if assignment.Value(routing.NextVar(node)) == node:
-            dropped_nodes.append(manager.IndexToNode(node))
-    print(dropped_nodes_msg.format(len(dropped_nodes)))
+    print(dropped_nodes_msg.format(len(result.dropped)))
     # Display routes
-    total_distance = 0
-    total_load = 0
-    for vehicle_id in range(data['num_vehicles']):
-        index = routing.Start(vehicle_id)
+    for vehicle_id, nodes in enumerate(result.routes):
+        loads = result.loads[vehicle_id]
         plan_output = 'Route for vehicle {}:\n'.format(vehicle_id)
-        route_distance = 0
-        route_load = 0
-        while not routing.IsEnd(index):
-            node_index = manager.IndexToNode(index)
-            route_load += data['demands'][node_index]
-            plan_output += ' {0} Points({1}) -> '.format(node_index, route_load)
-            previous_index = index
-            index = assignment.Value(routing.NextVar(index))
-            route_distance += routing.GetArcCostForVehicle(
-                previous_index, index, vehicle_id)
-        plan_output += ' {0} Points({1})\n'.format(
-            manager.IndexToNode(index), route_load)
-        plan_output += 'Distance of the route: {}m\n'.format(route_distance/100)
-        plan_output += 'Points of the route: {}\n'.format(route_load)
+        plan_output += ' -> '.join(
+            ' {0} Points({1})'.format(node, load) for node, load in zip(nodes, loads))
+        plan_output += '\nDistance of the route: {}m\n'.format(
+            result.distances[vehicle_id][-1]/100)
+        plan_output += 'Points of the route: {}\n'.format(loads[-1])
         print(plan_output)
-        total_distance += route_distance
-        total_load += route_load
-    print('Total Distance of all routes: {}m'.format(total_distance/100))
-    print('Total Points of all routes: {}'.format(total_load))
+    print('Total Distance of all routes: {}m'.format(result.total_distance/100))
+    print('Total Points of all routes: {}'.format(result.total_load))
 
 class Map(object):
     '''
@@ -82,40 +63,24 @@ class Map(object):
         rad_2 = math.log((1 + sinus) / (1 - sinus)) / 2
         return max(min(rad_2, math.pi), -math.pi) / 2
 
-    def _get_zoom(self, map_height_pix=900, map_width_pix=1900, zoom_max=21):
+    def _bounds(self):
+        """
+        Bounds of the points in one pass
+        :return: (min_lat, min_lon, max_lat, max_lon)
+        """
+        return get_bounds(np.asarray(self._points, dtype=float))
+
+    def _get_zoom(self, map_height_pix=900, map_width_pix=1900, zoom_max=21, bounds=None):
         """
         Algorithm to derive zoom from the activity route. For details please see
          - https://developers.google.com/maps/documentation/javascript/maptypes#WorldCoordinates
          - http://stackoverflow.com/questions/6048975/google-maps-v3-how-to-calculate-the-zoom-level-for-a-given-bounds
         :param zoom_max: maximal zoom level based on Google Map API
+        :param bounds: (min_lat, min_lon, max_lat, max_lon), computed if None
         :return:
         """
-
-        # at zoom level 0 the entire world can be displayed in an area that is 256 x 256 pixels
-        world_heigth_pix = 256
-        world_width_pix = 256
-
-        # get boundaries of the activity route
-        max_lat = max(x[0] for x in self._points)
-        min_lat = min(x[0] for x in self._points)
-        max_lon = max(x[1] for x in self._points)
-        min_lon = min(x[1] for x in self._points)
-
-        # calculate longitude fraction
-        diff_lon = max_lon - min_lon
-        if diff_lon < 0:
-            fraction_lon = (diff_lon + 360) / 360
-        else:
-            fraction_lon = diff_lon / 360
-
-        # calculate latitude fraction
-        fraction_lat = (self._lat_rad(max_lat) - self._lat_rad(min_lat)) / math.pi
-
-        # get zoom for both latitude and longitude
-        zoom_lat = math.floor(math.log(map_height_pix / world_heigth_pix / fraction_lat) / math.log(2))
-        zoom_lon = math.floor(math.log(map_width_pix / world_width_pix / fraction_lon) / math.log(2))
-
-        return min(zoom_lat, zoom_lon, zoom_max)
+        return get_zoom(bounds if bounds is not None else self._bounds(),
+            map_height_pix, map_width_pix, zoom_max)
 
     def __str__(self):
         """
@@ -125,41 +90,122 @@ class Map(object):
          - http://stackoverflow.com/questions/22342097/is-it-possible-to-create-a-google-map-from-python
         :return: string to be stored as html and opened in a web browser
         """
-        # center of the activity route
-        center_lat = (max((x[0] for x in self._points)) + min((x[0] for x in self._points))) / 2
-        center_lon = (max((x[1] for x in self._points)) + min((x[1] for x in self._points))) / 2
-
-        # get zoom needed for the route
-        zoom = self._get_zoom()
-
-        # string with points for the google.maps.Polyline
-        activity_coordinates = ",\n".join(
-            ["{{lat: {lat}, lng: {lon}}}".format(lat=x[0], lon=x[1]) for x in self._points])
-
-        return """
-            <script src="https://maps.googleapis.com/maps/api/js?v=3.exp&sensor=false"></script>
-            <div id="map-canvas" style="height: 100%; width: 100%"></div>
-            <script type="text/javascript">
-                var map;
-                function show_map() {{
-                    map = new google.maps.Map(document.getElementById("map-canvas"), {{
-                        zoom: {zoom},
-                        center: new google.maps.LatLng({center_lat}, {center_lon}),
-                        mapTypeId: 'terrain'
-                    }});
-
-                    var activity_coordinates = [{activity_coordinates}]
-
-                    var activity_route = new google.maps.Polyline({{
-                        path: activity_coordinates,
-                        geodesic: true,
-                        strokeColor: '#FF0000',
-                        strokeOpacity: 1.0,
-                        strokeWeight: 2
-                        }});
-
-                        activity_route.setMap(map);
-                }}
-                google.maps.event.addDomListener(window, 'load', show_map);
-            </script>
-        """.format(zoom=zoom, center_lat=center_lat, center_lon=center_lon, activity_coordinates=activity_coordinates)
+        return render_html([np.asarray(self._points, dtype=float)])
+
+def get_bounds(points):
+    """
+    Bounds of an (n, 2) [lat, lon] array in one pass
+    :return: (min_lat, min_lon, max_lat, max_lon)
+    """
+    low, high = points.min(axis=0), points.max(axis=0)
+    return low[0], low[1], high[0], high[1]
+
+def get_zoom(bounds, map_height_pix=900, map_width_pix=1900, zoom_max=21):
+    """
+    Zoom level that fits bounds (see Map._get_zoom)
+    """
+    # at zoom level 0 the entire world can be displayed in an area that is 256 x 256 pixels
+    world_heigth_pix = 256
+    world_width_pix = 256
+    min_lat, min_lon, max_lat, max_lon = bounds
+
+    # calculate longitude fraction
+    diff_lon = max_lon - min_lon
+    if diff_lon < 0:
+        fraction_lon = (diff_lon + 360) / 360
+    else:
+        fraction_lon = diff_lon / 360
+
+    # calculate latitude fraction
+    fraction_lat = (Map._lat_rad(max_lat) - Map._lat_rad(min_lat)) / math.pi
+
+    # get zoom for both latitude and longitude (a single point fits any zoom)
+    zoom_lat = zoom_lon = zoom_max
+    if fraction_lat > 0:
+        zoom_lat = math.floor(math.log(map_height_pix / world_heigth_pix / fraction_lat) / math.log(2))
+    if fraction_lon > 0:
+        zoom_lon = math.floor(math.log(map_width_pix / world_width_pix / fraction_lon) / math.log(2))
+
+    return min(zoom_lat, zoom_lon, zoom_max)
+
+def encode_polyline(points, precision:int=5):
+    """
+    Google encoded polyline of an (n, 2) [lat, lon] array, vectorized; see
+     - https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    :return: ascii string
+    """
+    scaled = np.rint(np.asarray(points, dtype=float) * 10**precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).reshape(-1)
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1) # zigzag
+
+    # split into 5-bit chunks, low bits first; all but the last get 0x20
+    chunks = (values[:, None] >> (5 * np.arange(7))) & 0x1f
+    counts = np.maximum(1, (np.floor(np.log2(np.maximum(values, 1))).astype(np.int64) // 5) + 1)
+    counts[values == 0] = 1
+    used = np.arange(7) < counts[:, None]
+    more = np.arange(7) < (counts - 1)[:, None]
+    chars = (chunks | (more * 0x20)) + 63
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+_MAP_TEMPLATE = """
+    <script src="https://maps.googleapis.com/maps/api/js?v=3.exp&libraries=geometry"></script>
+    <div id="map-canvas" style="height: 100%; width: 100%"></div>
+    <script type="text/javascript">
+        var paths = {paths};
+        function show_map() {{
+            var map = new google.maps.Map(document.getElementById("map-canvas"), {{
+                zoom: {zoom},
+                center: new google.maps.LatLng({center_lat}, {center_lon}),
+                mapTypeId: 'terrain'
+            }});
+            var decode = google.maps.geometry.encoding.decodePath;
+            for (var i = 0; i < paths.length; i++) {{
+                new google.maps.Polyline({{
+                    path: decode(paths[i]),
+                    geodesic: true,
+                    strokeColor: '#FF0000',
+                    strokeOpacity: 1.0,
+                    strokeWeight: 2,
+                    map: map
+                }});
+            }}
+        }}
+        google.maps.event.addDomListener(window, 'load', show_map);
+    </script>
+"""
+
+def render_html(routes:list):
+    """
+    Map page for one or more routes stored as encoded polylines
+    :param routes: list of (n, 2) [lat, lon] arrays (NaN rows are skipped)
+    :return: html string
+    """
+    routes = [r[~np.isnan(r).any(axis=1)] for r in map(np.asarray, routes)]
+    routes = [r for r in routes if len(r)]
+    bounds = get_bounds(np.vstack(routes))
+    return _MAP_TEMPLATE.format(
+        paths=json.dumps([encode_polyline(r) for r in routes]),
+        zoom=get_zoom(bounds),
+        center_lat=(bounds[0] + bounds[2]) / 2,
+        center_lon=(bounds[1] + bounds[3]) / 2)
+
+def render_routes(routes:list, target:str, combined:bool=True):
+    """
+    Headless batch rendering; never opens a browser
+    :param routes: list of (n, 2) [lat, lon] arrays
+    :param target: html file (combined) or directory (one file per route)
+    :param combined: one multi-route page for the batch or a page per route
+    :return: list of written paths
+    """
+    if combined:
+        with open(target, 'w') as out:
+            out.write(render_html(routes))
+        return [target]
+    os.makedirs(target, exist_ok=True)
+    paths = []
+    for i, route in enumerate(routes):
+        path = os.path.join(target, 'route_{}.html'.format(i))
+        with open(path, 'w') as out:
+            out.write(render_html([route]))
+        paths.append(path)
+    return paths
@@ -8,9 +8,29 @@ Notes:
     it can also be externalized. Since the problem scope is limited to Philly
     and/or mid-ranged proximity, haversine calculation will suffice in-app.
 '''
+from collections import OrderedDict
+from itertools import islice
 from math import radians, cos, sin, asin, sqrt
+import csv
+import hashlib
+import json
+import os
+import tempfile
 import numpy as np
 
+DISTANCE_SCALE = 100 # matrix units per kilometer (solver works in ints)
+LITTER_INDEX_CSV = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'notebooks', 'data', 'litter_index_lines.csv')
+LITTER_STORE_PATH = os.path.join(os.path.dirname(LITTER_INDEX_CSV), 'litter_store')
+
+# Effective door to door speed (km/h over the straight-line distance) per
+# hour of the day; slowest in the 7-9 and 16-18 rush hours.
+HOURLY_SPEEDS_KMH = (32, 34, 35, 35, 34, 30, 24, 17, 16, 21, 24, 24,
+    23, 23, 23, 21, 17, 16, 19, 24, 27, 29, 30, 31)
+DAY_SECONDS = 24 * 3600
+TIME_HORIZON = 2 * DAY_SECONDS # time windows may run past midnight
+
 def haversine(lon1, lat1, lon2, lat2):
     '''
     Purpose:
@@ -28,7 +48,7 @@ def haversine(lon1, lat1, lon2, lat2):
     r = 6371 # Radius of earth in kilometers. Use 3956 for miles
     return c * r
 
-def get_basic_geo_array():
+def get_basic_geo_array(n:int=50, seed:int=None):
     '''
     Purpose:
         First pass representation of a set of points to model. For simplicity
@@ -42,35 +62,1100 @@ def get_basic_geo_array():
         also accept *all* or at least a surplus of locations corresponding to
         litter to toss. Finally the rider should be able to pass the destination
         of their ride.
+
+    Args:
+        n: number of locations.
+        seed: optional seed for reproducible points (otherwise the global
+        np.random state is used).
+    '''
+    random = np.random if seed is None else np.random.default_rng(seed)
+    lats = random.uniform(low=39.94, high=39.96, size=(n,))
+    lons = random.uniform(low=-75.17, high=-75.14, size=(n,))
+    return np.column_stack([lats, lons])
+
+def haversine_vector(lon1, lat1, lon2, lat2):
     '''
-    lats = np.random.uniform(low=39.94, high=39.96, size=(50,))
-    lons = np.random.uniform(low=-75.17, high=-75.14, size=(50,))
-    return np.array([np.array(pair) for pair in zip(lats, lons)])
+    Purpose:
+        Vectorized haversine. Same formula (and argument order) as haversine
+        but accepts NumPy arrays and broadcasts them against each other, so an
+        all to all matrix is a single call with [:, None] and [None, :] views.
+    '''
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    r = 6371 # Radius of earth in kilometers.
+    return c * r
 
-def build_distance_matrix(geo_array:list):
+def _scale_distances(distances, dtype):
+    '''
+    Purpose:
+        Scale kilometer distances the way the solver expects them (km * 100,
+        rounded) and cast to the requested dtype.
+    '''
+    distances = np.rint(distances * DISTANCE_SCALE)
+    if np.dtype(dtype).kind in 'iu':
+        info = np.iinfo(dtype)
+        distances = np.clip(distances, info.min, info.max)
+    return distances.astype(dtype, copy=False)
+
+def _as_geo_array(geo_array):
+    return np.asarray(geo_array, dtype=np.float64).reshape(-1, 2)
+
+def _distance_block(geo_a, geo_b, dtype):
+    '''
+    Purpose:
+        Scaled distances from every location in geo_a to every location in
+        geo_b ([[lat, lon], ...] arrays).
+    '''
+    distances = haversine_vector(
+        geo_a[:, 1, None], geo_a[:, 0, None], geo_b[None, :, 1], geo_b[None, :, 0])
+    return _scale_distances(distances, dtype)
+
+def build_distance_matrix(geo_array:list, dtype='float64', cache=None):
     '''
     Purpose:
         Take an array (or list) of geocodes [[lat, lon], ...] pre-ordered and
         return a matrix of all to all distances using haversine calculations.
         The order of the matrix corresponds to the order of the geo_array.
 
+    Args:
+        geo_array: list of lists representing location geocodes. Example:
+        [[float, float], ...]
+        dtype: output dtype. 'float64' keeps the original behavior, 'float32'
+        halves the memory and 'int32' is ready to hand to Google OR (which
+        works in ints anyway).
+        cache: optional DistanceCache; only pairs it hasn't seen are computed.
+
+    Notes:
+        Computed in one broadcasted pass. build_distance_matrix_reference is
+        the original nested loop kept for benchmarking and validation.
+    '''
+    if cache is not None:
+        return _scale_distances(cache.distances(geo_array), dtype)
+    geo_array = _as_geo_array(geo_array)
+    return _distance_block(geo_array, geo_array, dtype)
+
+def build_distance_matrix_tiled(geo_array:list, path:str=None, tile_size:int=1024,
+    dtype='int32'):
+    '''
+    Purpose:
+        Same matrix as build_distance_matrix but computed block by block into
+        an on-disk .npy file that is memory-mapped. Peak memory is bounded by
+        tile_size^2 (a few temporaries of that size) instead of n^2, so the
+        matrix for city-scale point sets can be larger than RAM.
+
+    Args:
+        geo_array: list of lists representing location geocodes. Example:
+        [[float, float], ...]
+        path: .npy file to write; the caller owns it. Defaults to a
+        temporary file that is unlinked as soon as it's mapped on POSIX (the
+        mapping keeps the data until the matrix is released). Elsewhere the
+        caller deletes the returned matrix's filename when done with it.
+        tile_size: number of rows/columns computed per block.
+        dtype: output dtype (see build_distance_matrix).
+
+    Returns:
+        read-only numpy.memmap of shape (n, n). Index it like any other
+        matrix; only the pages touched are read from disk.
+    '''
+    geo_array = _as_geo_array(geo_array)
+    n = len(geo_array)
+    temporary = path is None
+    if temporary:
+        handle, path = tempfile.mkstemp(prefix='tossit_matrix_', suffix='.npy')
+        os.close(handle)
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n, n))
+    for i in range(0, n, tile_size):
+        rows = geo_array[i:i+tile_size]
+        for j in range(0, n, tile_size):
+            matrix[i:i+tile_size, j:j+tile_size] = _distance_block(
+                rows, geo_array[j:j+tile_size], dtype)
+        matrix.flush()
+    del matrix
+    matrix = load_distance_matrix(path)
+    if temporary and os.name == 'posix':
+        os.unlink(path)
+    return matrix
+
+def load_distance_matrix(path:str):
+    '''
+    Purpose:
+        Open a distance matrix written by build_distance_matrix_tiled (or
+        numpy.save) as a read-only memory map without loading it into RAM.
+    '''
+    return np.load(path, mmap_mode='r')
+
+def time_bucket(seconds:float, buckets:int=len(HOURLY_SPEEDS_KMH)):
+    '''
+    Purpose:
+        Travel-time bucket of a departure time (seconds since midnight; later
+        days wrap around).
+    '''
+    return int(seconds % DAY_SECONDS // (DAY_SECONDS / buckets))
+
+def build_travel_time_tensor(geo_array:list, speeds:list=HOURLY_SPEEDS_KMH,
+    path:str=None, dtype='int16', tile_size:int=1024, network=None):
+    '''
+    Purpose:
+        Travel seconds between every pair of locations for every time bucket
+        of the day (an hour each with the default speeds).
+
+    Args:
+        geo_array: list of lists representing location geocodes.
+        speeds: km/h per bucket; the number of speeds sets the bucket count.
+        path: optional .npy file. The tensor is then written tile by tile
+        (see build_distance_matrix_tiled) and returned memory-mapped, so
+        every solve and process reading it shares the same pages.
+        dtype: int16 covers trips up to ~9 hours; longer ones are clipped
+        (use int32 for regional point sets).
+        network: optional network.RoadNetwork; its shortest path km replace
+        the straight-line km.
+
+    Returns:
+        (buckets, n, n) array (a read-only numpy.memmap when path is given).
+        Bucket-major, so the matrix of one departure bucket is a contiguous
+        slice: tensor[time_bucket(departure)].
+    '''
+    geo_array = _as_geo_array(geo_array)
+    n = len(geo_array)
+    hours = 3600.0 / np.asarray(speeds, dtype=np.float64) # seconds per km
+    shape = (len(hours), n, n)
+    if path is None:
+        tensor = np.empty(shape, dtype=dtype)
+    else:
+        tensor = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    km = (None if network is None
+        else network.distance_matrix(geo_array, 'float64') / DISTANCE_SCALE)
+    info = np.iinfo(dtype)
+    for i in range(0, n, tile_size):
+        for j in range(0, n, tile_size):
+            if km is None:
+                rows, columns = geo_array[i:i+tile_size], geo_array[j:j+tile_size]
+                block = haversine_vector(rows[:, 1, None], rows[:, 0, None],
+                    columns[None, :, 1], columns[None, :, 0])
+            else:
+                block = km[i:i+tile_size, j:j+tile_size]
+            for bucket, seconds_per_km in enumerate(hours):
+                tensor[bucket, i:i+tile_size, j:j+tile_size] = np.clip(
+                    np.rint(block * seconds_per_km), info.min, info.max)
+    if path is None:
+        return tensor
+    tensor.flush()
+    del tensor
+    return load_distance_matrix(path)
+
+class DistanceCache(object):
+    '''
+    Purpose:
+        Pairwise distance cache for quantized coordinates. The same driver
+        depots, pickup spots and litter hotspots show up in most requests, so
+        building a matrix through the cache only computes the pairs it hasn't
+        seen before.
+
+    Notes:
+        Points are rounded to `precision` decimals (5 is ~1m) and given a
+        slot in a square kilometer matrix plus a boolean matrix of which
+        pairs are known. Lookups and fills are array operations on those
+        matrices; only the point -> slot mapping is a dict. The matrices
+        start at initial_points slots and double as points arrive, up to
+        max_points (a full 2048 point cache is ~36MB), so an idle or lightly
+        used cache stays small. When the cache is full the least recently
+        used points (and every pair involving them) are evicted. save() writes the cache to an
+        .npz file which is loaded back when the cache is created with the
+        same path, so it survives restarts.
+    '''
+    def __init__(self, max_points:int=2048, path:str=None, precision:int=5,
+        initial_points:int=64):
+        self.max_points = max_points
+        self.path = path
+        self.precision = precision
+        self._slots = OrderedDict() # quantized (lat, lon) -> slot, LRU order
+        self._free = []
+        self._points = np.zeros((0, 2))
+        self._km = np.zeros((0, 0))
+        self._known = np.zeros((0, 0), dtype=bool)
+        self._grow(min(initial_points, max_points))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def stats(self):
+        '''
+        Purpose:
+            Hit/miss counters (in pairs) for sizing the cache.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'points': len(self._slots),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def _grow(self, size:int):
+        '''
+        Purpose:
+            Enlarge the matrices to size slots, keeping every slot in place.
+        '''
+        used = len(self._points)
+        points = np.zeros((size, 2))
+        km = np.zeros((size, size))
+        known = np.zeros((size, size), dtype=bool)
+        points[:used] = self._points
+        km[:used, :used] = self._km
+        known[:used, :used] = self._known
+        self._points, self._km, self._known = points, km, known
+        self._free = list(range(size - 1, used - 1, -1)) + self._free
+
+    def quantize(self, geo_array:list):
+        return np.rint(_as_geo_array(geo_array) * 10**self.precision).astype(np.int64)
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._slots.move_to_end(key)
+            return slot
+        if not self._free and len(self._points) < self.max_points:
+            self._grow(min(self.max_points, max(1, 2 * len(self._points))))
+        if not self._free:
+            _, evicted = self._slots.popitem(last=False)
+            self._known[evicted, :] = False
+            self._known[:, evicted] = False
+            self._free.append(evicted)
+            self.evictions += 1
+        slot = self._free.pop()
+        self._slots[key] = slot
+        self._points[slot] = np.array(key) / 10**self.precision
+        return slot
+
+    def distances(self, geo_array:list):
+        '''
+        Purpose:
+            All to all kilometer distances for geo_array, computing only the
+            pairs missing from the cache.
+        '''
+        points, inverse = np.unique(
+            self.quantize(geo_array), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        if len(points) > self.max_points: # can't hold the request at once
+            self.misses += len(points) * (len(points) - 1) // 2
+            geo = points / 10**self.precision
+            km = haversine_vector(
+                geo[:, 1, None], geo[:, 0, None], geo[None, :, 1], geo[None, :, 0])
+            return km[np.ix_(inverse, inverse)]
+
+        # recently used slots move to the back of the LRU order first, so
+        # nothing this request needs is evicted while it's being filled
+        keys = [tuple(point) for point in points.tolist()]
+        for key in keys:
+            if key in self._slots:
+                self._slots.move_to_end(key)
+        slots = np.array([self._slot(key) for key in keys])
+        grid = np.ix_(slots, slots)
+        known = self._known[grid]
+        rows, cols = np.nonzero(np.triu(~known, 1))
+        pairs = len(slots) * (len(slots) - 1) // 2
+        self.misses += len(rows)
+        self.hits += pairs - len(rows)
+        if len(rows):
+            a, b = slots[rows], slots[cols]
+            km = haversine_vector(
+                self._points[a, 1], self._points[a, 0],
+                self._points[b, 1], self._points[b, 0])
+            self._km[a, b] = km
+            self._km[b, a] = km
+            self._known[a, b] = True
+            self._known[b, a] = True
+        return self._km[grid][np.ix_(inverse, inverse)]
+
+    def save(self, path:str=None):
+        '''
+        Purpose:
+            Write the cached points and pairs to an .npz file.
+        '''
+        path = path or self.path
+        slots = np.array(list(self._slots.values()), dtype=np.int64)
+        grid = np.ix_(slots, slots)
+        np.savez(path,
+            keys=np.array(list(self._slots.keys()), dtype=np.int64).reshape(-1, 2),
+            km=self._km[grid], known=self._known[grid], precision=self.precision)
+
+    def load(self, path:str):
+        '''
+        Purpose:
+            Restore a cache written by save (least recently used first).
+        '''
+        stored = np.load(path)
+        if int(stored['precision']) != self.precision:
+            return
+        keys = stored['keys'][-self.max_points:]
+        offset = len(stored['keys']) - len(keys)
+        slots = np.array([self._slot(tuple(key)) for key in keys.tolist()], dtype=np.int64)
+        grid = np.ix_(slots, slots)
+        self._km[grid] = stored['km'][offset:, offset:]
+        self._known[grid] = stored['known'][offset:, offset:]
+
+def build_distance_matrix_reference(geo_array:list):
+    '''
+    Purpose:
+        Original nested loop version of build_distance_matrix (calls the
+        scalar haversine n^2 times). Kept as the reference implementation the
+        vectorized path is checked and benchmarked against.
+
     Args:
         geo_array: list of lists representing location geocodes. Example:
         [[float, float], ...]
     '''
-    # simple nested loop to generate all to all
-    # TODO: may need to scale as app scales
     distance_matrix = []
     for location_a in geo_array:
         tmp_matrix = [] # build all to all by-location
         for location_b in geo_array:
-            tmp_matrix.append(
-                haversine(location_a[0], location_b[1], location_b[0], location_b[1])
+            tmp_matrix.append( # haversine takes (lon, lat, lon, lat)
+                haversine(location_a[1], location_a[0], location_b[1], location_b[0])
             )
         distance_matrix.append(tmp_matrix)
-    return np.round(np.array(distance_matrix) * 100, 0) # Google OR will convert to int
+    return np.round(np.array(distance_matrix) * DISTANCE_SCALE, 0) # Google OR will convert to int
+
+class GeoGrid(object):
+    '''
+    Purpose:
+        Uniform grid spatial index over [[lat, lon], ...] points. Points are
+        bucketed into roughly square cells (cell_km on a side) so radius and
+        nearest neighbor queries only look at nearby cells instead of every
+        point in the city.
+
+    Notes:
+        A grid is plenty for a single metro area (lat/lon distortion is small
+        and roughly constant), and it only needs NumPy.
+    '''
+    KM_PER_DEG_LAT = 111.195
+
+    def __init__(self, geo_array:list, cell_km:float=0.25):
+        self.points = _as_geo_array(geo_array)
+        self.cell_km = cell_km
+        ref_lat = self.points[:, 0].mean() if len(self.points) else 0.0
+        self._cell_lat = cell_km / self.KM_PER_DEG_LAT
+        self._cell_lon = cell_km / (self.KM_PER_DEG_LAT * cos(radians(ref_lat)))
+        cells = self._cells(self.points)
+        self._order = np.lexsort((cells[:, 1], cells[:, 0]))
+        keys, starts, counts = np.unique(
+            cells[self._order], axis=0, return_index=True, return_counts=True)
+        self._buckets = {
+            (int(i), int(j)): (s, s + c) for (i, j), s, c in zip(keys, starts, counts)}
+        # (row << 32) + column sorts the same way as the lexsort above, so
+        # each row of cells inside a box is one contiguous slice of _order
+        sorted_cells = cells[self._order]
+        self._keys = (sorted_cells[:, 0] << 32) + sorted_cells[:, 1]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cells(self, geo_array):
+        return np.column_stack([
+            np.floor(geo_array[:, 0] / self._cell_lat),
+            np.floor(geo_array[:, 1] / self._cell_lon)]).astype(np.int64)
+
+    def _ring(self, cell, ring:int):
+        '''
+        Purpose:
+            Point indexes in the cells exactly `ring` cells away from `cell`.
+        '''
+        ci, cj = cell
+        found = []
+        for i in range(ci - ring, ci + ring + 1):
+            step = 1 if i in (ci - ring, ci + ring) else 2 * ring
+            for j in range(cj - ring, cj + ring + 1, max(step, 1)):
+                bucket = self._buckets.get((i, j))
+                if bucket:
+                    found.append(self._order[bucket[0]:bucket[1]])
+        return found
+
+    def distances(self, lat:float, lon:float, indexes):
+        '''
+        Purpose:
+            Kilometer distances from (lat, lon) to the indexed points.
+        '''
+        points = self.points[indexes]
+        return haversine_vector(lon, lat, points[:, 1], points[:, 0])
+
+    def query_radius(self, lat:float, lon:float, radius_km:float):
+        '''
+        Purpose:
+            Indexes of every point within radius_km of (lat, lon), nearest
+            first.
+        '''
+        cell = tuple(self._cells(np.array([[lat, lon]]))[0])
+        rings = int(np.ceil(radius_km / self.cell_km))
+        found = [idx for ring in range(rings + 1) for idx in self._ring(cell, ring)]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        indexes = np.concatenate(found)
+        distances = self.distances(lat, lon, indexes)
+        keep = distances <= radius_km
+        return indexes[keep][np.argsort(distances[keep], kind='stable')]
+
+    def query_box(self, min_lat:float, min_lon:float, max_lat:float, max_lon:float):
+        '''
+        Purpose:
+            Indexes of the points in every cell overlapping the box (a
+            superset of the points strictly inside it; callers filter).
+        '''
+        (ci_min, cj_min), (ci_max, cj_max) = self._cells(
+            np.array([[min_lat, min_lon], [max_lat, max_lon]]))
+        rows = np.arange(ci_min, ci_max + 1, dtype=np.int64) << 32
+        lows = np.searchsorted(self._keys, rows + cj_min, side='left')
+        highs = np.searchsorted(self._keys, rows + cj_max, side='right')
+        slices = [self._order[lo:hi] for lo, hi in zip(lows, highs) if hi > lo]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(slices)
+
+    def query_knn(self, lat:float, lon:float, k:int):
+        '''
+        Purpose:
+            Indexes of the k points nearest to (lat, lon), nearest first.
+            Rings of cells are added until k points are found and the next
+            ring can't hold anything closer than the current k-th point.
+        '''
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        cell = tuple(self._cells(np.array([[lat, lon]]))[0])
+        found, count, ring = [], 0, 0
+        while True:
+            for idx in self._ring(cell, ring):
+                found.append(idx)
+                count += len(idx)
+            if count >= k:
+                indexes = np.concatenate(found)
+                distances = self.distances(lat, lon, indexes)
+                nearest = np.argpartition(distances, k - 1)[:k]
+                # anything outside the searched rings is at least this far
+                if distances[nearest].max() <= ring * self.cell_km:
+                    return indexes[nearest[np.argsort(distances[nearest], kind='stable')]]
+            ring += 1
+
+class LitterIndex(object):
+    '''
+    Purpose:
+        Spatial index over litter locations and their scores used to pick only
+        the litter worth a detour on a rider's pickup -> destination trip, so
+        the model stays small no matter how much litter the city has tagged.
+    '''
+    def __init__(self, geo_array:list, scores:list, cell_km:float=0.25):
+        self.grid = GeoGrid(geo_array, cell_km=cell_km)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        # digest of the litter data, e.g. to invalidate cached routes
+        digest = hashlib.sha1(np.ascontiguousarray(self.grid.points).tobytes())
+        digest.update(self.scores.tobytes())
+        self.version = digest.hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.grid)
+
+    def query_corridor(self, origin:list, destination:list, detour_km:float,
+        k:int=None):
+        '''
+        Purpose:
+            Litter inside the ellipse of points p with
+            d(origin, p) + d(p, destination) <= d(origin, destination) + detour_km
+            ranked by score per km of detour.
+
+        Args:
+            origin, destination: [lat, lon] of the rider's trip.
+            detour_km: extra kilometers the trip may grow by to pick up a
+            single item.
+            k: optional number of top candidates to return.
+
+        Returns:
+            (indexes, detours) numpy arrays, best candidates first.
+        '''
+        origin = np.asarray(origin, dtype=np.float64)
+        destination = np.asarray(destination, dtype=np.float64)
+        direct = haversine_vector(origin[1], origin[0], destination[1], destination[0])
+
+        # ellipse bounding box: the foci box grown by the semi-minor axis,
+        # which is never smaller than the detour/2 overshoot past each focus
+        grow_km = sqrt(detour_km * (2 * direct + detour_km)) / 2
+        grow_lat = grow_km / self.grid.KM_PER_DEG_LAT
+        grow_lon = grow_lat / cos(radians((origin[0] + destination[0]) / 2))
+        indexes = self.grid.query_box(
+            min(origin[0], destination[0]) - grow_lat,
+            min(origin[1], destination[1]) - grow_lon,
+            max(origin[0], destination[0]) + grow_lat,
+            max(origin[1], destination[1]) + grow_lon)
+
+        points = self.grid.points[indexes]
+        detours = (
+            haversine_vector(origin[1], origin[0], points[:, 1], points[:, 0])
+            + haversine_vector(points[:, 1], points[:, 0], destination[1], destination[0])
+            - direct)
+        inside = detours <= detour_km
+        indexes, detours = indexes[inside], detours[inside]
+
+        # score per unit detour; items right on the path only divide by ~10m
+        value = self.scores[indexes] / np.maximum(detours, 0.01)
+        if k is not None and k < len(indexes):
+            best = np.argpartition(-value, k - 1)[:k]
+            indexes, detours, value = indexes[best], detours[best], value[best]
+        order = np.argsort(-value, kind='stable')
+        return indexes[order], detours[order]
+
+def build_candidate_arcs(geo_array:list, k:int=10, radius_km:float=None,
+    keep:list=(), cell_km:float=0.25):
+    '''
+    Purpose:
+        Sparse candidate graph for the solver. Instead of every all to all arc,
+        each location only connects to its k nearest neighbors (and/or the
+        ones within radius_km). The relation is made symmetric, and the nodes
+        in `keep` (driver starts, rider pickups/destinations) stay connected
+        to everything so a feasible route always exists.
+
+    Args:
+        geo_array: list of lists representing location geocodes.
+        k: nearest neighbors per node. The quality/solve time knob -- larger
+        k gets closer to the dense model, smaller k searches fewer arcs.
+        radius_km: optional hard radius; arcs longer than this are dropped
+        even if they are among the k nearest (and all arcs within it kept
+        when k is None).
+        keep: node indexes that keep all of their arcs.
+
+    Returns:
+        boolean (n, n) numpy array where True marks an allowed arc.
+
+    Raises:
+        ValueError: when neither k nor radius_km is given, k is below 1 or
+        radius_km isn't positive.
+    '''
+    if k is None and radius_km is None:
+        raise ValueError('build_candidate_arcs needs k and/or radius_km')
+    if k is not None and k < 1:
+        raise ValueError('k must be at least 1, got {}'.format(k))
+    if radius_km is not None and not radius_km > 0:
+        raise ValueError('radius_km must be positive, got {}'.format(radius_km))
+    grid = GeoGrid(geo_array, cell_km=cell_km)
+    n = len(grid)
+    allowed = np.zeros((n, n), dtype=bool)
+    for node, (lat, lon) in enumerate(grid.points):
+        if k is not None:
+            neighbors = grid.query_knn(lat, lon, k + 1) # includes itself
+            if radius_km is not None:
+                neighbors = neighbors[
+                    grid.distances(lat, lon, neighbors) <= radius_km]
+        else:
+            neighbors = grid.query_radius(lat, lon, radius_km)
+        allowed[node, neighbors] = True
+    allowed |= allowed.T
+    keep = list(keep)
+    allowed[keep, :] = True
+    allowed[:, keep] = True
+    np.fill_diagonal(allowed, True)
+    return allowed
+
+def apply_candidate_arcs(distance_matrix, allowed, forbidden_cost:int=None):
+    '''
+    Purpose:
+        Price every arc outside the candidate graph as effectively forbidden.
+
+    Args:
+        distance_matrix: all to all matrix (see build_distance_matrix).
+        allowed: boolean mask from build_candidate_arcs.
+        forbidden_cost: cost of a non-candidate arc. Defaults to ten times
+        the longest candidate arc, which is far more than any detour.
+
+    Notes:
+        This only prices the arcs; it doesn't remove them. OR-Tools still
+        registers and may evaluate all n * n arcs, so model size and
+        per-move cost don't shrink. Only the search changes: the first
+        solution and local search steer clear of long arcs, which can reach
+        good routes in fewer moves (testing/benchmarks.bench_candidate_arcs
+        measures whether a given k pays off). A route that still uses a
+        forbidden arc shows it in the objective.
+    '''
+    matrix = np.array(distance_matrix, dtype=np.int64)
+    if forbidden_cost is None:
+        forbidden_cost = 10 * int(matrix[allowed].max()) + 1
+    matrix[~allowed] = forbidden_cost
+    return matrix
+
+KM_PER_DEGREE = 6371 * np.pi / 180 # along a meridian
+
+def _project(geo_array, latitude:float):
+    '''
+    Purpose:
+        Equirectangular km coordinates (x east, y north) around a reference
+        latitude, accurate enough for city scale clustering.
+    '''
+    return np.column_stack([
+        geo_array[:, 1] * KM_PER_DEGREE * np.cos(np.radians(latitude)),
+        geo_array[:, 0] * KM_PER_DEGREE])
+
+def _assign_balanced(distances, weights, limits):
+    '''
+    Purpose:
+        Nearest cluster per point without any cluster's summed weight going
+        over its limit. Each round every unassigned point asks its nearest
+        open cluster; a cluster accepts its closest askers while they fit and
+        closes once it turns one away. Points that fit nowhere take their
+        nearest cluster.
+    '''
+    n, k = distances.shape
+    labels = np.full(n, -1, dtype=np.int64)
+    totals = np.zeros(k)
+    open_ = np.ones(k, dtype=bool)
+    pending = np.arange(n)
+    while len(pending) and open_.any():
+        masked = np.where(open_[None, :], distances[pending], np.inf)
+        wanted = np.argmin(masked, axis=1)
+        order = np.lexsort((masked[np.arange(len(pending)), wanted], wanted))
+        points, wanted = pending[order], wanted[order]
+        # running weight of each cluster's askers, closest first (weights
+        # aren't negative, so the accepted askers are a prefix)
+        running = np.cumsum(weights[points])
+        running -= np.concatenate([[0], running])[np.searchsorted(wanted, wanted)]
+        accepted = totals[wanted] + running <= limits[wanted]
+        labels[points[accepted]] = wanted[accepted]
+        totals += np.bincount(wanted[accepted], weights[points[accepted]], minlength=k)
+        open_[wanted[~accepted]] = False
+        pending = points[~accepted]
+    if len(pending):
+        labels[pending] = np.argmin(distances[pending], axis=1)
+    return labels
+
+def cluster_locations(geo_array:list, k:int, weights:list=None, limits:list=None,
+    centers:list=None, iterations:int=25, seed:int=0):
+    '''
+    Purpose:
+        Spatially compact clusters of locations (k-means on projected lat/lon
+        with every point to center distance computed at once), optionally
+        capacity balanced.
+
+    Args:
+        geo_array: list of lists representing location geocodes.
+        k: number of clusters.
+        weights: optional weight per location (e.g. litter demand).
+        limits: optional most weight per cluster (e.g. sized to
+        vehicle_capacities); without it points simply join the nearest
+        center.
+        centers: optional initial [[lat, lon], ...] per cluster (e.g. the
+        vehicle starts); k-means++ seeding otherwise.
+        iterations: most assignment/update rounds.
+        seed: random seed of the k-means++ seeding.
+
+    Returns:
+        (labels, centers): int64 cluster per location and the [[lat, lon],
+        ...] cluster centers.
+    '''
+    geo_array = _as_geo_array(geo_array)
+    n = len(geo_array)
+    latitude = geo_array[:, 0].mean()
+    points = _project(geo_array, latitude)
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    if centers is None:
+        rng = np.random.default_rng(seed)
+        chosen = [rng.integers(n)]
+        nearest = ((points - points[chosen[0]]) ** 2).sum(axis=1)
+        for _ in range(1, k):
+            total = nearest.sum()
+            chosen.append(rng.choice(n, p=nearest / total) if total > 0 else rng.integers(n))
+            nearest = np.minimum(nearest, ((points - points[chosen[-1]]) ** 2).sum(axis=1))
+        centers = points[chosen]
+    else:
+        centers = _project(_as_geo_array(centers), latitude)
+    limits = None if limits is None else np.asarray(limits, dtype=np.float64)
+
+    labels = None
+    for _ in range(iterations):
+        distances = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        new = (np.argmin(distances, axis=1) if limits is None
+            else _assign_balanced(distances, weights, limits))
+        if labels is not None and np.array_equal(new, labels):
+            break
+        labels = new
+        counts = np.bincount(labels, minlength=k)
+        sums = np.column_stack([np.bincount(labels, points[:, axis], minlength=k)
+            for axis in range(2)])
+        # an empty cluster keeps its old center
+        centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+
+    return labels, np.column_stack([centers[:, 1] / KM_PER_DEGREE,
+        centers[:, 0] / (KM_PER_DEGREE * np.cos(np.radians(latitude)))])
+
+class LitterStore(object):
+    '''
+    Purpose:
+        Compact, array-backed litter index (see ingest_litter_index). Columns
+        are NumPy arrays -- memory-mapped when loaded from disk -- so opening
+        the ~40k segment index costs milliseconds at process start.
+
+    Attributes:
+        seg_id: int32 street segment ids.
+        score: float32 hundred block litter scores.
+        street_class: int8 street class codes (names in street_classes).
+        lat, lon: float64 segment coordinates when the source has them,
+        otherwise None.
+        version: sha1 of the source file; changes when the data is refreshed.
+    '''
+    COLUMNS = ('seg_id', 'score', 'street_class', 'lat', 'lon')
+
+    def __init__(self, seg_id, score, street_class, street_classes:dict,
+        lat=None, lon=None, version:str=None):
+        self.seg_id = seg_id
+        self.score = score
+        self.street_class = street_class
+        self.street_classes = street_classes
+        self.lat = lat
+        self.lon = lon
+        self.version = version
+
+    def __len__(self):
+        return len(self.seg_id)
+
+    def demands(self, indexes=None, scale:float=1):
+        '''
+        Purpose:
+            Integer solver demands (points) from litter scores.
+
+        Args:
+            indexes: optional subset of rows.
+            scale: points per unit of score.
+        '''
+        score = self.score if indexes is None else self.score[indexes]
+        return np.rint(np.asarray(score) * scale).astype(np.int64)
+
+    def save(self, path:str):
+        '''
+        Purpose:
+            Write one .npy per column plus meta.json into the directory path.
+        '''
+        os.makedirs(path, exist_ok=True)
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            if values is not None:
+                np.save(os.path.join(path, column + '.npy'), values)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'rows': len(self),
+                'version': self.version,
+                'street_classes': {str(k): v for k, v in self.street_classes.items()}
+            }, f)
+
+    @classmethod
+    def load(cls, path:str):
+        '''
+        Purpose:
+            Open a saved store with every column memory-mapped read-only.
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = {}
+        for column in cls.COLUMNS:
+            target = os.path.join(path, column + '.npy')
+            columns[column] = np.load(target, mmap_mode='r') if os.path.exists(target) else None
+        return cls(
+            street_classes={int(k): v for k, v in meta['street_classes'].items()},
+            version=meta['version'], **columns)
+
+def ingest_litter_index(csv_path:str=LITTER_INDEX_CSV, store_path:str=None,
+    chunksize:int=8192):
+    '''
+    Purpose:
+        Stream the litter index CSV (seg_id, hundred_block_score,
+        street_class, street_class_name, ...) chunk by chunk into a compact
+        LitterStore: int32 ids, float32 scores and int8 street class codes.
+        Rows without a score are skipped.
+
+    Args:
+        csv_path: litter index CSV (defaults to the bundled open data extract).
+        store_path: optional directory to save the store to (see
+        LitterStore.load).
+        chunksize: rows parsed per chunk.
+
+    Notes:
+        The open data extract has no coordinates. If a refresh adds lat/lon
+        (or latitude/longitude) columns they are stored too.
+    '''
+    columns = {column: [] for column in LitterStore.COLUMNS}
+    street_classes = {}
+    digest = hashlib.sha1()
+    with open(csv_path, newline='') as f:
+        header = f.readline()
+        digest.update(header.encode())
+        fields = next(csv.reader([header]))
+        position = {name: i for i, name in enumerate(fields)}
+        lat_field = next((c for c in ('lat', 'latitude') if c in position), None)
+        lon_field = next((c for c in ('lon', 'lng', 'longitude') if c in position), None)
+        has_coordinates = lat_field is not None and lon_field is not None
+        while True:
+            lines = list(islice(f, chunksize))
+            if not lines:
+                break
+            for line in lines:
+                digest.update(line.encode())
+            chunk = [row for row in csv.reader(lines)
+                if row and row[position['hundred_block_score']] != '']
+            columns['seg_id'].append(np.array(
+                [row[position['seg_id']] for row in chunk], dtype=np.int32))
+            columns['score'].append(np.array(
+                [row[position['hundred_block_score']] for row in chunk], dtype=np.float32))
+            codes = np.array(
+                [row[position['street_class']] or -1 for row in chunk], dtype=np.int8)
+            columns['street_class'].append(codes)
+            if 'street_class_name' in position:
+                for code, row in zip(codes.tolist(), chunk):
+                    name = row[position['street_class_name']]
+                    if name:
+                        street_classes.setdefault(code, name)
+            if has_coordinates:
+                columns['lat'].append(np.array(
+                    [row[position[lat_field]] or 'nan' for row in chunk], dtype=np.float64))
+                columns['lon'].append(np.array(
+                    [row[position[lon_field]] or 'nan' for row in chunk], dtype=np.float64))
+    store = LitterStore(
+        seg_id=np.concatenate(columns['seg_id']),
+        score=np.concatenate(columns['score']),
+        street_class=np.concatenate(columns['street_class']),
+        street_classes=street_classes,
+        lat=np.concatenate(columns['lat']) if has_coordinates else None,
+        lon=np.concatenate(columns['lon']) if has_coordinates else None,
+        version=digest.hexdigest())
+    if store_path is not None:
+        store.save(store_path)
+        return LitterStore.load(store_path)
+    return store
+
+def get_litter_store(store_path:str=LITTER_STORE_PATH, csv_path:str=LITTER_INDEX_CSV):
+    '''
+    Purpose:
+        Load the saved litter store, ingesting the CSV first if the store
+        doesn't exist yet or the CSV is newer than it.
+    '''
+    meta = os.path.join(store_path, 'meta.json')
+    if (not os.path.exists(meta)
+        or os.path.getmtime(csv_path) > os.path.getmtime(meta)):
+        return ingest_litter_index(csv_path, store_path)
+    return LitterStore.load(store_path)
+
+class MatrixStore(object):
+    '''
+    Purpose:
+        The city's all to all node matrix, demands and locations written
+        once and shared read-only by every solver process. A request's
+        model is an index subset of the store's nodes (see model and
+        resolve_model), so a solve task carries a few integer arrays instead
+        of its own matrix.
+
+    Notes:
+        Columns are .npy files memory-mapped read-only like LitterStore's.
+        Processes opening the same store map the same pages of the OS page
+        cache, so the matrix is in RAM once whatever the worker count. Put
+        the store on a tmpfs (e.g. /dev/shm) to keep it off disk. A store
+        pickles as its path and each process opens it once
+        (open_matrix_store).
+
+    Attributes:
+        path: the store directory.
+        distance_matrix: (n, n) scaled distances (km * DISTANCE_SCALE).
+        demands: int64 points per node.
+        locations: float64 [[lat, lon], ...] per node.
+        version: digest of the locations, demands and matrix dtype.
+    '''
+    COLUMNS = ('distance_matrix', 'demands', 'locations')
+
+    def __init__(self, path:str, distance_matrix, demands, locations, version:str=None):
+        self.path = path
+        self.distance_matrix = distance_matrix
+        self.demands = demands
+        self.locations = locations
+        self.version = version
+
+    def __len__(self):
+        return len(self.demands)
+
+    def __repr__(self):
+        return 'MatrixStore(path={!r}, nodes={}, version={})'.format(
+            self.path, len(self), self.version)
+
+    def __reduce__(self):
+        return (open_matrix_store, (self.path,))
+
+    @classmethod
+    def build(cls, geo_array:list, path:str=None, demands:list=None,
+        tile_size:int=1024, dtype='int32', network=None):
+        '''
+        Purpose:
+            Compute and save the store for these locations.
+
+        Args:
+            geo_array: [[lat, lon], ...] of every node.
+            path: store directory. Defaults to a new temporary directory.
+            demands: optional points per node (0 by default).
+            tile_size, dtype: see build_distance_matrix_tiled.
+            network: optional network.RoadNetwork for road distances (the
+            matrix is then computed in memory before it is written).
+        '''
+        geo_array = _as_geo_array(geo_array)
+        if path is None:
+            path = tempfile.mkdtemp(prefix='tossit_store_')
+        os.makedirs(path, exist_ok=True)
+        target = os.path.join(path, 'distance_matrix.npy')
+        if network is None:
+            build_distance_matrix_tiled(geo_array, target, tile_size, dtype)
+        else:
+            np.save(target, network.distance_matrix(geo_array, dtype))
+        demands = (np.zeros(len(geo_array), dtype=np.int64) if demands is None
+            else np.asarray(demands, dtype=np.int64))
+        np.save(os.path.join(path, 'demands.npy'), demands)
+        np.save(os.path.join(path, 'locations.npy'), geo_array)
+        digest = hashlib.sha1(geo_array.tobytes())
+        digest.update(demands.tobytes())
+        digest.update('{} {}'.format(np.dtype(dtype).str,
+            None if network is None else network.version).encode())
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'nodes': len(geo_array), 'version': digest.hexdigest()[:16]}, f)
+        return open_matrix_store(path)
+
+    @classmethod
+    def load(cls, path:str):
+        '''
+        Purpose:
+            Open a saved store with every column memory-mapped read-only.
+        '''
+        path = os.path.abspath(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+            for column in cls.COLUMNS}
+        return cls(path, version=meta['version'], **columns)
+
+    def submatrix(self, nodes):
+        '''
+        Purpose:
+            In-memory copy of the block between these nodes (only its pages
+            of the store are read).
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        return np.asarray(self.distance_matrix[np.ix_(nodes, nodes)])
+
+    def model(self, nodes:list, starts:list, ends:list, vehicle_capacities:list, **fields):
+        '''
+        Purpose:
+            Model data (see optimize.route) over a subset of the store's
+            nodes.
+
+        Args:
+            nodes: store rows of the model's nodes, in model order.
+            starts, ends: store rows of each vehicle's start and end (they
+            must be in nodes).
+            vehicle_capacities: max points per vehicle.
+            fields: other model fields in model indexes (e.g.
+            'pickups_deliveries', or 'demands' to override the store's).
+
+        Returns:
+            dict with 'matrix_store' (this store), 'nodes' and the vehicle
+            fields; optimize resolves the rest (see resolve_model).
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        position = {}
+        for i, node in enumerate(nodes.tolist()):
+            position.setdefault(node, i)
+        data = {
+            'matrix_store': self,
+            'nodes': nodes,
+            'num_vehicles': len(starts),
+            'starts': [position[int(node)] for node in starts],
+            'ends': [position[int(node)] for node in ends],
+            'vehicle_capacities': list(vehicle_capacities)
+        }
+        data.update(fields)
+        return data
+
+# path -> (meta.json mtime, MatrixStore) opened by this process
+_MATRIX_STORES = {}
+
+def open_matrix_store(store):
+    '''
+    Purpose:
+        The MatrixStore saved at path, opened once per process (and opened
+        again when the store was rebuilt). A MatrixStore is returned as is.
+    '''
+    if isinstance(store, MatrixStore):
+        return store
+    path = os.path.abspath(store)
+    stamp = os.path.getmtime(os.path.join(path, 'meta.json'))
+    entry = _MATRIX_STORES.get(path)
+    if entry is None or entry[0] != stamp:
+        entry = _MATRIX_STORES[path] = (stamp, MatrixStore.load(path))
+    return entry[1]
+
+def resolve_model(data:dict, matrix:bool=True):
+    '''
+    Purpose:
+        Fill in an index-subset model (data['matrix_store'] and
+        data['nodes'], see MatrixStore.model) from its store: the
+        'distance_matrix' block between its nodes, and 'demands' and
+        'locations' unless the model sets them. Other models are returned
+        unchanged.
+
+    Args:
+        data: model data dict.
+        matrix: False leaves the matrix out (for callers that only need
+        demands and locations).
+    '''
+    if 'matrix_store' not in data:
+        return data
+    store = open_matrix_store(data['matrix_store'])
+    nodes = np.asarray(data['nodes'], dtype=np.int64)
+    model = dict(data)
+    if matrix and 'distance_matrix' not in model:
+        model['distance_matrix'] = store.submatrix(nodes)
+    if model.get('demands') is None:
+        model['demands'] = np.asarray(store.demands[nodes])
+    if model.get('locations') is None:
+        model['locations'] = np.asarray(store.locations[nodes])
+    return model
+
+def build_scenario(n:int, num_vehicles:int=1, seed:int=0, capacity:int=None):
+    '''
+    Purpose:
+        Seeded, reproducible model for tests and benchmarks: num_vehicles
+        drivers starting at the first nodes, litter in the middle and a shared
+        destination as the last node. Same seed, same scenario.
+
+    Args:
+        n: total number of locations (at least num_vehicles + 1).
+        num_vehicles: number of drivers.
+        seed: random seed.
+        capacity: points per vehicle. Defaults to enough for about half of
+        the litter split across the vehicles (so some nodes get dropped).
+    '''
+    rng = np.random.default_rng(seed)
+    locations = get_basic_geo_array(n, seed=rng)
+    demands = rng.integers(low=1, high=4, size=n)
+    demands[:num_vehicles] = 0
+    demands[-1] = 0
+    if capacity is None:
+        capacity = max(5, int(demands.sum()) // (2 * num_vehicles))
+    return {
+        'demands': demands,
+        'vehicle_capacities': [capacity] * num_vehicles,
+        'distance_matrix': build_distance_matrix(locations, dtype='int32'),
+        'num_vehicles': num_vehicles,
+        'starts': list(range(num_vehicles)),
+        'ends': [n-1] * num_vehicles,
+        'locations': locations
+    }
 
-def build_model_data(n:int):
+def build_model_data(n:int, litter_demands:list=None):
     '''
     Purpose:
         UPDATE: improved complexity.
@@ -92,13 +1177,18 @@ def build_model_data(n:int):
 
     Args:
         n: int of number of locations
+        litter_demands: optional n-2 points for the litter locations (e.g.
+        LitterStore.demands for the selected segments). Defaults to the
+        original placeholder of 1 point each.
     '''
     num_vehicles = 1
+    if litter_demands is None:
+        litter_demands = np.random.randint(low=1, high=2, size=n-2)
     return { # rider is depot
         'demands': np.append(
             np.array([0]),
             np.append(
-                np.random.randint(low=1, high=2, size=n-2),
+                np.asarray(litter_demands, dtype=np.int64),
                 np.array([0]),
                 axis=0),
             axis=0),
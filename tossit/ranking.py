@@ -0,0 +1,264 @@
+'''
+Purpose:
+    Route scoring and city-wide driver/rider rankings (README: Ranking
+    system).
+
+Notes:
+    Routes are scored in batches with array operations: every route's nodes
+    are laid end to end and per-route sums come from np.add.reduceat.
+    Leaderboards update in O(log n) per ride: a lazy min-heap holds the top
+    k, and a Fenwick tree over integer point totals answers "how many users
+    have more points" for any user's rank, so nothing is re-sorted per
+    update. Rankings keeps all-time boards plus boards per time bucket
+    (e.g. per week) with ride/point/km aggregates.
+'''
+from collections import OrderedDict
+from heapq import heappop, heappush
+from . import preprocess
+import numpy as np
+import time
+
+SCORE_FIELDS = ('points', 'distance_km', 'direct_km', 'detour_km', 'points_per_km')
+
+def score_routes(routes:list, distance_matrix, demands:list):
+    '''
+    Purpose:
+        Score every route of one model at once.
+
+    Args:
+        routes: list of node sequences (e.g. RouteResult.routes).
+        distance_matrix: the model's scaled matrix (km * DISTANCE_SCALE).
+        demands: points per node.
+
+    Returns:
+        dict of arrays, one entry per route: 'points' collected,
+        'distance_km' driven, 'direct_km' (start straight to end),
+        'detour_km' (distance_km - direct_km) and 'points_per_km'.
+    '''
+    matrix = np.asarray(distance_matrix)
+    lengths = np.array([len(nodes) for nodes in routes], dtype=np.int64)
+    flat = np.concatenate([np.asarray(nodes, dtype=np.int64) for nodes in routes])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    ends = starts + lengths - 1
+    # arcs between consecutive nodes, minus the ones joining two routes
+    arcs = np.append(matrix[flat[:-1], flat[1:]].astype(np.float64), 0)
+    arcs[ends] = 0
+    distance = np.add.reduceat(arcs, starts) / preprocess.DISTANCE_SCALE
+    points = np.add.reduceat(np.asarray(demands, dtype=np.float64)[flat], starts)
+    direct = matrix[flat[starts], flat[ends]] / preprocess.DISTANCE_SCALE
+    return _scores(points, distance, direct)
+
+def score_results(results:list, models:list):
+    '''
+    Purpose:
+        Score a batch of completed rides (RouteResults and their model
+        data) from the cumulative distances/loads the results already carry.
+
+    Returns:
+        dict of arrays like score_routes, one entry per route of every
+        result in order, plus 'ride' (index into results) and 'vehicle'.
+    '''
+    points, distance, direct, ride, vehicle = [], [], [], [], []
+    for i, (result, data) in enumerate(zip(results, models)):
+        matrix = data['distance_matrix']
+        for v, nodes in enumerate(result.routes):
+            points.append(result.loads[v][-1] if len(result.loads[v]) else 0)
+            distance.append(result.distances[v][-1] if len(result.distances[v]) else 0)
+            direct.append(matrix[nodes[0]][nodes[-1]] if len(nodes) else 0)
+            ride.append(i)
+            vehicle.append(v)
+    scores = _scores(np.array(points, dtype=np.float64),
+        np.array(distance, dtype=np.float64) / preprocess.DISTANCE_SCALE,
+        np.array(direct, dtype=np.float64) / preprocess.DISTANCE_SCALE)
+    scores['ride'] = np.array(ride, dtype=np.int64)
+    scores['vehicle'] = np.array(vehicle, dtype=np.int64)
+    return scores
+
+def _scores(points, distance, direct):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_km = np.where(distance > 0, points / distance, 0.0)
+    return {
+        'points': points,
+        'distance_km': distance,
+        'direct_km': direct,
+        'detour_km': distance - direct,
+        'points_per_km': per_km
+    }
+
+class _Counts(object):
+    '''
+    Purpose:
+        Fenwick tree of how many users hold each integer point total. The
+        array doubles when a total outgrows it.
+    '''
+    def __init__(self, size:int=1024):
+        self.tree = [0] * (size + 1)
+        self.users = 0
+
+    def add(self, total:int, count:int):
+        if total + 1 >= len(self.tree):
+            self._grow(total + 1)
+        self.users += count
+        i = total + 1
+        while i < len(self.tree):
+            self.tree[i] += count
+            i += i & -i
+
+    def at_most(self, total:int):
+        i = min(total + 1, len(self.tree) - 1)
+        count = 0
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+
+    def _grow(self, needed:int):
+        size = len(self.tree) - 1
+        while size < needed:
+            size *= 2
+        counts = [0] * (size + 1)
+        for total in range(len(self.tree) - 1):
+            counts[total + 1] = self.at_most(total) - self.at_most(total - 1)
+        # rebuild in O(size)
+        for i in range(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                counts[j] += counts[i]
+        self.tree = counts
+
+class Leaderboard(object):
+    '''
+    Purpose:
+        Point totals per user with O(log n) updates, top-k and rank queries.
+
+    Notes:
+        Totals only grow (points are never negative), so a user leaves the
+        top k only when someone passes them. Stale heap entries are skipped
+        when popped and compacted away when they pile up.
+    '''
+    def __init__(self, k:int=10):
+        self.k = k
+        self.totals = {}
+        self._counts = _Counts()
+        self._heap = [] # (total, user) min-heap of the top k, lazily updated
+        self._top = {} # user -> total for users in the top k
+
+    def __len__(self):
+        return len(self.totals)
+
+    def add(self, user, points:int):
+        points = int(points)
+        if points < 0:
+            raise ValueError('points must not be negative')
+        old = self.totals.get(user)
+        total = (old or 0) + points
+        self.totals[user] = total
+        if old is not None:
+            self._counts.add(old, -1)
+        self._counts.add(total, 1)
+
+        if user in self._top:
+            self._top[user] = total
+            heappush(self._heap, (total, user))
+        elif len(self._top) < self.k:
+            self._top[user] = total
+            heappush(self._heap, (total, user))
+        elif total > self._minimum():
+            _, evicted = heappop(self._heap)
+            del self._top[evicted]
+            self._top[user] = total
+            heappush(self._heap, (total, user))
+        if len(self._heap) > 4 * self.k: # compact stale entries
+            self._heap = [(total, user) for user, total in self._top.items()]
+            self._heap.sort()
+        return total
+
+    def _minimum(self):
+        '''
+        Purpose:
+            Lowest current total in the top k (stale entries are dropped).
+        '''
+        while self._heap[0][0] != self._top.get(self._heap[0][1]):
+            heappop(self._heap)
+        return self._heap[0][0]
+
+    def top(self, k:int=None):
+        '''
+        Purpose:
+            [(user, total), ...] highest first (k <= the board's k).
+        '''
+        ranked = sorted(self._top.items(), key=lambda item: -item[1])
+        return ranked[:k or self.k]
+
+    def rank(self, user):
+        '''
+        Purpose:
+            1 + the number of users with more points (ties share a rank).
+        '''
+        return self.rank_of(self.totals[user])
+
+    def rank_of(self, total:int):
+        '''
+        Purpose:
+            The rank a user with this many points would have.
+        '''
+        return 1 + self._counts.users - self._counts.at_most(int(total))
+
+class Rankings(object):
+    '''
+    Purpose:
+        All-time and per time bucket driver and rider leaderboards with
+        ride aggregates.
+
+    Args:
+        k: top-k size of every board.
+        bucket_seconds: bucket width (a week by default).
+        buckets: most recent buckets kept.
+    '''
+    def __init__(self, k:int=10, bucket_seconds:int=7 * 24 * 3600, buckets:int=8):
+        self.k = k
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.drivers = Leaderboard(k)
+        self.riders = Leaderboard(k)
+        self.periods = OrderedDict() # bucket -> {'drivers', 'riders', 'rides', 'points', 'km'}
+
+    def bucket(self, timestamp:float=None):
+        return int((time.time() if timestamp is None else timestamp) // self.bucket_seconds)
+
+    def period(self, bucket:int):
+        period = self.periods.get(bucket)
+        if period is None:
+            period = self.periods[bucket] = {'drivers': Leaderboard(self.k),
+                'riders': Leaderboard(self.k), 'rides': 0, 'points': 0, 'km': 0.0}
+            # late rides can open an older bucket, so drop by age, not order
+            while len(self.periods) > self.buckets:
+                del self.periods[min(self.periods)]
+        return period
+
+    def record(self, points:int, distance_km:float, driver=None, rider=None,
+        timestamp:float=None):
+        '''
+        Purpose:
+            Credit one completed ride's points to its driver and rider.
+        '''
+        period = self.period(self.bucket(timestamp))
+        period['rides'] += 1
+        period['points'] += int(points)
+        period['km'] += float(distance_km)
+        for user, board, bucket_board in ((driver, self.drivers, period['drivers']),
+            (rider, self.riders, period['riders'])):
+            if user is not None:
+                board.add(user, points)
+                bucket_board.add(user, points)
+
+    def record_batch(self, scores:dict, drivers:list, riders:list, timestamps:list=None):
+        '''
+        Purpose:
+            Record many rides from score_results/score_routes output.
+        '''
+        timestamps = [None] * len(drivers) if timestamps is None else timestamps
+        for points, km, driver, rider, timestamp in zip(
+            np.rint(scores['points']).astype(np.int64).tolist(),
+            scores['distance_km'].tolist(), drivers, riders, timestamps):
+            self.record(points, km, driver, rider, timestamp)
@@ -0,0 +1,267 @@
+'''
+Purpose:
+    Asyncio front-end that takes ride requests concurrently and serves them
+    with batched dispatch solves.
+
+Notes:
+    Requests wait in a bounded queue (callers block when it's full, which is
+    the backpressure). A batcher task groups the requests that arrive within
+    a short window (or up to max_batch of them) into one multi-rider,
+    multi-vehicle model (dispatch.build_dispatch_model) solved in a process
+    pool so the event loop keeps accepting requests (OR-Tools holds the GIL
+    for the whole search, so a thread would stall the loop). Each caller gets
+    its own rider's assignment back. Under load the queue fills while a
+    batch is solving, so batches grow with the arrival rate.
+
+    Workers solve against a pickled copy of the driver pool, so the service
+    books drivers in its own pool when a batch returns: assigned drivers are
+    marked unavailable until release(). Riders whose driver was booked by
+    another batch in flight meanwhile are solved again.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from . import dispatch
+from . import optimize
+import asyncio
+import numpy as np
+import time
+
+def dispatch_batch(riders:list, pool, litter_index=None, profile:str='interactive',
+    k:int=3, **kwargs):
+    '''
+    Purpose:
+        Solve one batch of riders with the drivers nearest to them. Module
+        level so it can run in a process pool.
+
+    Args:
+        riders: list of {'origin': [lat, lon], 'destination': [lat, lon]}.
+        pool: dispatch.DriverPool.
+        litter_index: optional preprocess.LitterIndex.
+        profile: optimize.SOLVER_PROFILES entry.
+        k: nearest drivers considered per rider.
+        kwargs: passed on to dispatch.build_dispatch_model.
+
+    Returns:
+        list per rider of {'driver_id', 'stops'} where stops are the
+        [lat, lon] of the assigned driver's route (driver_id None and no
+        stops when the rider wasn't served).
+    '''
+    data = dispatch.build_dispatch_model(
+        riders, pool, k=k, litter_index=litter_index, **kwargs)
+    result = optimize.route(data, profile=profile)
+    if result.error is not None:
+        raise RuntimeError(result.error)
+    drivers = dispatch.assign_riders(data, result)
+    vehicles = {driver_id: vehicle for vehicle, driver_id in enumerate(data['driver_ids'])}
+    served = []
+    for driver_id in drivers:
+        if driver_id is None:
+            served.append({'driver_id': None, 'stops': []})
+            continue
+        nodes = result.routes[vehicles[driver_id]][:-1] # without the free end
+        served.append({'driver_id': driver_id,
+            'stops': data['locations'][nodes].tolist()})
+    return served
+
+def percentiles(values:list, q:tuple=(50, 95, 99)):
+    if not len(values):
+        return {p: None for p in q}
+    return dict(zip(q, np.percentile(values, q).tolist()))
+
+class RideService(object):
+    '''
+    Purpose:
+        Concurrent ride request front-end with micro-batching.
+
+    Example:
+        service = RideService(pool)
+        await service.start()
+        assignment = await service.request([lat, lon], [lat, lon])
+        await service.stop()
+    '''
+    def __init__(self, pool, litter_index=None, window:float=0.01,
+        max_batch:int=4, max_queue:int=256, concurrency:int=1, executor=None,
+        profile:str='interactive', k:int=3, **kwargs):
+        '''
+        Args:
+            pool: dispatch.DriverPool of live drivers.
+            litter_index: optional preprocess.LitterIndex.
+            window: seconds to wait for more requests after the first one of
+            a batch arrives.
+            max_batch: most riders per solve. Small batches amortize the
+            per solve overhead; search cost grows faster than linearly with
+            riders, so large batches lose throughput (see
+            testing/benchmarks.bench_service).
+            max_queue: pending requests before request() blocks.
+            concurrency: batches solving at once.
+            executor: concurrent.futures executor for the solves (defaults
+            to a process pool of size concurrency). The driver pool is
+            pickled per batch; assigned drivers are marked unavailable in
+            pool until release().
+            profile, k, kwargs: passed on to dispatch_batch.
+        '''
+        self.pool = pool
+        self.litter_index = litter_index
+        self.window = window
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.executor = executor
+        self.profile = profile
+        self.k = k
+        self.kwargs = kwargs
+        self.latencies = []
+        self.batch_sizes = []
+        self.solve_times = []
+        self._queue = None
+        self._batcher = None
+        self._inflight = set()
+        self._own_executor = False
+        self._started = None
+        self._stopped = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.concurrency)
+            self._own_executor = True
+        self._started = time.perf_counter()
+        self._stopped = None
+        self._batcher = asyncio.get_running_loop().create_task(self._batch_requests())
+
+    async def stop(self):
+        '''
+        Purpose:
+            Finish the queued and in-flight requests, then stop batching.
+        '''
+        await self._queue.join()
+        if self._inflight:
+            await asyncio.gather(*self._inflight)
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._stopped = time.perf_counter()
+        if self._own_executor:
+            self.executor.shutdown()
+            self.executor = None
+            self._own_executor = False
+
+    async def request(self, origin:list, destination:list, block:bool=True):
+        '''
+        Purpose:
+            Request a ride and wait for the assignment.
+
+        Args:
+            origin, destination: [lat, lon].
+            block: wait for room when the queue is full; otherwise raise
+            asyncio.QueueFull right away.
+
+        Returns:
+            {'driver_id', 'stops'} (see dispatch_batch).
+        '''
+        future = asyncio.get_running_loop().create_future()
+        item = ({'origin': origin, 'destination': destination}, future,
+            time.perf_counter())
+        if block:
+            await self._queue.put(item)
+        else:
+            self._queue.put_nowait(item)
+        return await future
+
+    def release(self, driver_id):
+        '''
+        Purpose:
+            Make a booked driver available again (their ride is over).
+        '''
+        self.pool.set_available(driver_id, True)
+
+    async def _batch_requests(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for a free solve slot first so requests keep queueing
+            # (and batches keep growing) while every slot is busy
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self._solve(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _solve(self, batch:list):
+        loop = asyncio.get_running_loop()
+        served = [None] * len(batch)
+        pending = list(range(len(batch)))
+        start = time.perf_counter()
+        try:
+            while pending:
+                assignments = await loop.run_in_executor(self.executor, partial(
+                    dispatch_batch, [batch[i][0] for i in pending], self.pool,
+                    self.litter_index, self.profile, self.k, **self.kwargs))
+                pending = self._book(pending, assignments, served)
+        except Exception as e:
+            served = [e if assignment is None else assignment for assignment in served]
+        finally:
+            self._slots.release()
+        now = time.perf_counter()
+        self.batch_sizes.append(len(batch))
+        self.solve_times.append(now - start)
+        for (_, future, queued), assignment in zip(batch, served):
+            self.latencies.append(now - queued)
+            if future.cancelled():
+                pass
+            elif isinstance(assignment, Exception):
+                future.set_exception(assignment)
+            else:
+                future.set_result(assignment)
+            self._queue.task_done()
+
+    def _book(self, riders:list, assignments:list, served:list):
+        '''
+        Purpose:
+            Mark the drivers of a solved batch unavailable in the service's
+            pool and fill in served. Returns the riders to solve again: those
+            whose driver stopped being available while the batch solved.
+        '''
+        taken = {assignment['driver_id'] for assignment in assignments
+            if assignment['driver_id'] is not None
+            and not self.pool.is_available(assignment['driver_id'])}
+        again = []
+        for rider, assignment in zip(riders, assignments):
+            if assignment['driver_id'] in taken:
+                again.append(rider)
+                continue
+            if assignment['driver_id'] is not None:
+                self.pool.set_available(assignment['driver_id'], False)
+            served[rider] = assignment
+        return again
+
+    def stats(self):
+        '''
+        Purpose:
+            Latency percentiles (seconds, queueing included), per batch
+            solve percentiles (executor round trip included), throughput
+            (requests per second while running) and batch sizes.
+        '''
+        if self._started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._stopped or time.perf_counter()) - self._started
+        return {
+            'requests': len(self.latencies),
+            'batches': len(self.batch_sizes),
+            'mean_batch': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'latency': percentiles(self.latencies),
+            'solve': percentiles(self.solve_times),
+            'throughput': len(self.latencies) / elapsed if elapsed > 0 else 0.0
+        }
@@ -0,0 +1,315 @@
+'''
+Purpose:
+    Seeded discrete-event simulation of a day of ride requests, driver
+    movements and litter tags driven through Main (dispatch.build_dispatch_model
+    and optimize.route), for offline capacity planning.
+
+Notes:
+    Events sit in a heap ordered by simulated time. Ride requests arrive as a
+    Poisson process whose rate follows HOURLY_DEMAND; each one is quoted
+    through Main.dispatch and its wall-clock latency recorded. A served rider
+    takes their driver out of the pool until the ride completes (route km at
+    the hour's speed), when the driver reappears at the last stop and the
+    ride's litter counts as collected. Idle drivers wander, new litter is
+    tagged through the day and the litter index is refreshed periodically
+    (new tags in, collected litter out) like the live data feed. Quotes use
+    the live index between refreshes, so already collected litter can be
+    offered again until the next refresh.
+
+Example:
+    python -m tossit.simulate --hours 24 --requests-per-hour 120 --csv-scores
+'''
+from heapq import heappop, heappush
+from . import Main
+from . import dispatch
+from . import preprocess
+from . import service
+import argparse
+import json
+import numpy as np
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+# Relative ride requests per hour of the day (1 on average), peaking with
+# the commutes.
+HOURLY_DEMAND = (0.3, 0.2, 0.15, 0.1, 0.15, 0.3, 0.8, 1.8, 2.0, 1.3, 1.0, 1.1,
+    1.3, 1.2, 1.1, 1.3, 1.8, 2.1, 1.7, 1.2, 1.0, 0.9, 0.7, 0.5)
+
+# routing.status() values of a search stopped by its time limit
+TIMEOUT_STATUSES = (2, 4) # PARTIAL_SUCCESS_LOCAL_OPTIMUM_NOT_REACHED, FAIL_TIMEOUT
+
+class Simulation(object):
+    '''
+    Purpose:
+        One simulated day (or part of one) through Main.
+
+    Example:
+        report = Simulation(seed=1, hours=2).run()
+    '''
+    def __init__(self, seed:int=0, hours:float=24, start_hour:float=0,
+        drivers:int=50, requests_per_hour:float=60, litter:int=2000,
+        tags_per_hour:float=30, csv_scores:bool=False, profile:str='interactive',
+        k:int=3, refresh_minutes:float=15, move_minutes:float=5,
+        travel_times:bool=False, route_cache=None, trace_memory:bool=True):
+        '''
+        Args:
+            seed: seed of every random draw, so runs are reproducible.
+            hours, start_hour: simulated span (hours since midnight).
+            drivers: drivers on shift.
+            requests_per_hour: average ride requests per hour (shaped by
+            HOURLY_DEMAND).
+            litter: litter tagged at the start.
+            tags_per_hour: new litter tags per hour.
+            csv_scores: draw litter scores from litter_index_lines.csv
+            (otherwise uniform 1 to 4 points).
+            profile, k: Main.dispatch settings.
+            refresh_minutes: how often new tags and collected litter reach
+            the litter index.
+            move_minutes: how often idle drivers move.
+            travel_times: quote with the 'Time' dimension for the request's
+            hour of the day.
+            route_cache: optional optimize.RouteCache for Main.
+            trace_memory: track the Python allocation peak (tracemalloc
+            slows the run down somewhat).
+        '''
+        self.seed = seed
+        self.hours = hours
+        self.start_hour = start_hour
+        self.drivers = drivers
+        self.requests_per_hour = requests_per_hour
+        self.litter = litter
+        self.tags_per_hour = tags_per_hour
+        self.csv_scores = csv_scores
+        self.profile = profile
+        self.k = k
+        self.refresh_minutes = refresh_minutes
+        self.move_minutes = move_minutes
+        self.travel_times = travel_times
+        self.route_cache = route_cache
+        self.trace_memory = trace_memory
+        self._csv_values = None # CSV scores worth a point, loaded once
+
+    def _scores(self, rng, n:int):
+        if self.csv_scores:
+            if self._csv_values is None:
+                scores = np.asarray(preprocess.get_litter_store().score, dtype=np.float64)
+                self._csv_values = scores[scores >= 0.5] # rounds to at least a point
+            return rng.choice(self._csv_values, n)
+        return rng.integers(1, 5, n).astype(np.float64)
+
+    def _arrivals(self, rng, per_hour:float, shape:tuple=None):
+        '''
+        Purpose:
+            Sorted Poisson arrival times (seconds since midnight) over the
+            simulated span, hour by hour.
+        '''
+        start = self.start_hour * 3600
+        end = start + self.hours * 3600
+        times = []
+        for hour in range(int(start // 3600), int(np.ceil(end / 3600))):
+            rate = per_hour * (1 if shape is None else shape[hour % len(shape)])
+            low, high = max(start, hour * 3600), min(end, (hour + 1) * 3600)
+            count = rng.poisson(rate * (high - low) / 3600)
+            times.append(rng.uniform(low, high, count))
+        return np.sort(np.concatenate(times)) if times else np.empty(0)
+
+    def run(self):
+        '''
+        Purpose:
+            Simulate the span and return the report (see report).
+        '''
+        rng = np.random.default_rng(self.seed)
+        self.app = Main(route_cache=self.route_cache)
+        self.pool = dispatch.DriverPool()
+        positions = preprocess.get_basic_geo_array(self.drivers, seed=rng)
+        for i, position in enumerate(positions):
+            self.pool.update('driver-{}'.format(i), position)
+        self._positions = {'driver-{}'.format(i): p for i, p in enumerate(positions)}
+        # litter ids stay the same across index refreshes (rows don't)
+        self._ids = np.arange(self.litter)
+        self._next_id = self.litter
+        self._points = preprocess.get_basic_geo_array(self.litter, seed=rng)
+        self._values = self._scores(rng, self.litter)
+        self._pending = []
+        self._collected = set()
+        self._refresh()
+
+        events = []
+        sequence = 0
+        def schedule(at, kind, payload=None):
+            nonlocal sequence
+            heappush(events, (at, sequence, kind, payload))
+            sequence += 1
+        requests = self._arrivals(rng, self.requests_per_hour, HOURLY_DEMAND)
+        trips = preprocess.get_basic_geo_array(2 * len(requests), seed=rng).reshape(-1, 2, 2)
+        for i, (at, trip) in enumerate(zip(requests, trips)):
+            schedule(at, 'request', (i, trip))
+        tags = self._arrivals(rng, self.tags_per_hour)
+        for at, point, score in zip(tags, preprocess.get_basic_geo_array(len(tags), seed=rng),
+            self._scores(rng, len(tags))):
+            schedule(at, 'tag', (point, score))
+        start, end = self.start_hour * 3600, (self.start_hour + self.hours) * 3600
+        for at in np.arange(start + self.move_minutes * 60, end, self.move_minutes * 60):
+            schedule(at, 'move')
+        for at in np.arange(start + self.refresh_minutes * 60, end, self.refresh_minutes * 60):
+            schedule(at, 'refresh')
+
+        self.latencies = []
+        self.statuses = {}
+        self.counts = dict.fromkeys(('requests', 'served', 'unserved', 'completed',
+            'fallbacks', 'litter_offered', 'litter_dropped', 'litter_tagged',
+            'litter_collected', 'points', 'refreshes'), 0)
+        if self.trace_memory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        try:
+            while events:
+                at, _, kind, payload = heappop(events)
+                if kind == 'request':
+                    completion = self._request(at, *payload)
+                    if completion is not None:
+                        schedule(*completion)
+                elif kind == 'complete':
+                    self._complete(at, *payload)
+                elif kind == 'move':
+                    self._move(rng)
+                elif kind == 'tag':
+                    self._pending.append(payload)
+                    self.counts['litter_tagged'] += 1
+                elif kind == 'refresh':
+                    self._refresh()
+                    self.counts['refreshes'] += 1
+            self.wall_seconds = time.perf_counter() - wall
+            self.peak_bytes = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+        return self.report()
+
+    def _refresh(self):
+        keep = ~np.isin(self._ids, list(self._collected))
+        ids, points, values = self._ids[keep], self._points[keep], self._values[keep]
+        if self._pending:
+            ids = np.append(ids, self._next_id + np.arange(len(self._pending)))
+            self._next_id += len(self._pending)
+            points = np.vstack([points, [point for point, _ in self._pending]])
+            values = np.append(values, [score for _, score in self._pending])
+        self._ids, self._points, self._values = ids, points, values
+        self._pending = []
+        self.index = preprocess.LitterIndex(points, values)
+
+    def _request(self, at:float, i:int, trip):
+        self.counts['requests'] += 1
+        app = self.app
+        app.initialize_rider('rider-{}'.format(i), trip[0], trip[1])
+        kwargs = {'departure': at % preprocess.DAY_SECONDS} if self.travel_times else {}
+        start = time.perf_counter()
+        try:
+            driver = app.dispatch(self.pool, self.index, k=self.k, profile=self.profile,
+                **kwargs)
+        except ValueError: # no available drivers
+            self.latencies.append(time.perf_counter() - start)
+            self.counts['unserved'] += 1
+            return None
+        self.latencies.append(time.perf_counter() - start)
+
+        data, result = app.model_data, app.output
+        self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+        if result.profile == 'heuristic':
+            self.counts['fallbacks'] += 1
+        # nodes: driver starts, the rider's pickup and destination, litter, free end
+        first = data['num_vehicles'] + 2
+        end = len(data['demands']) - 1
+        self.counts['litter_offered'] += end - first
+        self.counts['litter_dropped'] += int(((result.dropped >= first)
+            & (result.dropped < end)).sum())
+        if driver is None:
+            self.counts['unserved'] += 1
+            return None
+        self.counts['served'] += 1
+        vehicle = data['driver_ids'].index(driver)
+        nodes = result.routes[vehicle]
+        litter = self._ids[data['litter'][nodes[(nodes >= first) & (nodes < end)] - first]]
+        description = app.describe_route(vehicle)
+        bucket = preprocess.time_bucket(at, len(preprocess.HOURLY_SPEEDS_KMH))
+        seconds = description['distance_km'] / preprocess.HOURLY_SPEEDS_KMH[bucket] * 3600
+        self.pool.set_available(driver, False)
+        return (at + seconds, 'complete',
+            (driver, trip[1], litter.tolist(), description, app.rider['name']))
+
+    def _complete(self, at:float, driver, position, litter:list, description:dict, rider):
+        self.pool.update(driver, position)
+        self._positions[driver] = position
+        self.counts['litter_collected'] += len(set(litter) - self._collected)
+        self._collected.update(litter)
+        self.counts['completed'] += 1
+        self.counts['points'] += int(description['points'])
+        self.app.rankings.record(description['points'], description['distance_km'],
+            driver=driver, rider=rider, timestamp=at)
+
+    def _move(self, rng):
+        '''
+        Purpose:
+            Idle drivers drift up to ~1 km, staying in the service area.
+        '''
+        idle = [driver for driver, row in self.pool._rows.items() if self.pool._available[row]]
+        if not idle:
+            return
+        steps = rng.normal(0, 0.005, (len(idle), 2))
+        for driver, step in zip(idle, steps):
+            lat, lon = self._positions[driver] + step
+            position = [min(max(lat, 39.94), 39.96), min(max(lon, -75.17), -75.14)]
+            self._positions[driver] = np.array(position)
+            self.pool.update(driver, position)
+
+    def report(self):
+        '''
+        Purpose:
+            Capacity planning numbers of the last run.
+
+        Returns:
+            dict with request counts, 'throughput' (quotes per wall second
+            of the whole run), 'latency_ms' p50/p95/p99 of the quotes,
+            solver 'statuses', 'timeouts' (searches stopped by their time
+            limit) and 'fallbacks' (heuristic answers), litter offered,
+            dropped ('dropped_litter_rate' is dropped/offered), tagged and
+            collected, and the memory high-water marks in MB: tracemalloc's
+            Python allocation peak and the process max RSS.
+        '''
+        counts = self.counts
+        max_rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            if resource is not None else None) # KB on Linux
+        return dict(counts,
+            simulated_hours=self.hours,
+            wall_seconds=self.wall_seconds,
+            throughput=counts['requests'] / self.wall_seconds if self.wall_seconds else 0.0,
+            latency_ms={q: None if value is None else value * 1000
+                for q, value in service.percentiles(self.latencies).items()},
+            statuses=self.statuses,
+            timeouts=sum(self.statuses.get(status, 0) for status in TIMEOUT_STATUSES),
+            dropped_litter_rate=(counts['litter_dropped'] / counts['litter_offered']
+                if counts['litter_offered'] else 0.0),
+            peak_mb=None if self.peak_bytes is None else self.peak_bytes / 2**20,
+            max_rss_mb=max_rss)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a day of tossit rides.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--start-hour', type=float, default=0)
+    parser.add_argument('--drivers', type=int, default=50)
+    parser.add_argument('--requests-per-hour', type=float, default=60)
+    parser.add_argument('--litter', type=int, default=2000)
+    parser.add_argument('--tags-per-hour', type=float, default=30)
+    parser.add_argument('--csv-scores', action='store_true')
+    parser.add_argument('--profile', default='interactive')
+    parser.add_argument('--travel-times', action='store_true')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false')
+    args = parser.parse_args()
+    report = Simulation(**{key: value for key, value in vars(args).items()}).run()
+    print(json.dumps(report, indent=2, default=str))
@@ -0,0 +1,188 @@
+'''
+Purpose:
+    Per-stage timing and solver telemetry for Main and optimize.route, so a
+    slow quote can be traced to matrix building, model construction, the
+    OR-Tools search or postprocess.
+
+Notes:
+    A Metrics object accumulates wall and CPU seconds per named stage and
+    keeps the telemetry of the last solve. Hooks are plain callables
+    hook(operation, metrics) that Main calls after each operation; LogHook
+    appends JSON lines to app.log and PrometheusHook writes the Prometheus
+    text exposition format to a file (e.g. for node_exporter's textfile
+    collector).
+'''
+from contextlib import contextmanager, nullcontext
+from os import path
+import json
+import logging
+import os
+import time
+import weakref
+
+APP_LOG = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'app.log')
+
+class Metrics(object):
+    '''
+    Purpose:
+        Structured timings and solver telemetry.
+
+    Attributes:
+        stages: {name: {'calls', 'wall', 'cpu', 'last_wall', 'last_cpu'}}
+        with totals in seconds since the Metrics was created.
+        solver: telemetry of the last solve: 'status' (routing.status()),
+        'solutions' found, 'objective', 'trajectory' [[seconds, objective],
+        ...] of every improving solution, 'nodes', 'vehicles' and
+        'fallback' (True when route_from_scratch answered instead of
+        OR-Tools).
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.solver = {}
+
+    @contextmanager
+    def stage(self, name:str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add(self, name:str, wall:float, cpu:float):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0}
+        stage['calls'] += 1
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['last_wall'] = wall
+        stage['last_cpu'] = cpu
+
+    def watch_search(self, routing):
+        '''
+        Purpose:
+            Record the objective of each solution the search finds. Call
+            before solving; the callback adds a little overhead per solution,
+            so route only registers it when metrics are requested.
+        '''
+        trajectory = []
+        self.solver = {'trajectory': trajectory}
+        start = time.perf_counter()
+        # the model holds the callback in C++, so a strong reference back to
+        # it is a cycle the garbage collector can't see (every model leaked)
+        model = weakref.ref(routing)
+        # CostVar is only final once the model is closed, so look it up late
+        routing.AddAtSolutionCallback(lambda: trajectory.append(
+            [time.perf_counter() - start, model().CostVar().Max()]))
+
+    def record_solve(self, routing, assignment, nodes:int, vehicles:int):
+        trajectory = self.solver.get('trajectory', [])
+        self.solver = {
+            'status': routing.status(),
+            'solutions': len(trajectory),
+            'objective': assignment.ObjectiveValue() if assignment else None,
+            'trajectory': trajectory,
+            'nodes': nodes,
+            'vehicles': vehicles,
+            'fallback': False
+        }
+
+    def record_fallback(self, result, nodes:int, vehicles:int):
+        '''
+        Purpose:
+            Record a route_from_scratch answer as the last solve, replacing
+            whatever an earlier (or the failed) OR-Tools search left. Its
+            single solution is the whole trajectory.
+        '''
+        self.solver = {
+            'status': result.status,
+            'solutions': 1,
+            'objective': result.objective,
+            'trajectory': [[result.solve_time, result.objective]],
+            'nodes': nodes,
+            'vehicles': vehicles,
+            'fallback': True
+        }
+
+    def to_dict(self):
+        return {'stages': self.stages, 'solver': self.solver}
+
+    def to_prometheus(self, prefix:str='tossit'):
+        '''
+        Purpose:
+            Prometheus text exposition (version 0.0.4) of the metrics.
+        '''
+        lines = [
+            '# HELP {}_stage_seconds_total Time spent per stage.'.format(prefix),
+            '# TYPE {}_stage_seconds_total counter'.format(prefix)]
+        for name, stage in sorted(self.stages.items()):
+            for clock in ('wall', 'cpu'):
+                lines.append('{}_stage_seconds_total{{stage="{}",clock="{}"}} {}'.format(
+                    prefix, name, clock, stage[clock]))
+        lines += [
+            '# HELP {}_stage_calls_total Times each stage ran.'.format(prefix),
+            '# TYPE {}_stage_calls_total counter'.format(prefix)]
+        for name, stage in sorted(self.stages.items()):
+            lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(
+                prefix, name, stage['calls']))
+        for key in ('status', 'solutions', 'objective', 'nodes', 'vehicles', 'fallback'):
+            value = self.solver.get(key)
+            if value is None:
+                continue
+            lines += [
+                '# HELP {}_solver_{} Last solve {}.'.format(prefix, key, key),
+                '# TYPE {}_solver_{} gauge'.format(prefix, key),
+                '{}_solver_{} {}'.format(prefix, key, int(value)
+                    if isinstance(value, bool) else value)]
+        return '\n'.join(lines) + '\n'
+
+def stage(metrics:Metrics, name:str):
+    '''
+    Purpose:
+        metrics.stage(name), or a no-op when metrics is None.
+    '''
+    return nullcontext() if metrics is None else metrics.stage(name)
+
+class LogHook(object):
+    '''
+    Purpose:
+        Append one JSON line per operation (its unix 'time', timings of
+        the stages that ran in it and the solver telemetry) to a log file,
+        app.log by default, so the file parses as JSON lines.
+    '''
+    def __init__(self, log_path:str=APP_LOG):
+        self._calls = {}
+        self.logger = logging.getLogger('tossit.telemetry.{}'.format(log_path))
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = logging.FileHandler(log_path)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+    def __call__(self, operation:str, metrics:Metrics):
+        stages = {}
+        for name, stage in metrics.stages.items():
+            if self._calls.get(name) != stage['calls']:
+                stages[name] = {'wall': stage['last_wall'], 'cpu': stage['last_cpu']}
+                self._calls[name] = stage['calls']
+        solver = {key: value for key, value in metrics.solver.items()
+            if key != 'trajectory'}
+        self.logger.info(json.dumps({'time': time.time(), 'operation': operation,
+            'stages': stages, 'solver': solver}))
+
+class PrometheusHook(object):
+    '''
+    Purpose:
+        Rewrite a Prometheus text file after each operation. The file is
+        replaced atomically so a scraper never reads a partial write.
+    '''
+    def __init__(self, target:str, prefix:str='tossit'):
+        self.target = target
+        self.prefix = prefix
+
+    def __call__(self, operation:str, metrics:Metrics):
+        temp = self.target + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(metrics.to_prometheus(self.prefix))
+        os.replace(temp, self.target)
@@ -1,19 +1,15 @@
 import tossit as ts
+import asyncio
+import json
+import multiprocessing
 import numpy as np
+import os
+import pickle
+import tempfile
+import time
 
 def get_ouput_sequence_sets(app):
-    location_sets = []
-    for vehicle in range(app.model_data['num_vehicles']):
-        locations = set()
-        i = app.output['routing'].Start(vehicle)
-        locations.add(i)
-        while not app.output['routing'].IsEnd(i):
-            node_i = app.output['manager'].IndexToNode(i)
-            prev_node_i = node_i
-            i = app.output['assignment'].Value(app.output['routing'].NextVar(i))
-            locations.add(i)
-        location_sets.append(locations)
-    return location_sets
+    return [set(nodes.tolist()) for nodes in app.output.routes]
 
 def init_app():
     # psuedo route instruction params TODO: integrate
@@ -33,6 +29,170 @@ def init_app():
 def test_rider(app):
     print('TESTING:>>Rider Created: ({})\n'.format(app.rider))
 
+def test_distance_matrix():
+    locations = ts.preprocess.get_basic_geo_array()
+    reference = ts.preprocess.build_distance_matrix_reference(locations)
+    vectorized = ts.preprocess.build_distance_matrix(locations)
+    assert np.allclose(reference, vectorized, atol=1)
+    assert np.allclose(vectorized, vectorized.T)
+    scaled = ts.preprocess.build_distance_matrix(locations, dtype='int32')
+    assert scaled.dtype == np.int32 and np.abs(scaled - vectorized).max() <= 1
+    print('TESTING:>>Distance Matrix ({} locations) OK'.format(len(locations)))
+
+def test_tiled_distance_matrix():
+    locations = ts.preprocess.get_basic_geo_array()
+    dense = ts.preprocess.build_distance_matrix(locations, dtype='int32')
+    tiled = ts.preprocess.build_distance_matrix_tiled(locations, tile_size=16)
+    assert isinstance(tiled, np.memmap) and (np.asarray(tiled) == dense).all()
+    if os.name == 'posix': # the temporary file is gone once mapped
+        assert not os.path.exists(tiled.filename)
+    else:
+        filename = tiled.filename
+        del tiled
+        os.remove(filename)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'matrix.npy')
+        tiled = ts.preprocess.build_distance_matrix_tiled(locations, path, tile_size=16)
+        assert (np.asarray(ts.preprocess.load_distance_matrix(path)) == dense).all()
+        del tiled
+    print('TESTING:>>Tiled Distance Matrix OK')
+
+def test_candidate_arcs():
+    locations = ts.preprocess.get_basic_geo_array()
+    matrix = ts.preprocess.build_distance_matrix(locations)
+    allowed = ts.preprocess.build_candidate_arcs(locations, k=5, keep=[0])
+    lats, lons = locations[:, 0], locations[:, 1]
+    km = ts.preprocess.haversine_vector(
+        lons[:, None], lats[:, None], lons[None, :], lats[None, :])
+    nearest = np.argsort(km, axis=1)[:, :6]
+    assert (allowed == allowed.T).all() and allowed[0].all()
+    assert all(allowed[i, nearest[i]].all() for i in range(len(locations)))
+    sparse = ts.preprocess.apply_candidate_arcs(matrix, allowed)
+    assert (sparse[~allowed] > matrix.max()).all()
+    for k, radius_km in ((None, None), (0, None), (None, 0)):
+        try:
+            ts.preprocess.build_candidate_arcs(locations, k=k, radius_km=radius_km)
+        except ValueError:
+            continue
+        raise AssertionError('accepted k={} radius_km={}'.format(k, radius_km))
+    print('TESTING:>>Candidate Arcs ({} of {}) OK'.format(
+        allowed.sum(), allowed.size))
+
+def test_distance_cache():
+    locations = ts.preprocess.get_basic_geo_array()
+    cache = ts.preprocess.DistanceCache(max_points=60)
+    cached = ts.preprocess.build_distance_matrix(locations, cache=cache)
+    assert np.abs(cached - ts.preprocess.build_distance_matrix(locations)).max() <= 1
+    misses = cache.misses
+    extended = np.append(locations, ts.preprocess.get_basic_geo_array()[:20], axis=0)
+    again = ts.preprocess.build_distance_matrix(extended[20:], cache=cache)
+    assert np.abs(again - ts.preprocess.build_distance_matrix(extended[20:])).max() <= 1
+    stats = cache.stats()
+    assert stats['misses'] - misses < 20 * len(extended) and stats['evictions'] == 10
+
+    # the matrices start small and grow with the points, not up front
+    lazy = ts.preprocess.DistanceCache(initial_points=8)
+    assert lazy._km.shape == (8, 8)
+    many = ts.preprocess.get_basic_geo_array(100, seed=3)
+    assert np.array_equal(ts.preprocess.build_distance_matrix(many, cache=lazy),
+        ts.preprocess.build_distance_matrix(many, cache=ts.preprocess.DistanceCache(100)))
+    assert lazy._km.shape == (128, 128) and lazy.stats()['evictions'] == 0
+    print('TESTING:>>Distance Cache {}'.format(stats))
+
+def test_litter_store():
+    store = ts.preprocess.ingest_litter_index(chunksize=1000)
+    assert store.seg_id.dtype == np.int32 and store.score.dtype == np.float32
+    assert len(store) == len(store.street_class) and 5 in store.street_classes
+    data = ts.preprocess.build_model_data(12, store.demands(np.arange(10)))
+    assert list(data['demands'][1:-1]) == list(np.rint(store.score[:10]))
+    print('TESTING:>>Litter Store ({} segments, version {}) OK'.format(
+        len(store), store.version[:8]))
+
+def get_grid_network(size=6, spacing=0.002):
+    # size x size street grid; odd rows are one-way eastbound
+    lat, lon = np.meshgrid(39.94 + spacing * np.arange(size),
+        -75.17 + spacing * np.arange(size), indexing='ij')
+    points = np.column_stack([lat.ravel(), lon.ravel()])
+    node = np.arange(size * size).reshape(size, size)
+    sources = np.concatenate([node[:, :-1].ravel(), node[:-1, :].ravel()])
+    targets = np.concatenate([node[:, 1:].ravel(), node[1:, :].ravel()])
+    oneway = np.concatenate([np.repeat(np.arange(size) % 2 == 1, size - 1),
+        np.zeros((size - 1) * size, dtype=bool)])
+    return points, sources, targets, oneway
+
+def test_network():
+    points, sources, targets, oneway = get_grid_network()
+    network = ts.network.RoadNetwork.from_edges(points, sources, targets, oneway=oneway)
+
+    # brute force all pairs (Floyd-Warshall) over the same edges
+    n = len(points)
+    reference = np.full((n, n), np.inf)
+    np.fill_diagonal(reference, 0)
+    for u in range(n):
+        edges = slice(network.indptr[u], network.indptr[u + 1])
+        reference[u, network.indices[edges]] = network.weights[edges]
+    for k in range(n):
+        reference = np.minimum(reference, reference[:, k, None] + reference[None, k, :])
+    assert np.allclose(network.shortest_paths(np.arange(n), np.arange(n)), reference)
+    assert not np.allclose(reference, reference.T) # one-way rows
+
+    # the search cache holds at most SEARCH_CACHE_NODES row entries
+    cap, ts.network.SEARCH_CACHE_NODES = ts.network.SEARCH_CACHE_NODES, 4 * n
+    try:
+        ts.network.clear_search_cache()
+        assert np.array_equal(network.shortest_paths(np.arange(n), np.arange(n)),
+            network.shortest_paths(np.arange(n), np.arange(n)))
+        assert len(ts.network._SEARCH_CACHE) == 4
+    finally:
+        ts.network.SEARCH_CACHE_NODES = cap
+
+    # segment csv and osm extracts load the same graph
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, 'segments.csv')
+    with open(csv_path, 'w') as f:
+        f.write('seg_id,from_lat,from_lon,to_lat,to_lon,oneway\n')
+        for i, (a, b, one) in enumerate(zip(sources, targets, oneway)):
+            f.write('{},{},{},{},{},{}\n'.format(i, *points[a], *points[b], int(one)))
+    osm_path = os.path.join(directory, 'extract.osm')
+    with open(osm_path, 'w') as f:
+        f.write('<osm>\n')
+        for i, (lat, lon) in enumerate(points):
+            f.write('<node id="{}" lat="{}" lon="{}"/>\n'.format(i, lat, lon))
+        for i, (a, b, one) in enumerate(zip(sources, targets, oneway)):
+            f.write('<way id="{}"><nd ref="{}"/><nd ref="{}"/>'
+                '<tag k="highway" v="residential"/><tag k="oneway" v="{}"/></way>\n'.format(
+                    i, a, b, 'yes' if one else 'no'))
+        f.write('<way id="999"><nd ref="0"/><nd ref="35"/><tag k="highway" v="footway"/></way>\n')
+        f.write('</osm>\n')
+    locations = points[[0, 7, 14, 35, 20]] + 0.0001
+    expected = network.distance_matrix(locations, dtype='int32')
+    for loaded in (ts.network.RoadNetwork.from_segments_csv(csv_path),
+        ts.network.RoadNetwork.from_osm(osm_path)):
+        assert len(loaded) == n and len(loaded.indices) == len(network.indices)
+        assert np.allclose(loaded.distance_matrix(locations, dtype='int32'), expected, atol=1)
+
+    # road distances never beat the straight line
+    haversine = ts.preprocess.build_distance_matrix(locations, dtype='int32')
+    assert (expected >= haversine - 1).all()
+    network.save(os.path.join(directory, 'network.npz'))
+    loaded = ts.network.RoadNetwork.load(os.path.join(directory, 'network.npz'))
+    assert loaded.version == network.version
+
+    app = ts.Main(network=network)
+    app.rider = {'origin': locations[0], 'destination': locations[3]}
+    index = ts.preprocess.LitterIndex(locations[1:3], np.ones(2))
+    data = app.build_model(index, detour_km=2)
+    assert np.array_equal(data['distance_matrix'],
+        network.distance_matrix(data['locations'], dtype='int32'))
+    pool = ts.dispatch.DriverPool()
+    pool.update('driver-0', locations[4])
+    app.dispatch(pool)
+    data = app.model_data
+    expected = network.distance_matrix(data['locations'], dtype='int32')
+    expected[:, data['free_end']] = 0
+    assert np.array_equal(data['distance_matrix'], expected)
+    print('TESTING:>>Road Network {} OK'.format(network))
+
 def test_routing(app):
     # could externalize the modeling of the problem:
     # TODO: use rider programmed data
@@ -40,18 +200,15 @@ def test_routing(app):
     locations = np.append(np.array([app.rider['origin']]), locations, axis=0)
     locations = np.append(locations, np.array([app.rider['destination']]), axis=0)
     data = ts.preprocess.build_model_data(len(locations))
-    data['distance_matrix'] = ts.preprocess.build_distance_matrix(locations)
+    data['distance_matrix'] = ts.preprocess.build_distance_matrix(
+        locations, dtype='int32')
     app.initialize_routes(data)
     app.model_data['locations'] = locations
 
     # Print solution on console.
     print('TESTING:>>Routes Created:')
-    if app.output['assignment']:
-        ts.postprocess.print_solution(
-            app.output['data'],
-            app.output['manager'],
-            app.output['routing'],
-            app.output['assignment'])
+    if app.output:
+        ts.postprocess.print_solution(app.output)
 
     print('\nDEBUG:\norigin:\t\t{}'.format(app.model_data['locations'][0]))
     print('destination:\t{}'.format(app.model_data['locations'][-1]))
@@ -61,15 +218,506 @@ def test_routing(app):
     print('points:\t\t{}'.format(demands))
     print('total pts:\t{}'.format(sum(demands)))
 
+def test_corridor(app):
+    litter = ts.preprocess.get_basic_geo_array()
+    scores = np.random.uniform(low=0, high=4, size=len(litter))
+    index = ts.preprocess.LitterIndex(litter, scores)
+    data = app.build_model(index, detour_km=0.5, k=10)
+    assert len(data['locations']) == len(data['litter']) + 2 <= 12
+    origin, destination = app.rider['origin'], app.rider['destination']
+    direct = ts.preprocess.haversine(origin[1], origin[0], destination[1], destination[0])
+    for lat, lon in data['locations'][1:-1]:
+        detour = (ts.preprocess.haversine(origin[1], origin[0], lon, lat)
+            + ts.preprocess.haversine(lon, lat, destination[1], destination[0]) - direct)
+        assert detour <= 0.5 + 1e-9
+    print('TESTING:>>Corridor ({} of {} litter locations) OK'.format(
+        len(data['litter']), len(litter)))
+
+def test_reroute(app):
+    before = get_ouput_sequence_sets(app)[0]
+    visited = sorted(before)[1]
+    added = ts.preprocess.get_basic_geo_array()[:3]
+    app.reroute(added_locations=added, added_demands=[1, 1, 1], removed=[visited],
+        position=app.model_data['locations'][visited])
+    routes = app.output.routes
+    assert app.output.warm_start and visited not in routes[0]
+    print('TESTING:>>Reroute in {:.4f}s -> {}'.format(
+        app.output.solve_time, routes[0]))
+
+def test_metrics(app):
+    stages = app.metrics.stages
+    assert {'build_model', 'search', 'extract', 'distance_matrix'} <= set(stages)
+    assert stages['search']['calls'] == 2 # initialize_routes and reroute
+    solver = app.metrics.solver
+    assert solver['solutions'] == len(solver['trajectory']) > 0
+    assert solver['objective'] == app.output.objective
+    assert solver['nodes'] == len(app.model_data['distance_matrix'])
+
+    directory = tempfile.mkdtemp()
+    log_path = os.path.join(directory, 'app.log')
+    prometheus_path = os.path.join(directory, 'tossit.prom')
+    calls = []
+    app.hooks = [ts.telemetry.LogHook(log_path), ts.telemetry.PrometheusHook(prometheus_path),
+        lambda operation, metrics: calls.append(operation)]
+    app.reroute()
+    assert calls == ['reroute']
+    with open(log_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert entries[-1]['operation'] == 'reroute' and entries[-1]['time'] > 0
+    with open(prometheus_path) as f:
+        text = f.read()
+    assert 'tossit_stage_seconds_total{stage="search",clock="wall"}' in text
+    assert 'tossit_stage_calls_total{stage="search"} 3' in text
+    app.hooks = []
+
+    # a heuristic answer replaces the last OR-Tools solve's telemetry
+    metrics = ts.telemetry.Metrics()
+    ts.optimize.route(app.model_data, profile='interactive', metrics=metrics)
+    assert metrics.solver['fallback'] is False
+    pywrapcp, ts.optimize.pywrapcp = ts.optimize.pywrapcp, None
+    try:
+        fallback = ts.optimize.route(app.model_data, metrics=metrics)
+    finally:
+        ts.optimize.pywrapcp = pywrapcp
+    assert metrics.solver['fallback'] is True and metrics.solver['solutions'] == 1
+    assert metrics.solver['status'] == fallback.status
+    assert metrics.solver['objective'] == fallback.objective
+    assert 'tossit_solver_fallback 1' in metrics.to_prometheus()
+    print('TESTING:>>Metrics {}'.format(
+        {name: round(stage['wall'], 4) for name, stage in stages.items()}))
+
+def test_dispatch():
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(ts.preprocess.get_basic_geo_array()[:20]):
+        pool.update('driver-{}'.format(i), position, available=i % 4 != 0)
+    riders = [{'origin': o, 'destination': d} for o, d in zip(
+        ts.preprocess.get_basic_geo_array()[:6], ts.preprocess.get_basic_geo_array()[:6])]
+    litter = ts.preprocess.get_basic_geo_array()
+    index = ts.preprocess.LitterIndex(litter, np.ones(len(litter)))
+    data = ts.dispatch.build_dispatch_model(riders, pool, k=3, litter_index=index)
+    result = ts.optimize.route(data, profile='interactive')
+    drivers = ts.dispatch.assign_riders(data, result)
+    assert None not in drivers and not any(d.endswith(('-0', '-4', '-8')) for d in drivers)
+    for vehicle, nodes in enumerate(result.routes):
+        riding = [n for pair in data['rider_nodes'] for n in pair if n in nodes]
+        assert len(riding) % 2 == 0
+
+    app = ts.Main()
+    app.initialize_rider('rider', *ts.preprocess.get_basic_geo_array(2, seed=7))
+    driver = app.dispatch(pool, index)
+    vehicle = app.model_data['driver_ids'].index(driver)
+    app.reroute(added_locations=[[39.95, -75.15]], added_demands=[2],
+        position=[39.951, -75.16])
+    data = app.model_data
+    assert data['distance_matrix'][:, data['free_end']].sum() == 0 # still a free end
+    assert np.allclose(data['locations'][data['starts'][vehicle]], [39.951, -75.16])
+    description = app.complete_ride() # the chosen driver's route and credit
+    assert description == app.describe_route(vehicle)
+    assert app.rankings.drivers.totals[driver] == int(description['points'])
+    print('TESTING:>>Dispatch ({} riders, {} drivers) -> {}'.format(
+        len(riders), data['num_vehicles'], drivers))
+
+def test_time_windows():
+    locations = ts.preprocess.get_basic_geo_array(30, seed=5)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'travel_times.npy')
+        tensor = ts.preprocess.build_travel_time_tensor(locations, path=path)
+        assert isinstance(tensor, np.memmap) and tensor.shape == (24, 30, 30)
+        assert tensor.dtype == np.int16 and (tensor[8] >= tensor[3]).all() # rush hour
+        assert (tensor == ts.preprocess.build_travel_time_tensor(locations)).all()
+        del tensor
+    assert ts.preprocess.time_bucket(8.5 * 3600) == 8
+    assert ts.preprocess.time_bucket(ts.preprocess.DAY_SECONDS + 60) == 0
+
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(ts.preprocess.get_basic_geo_array(20, seed=3)):
+        pool.update('driver-{}'.format(i), position, seats=2)
+    trips = ts.preprocess.get_basic_geo_array(8, seed=4).reshape(4, 2, 2)
+    riders = [{'origin': o, 'destination': d} for o, d in trips]
+    departure = 8 * 3600
+    riders[0]['pickup_window'] = [departure + 600, departure + 900] # ten minutes out
+    data = ts.dispatch.build_dispatch_model(riders, pool, departure=departure)
+    for result in (ts.optimize.route(data, profile='interactive'),
+        ts.optimize.route_from_scratch(data)):
+        assert None not in ts.dispatch.assign_riders(data, result)
+        for nodes, times in zip(result.routes, result.times):
+            assert times[0] == departure and (np.diff(times) >= 0).all()
+            for node, arrival in zip(nodes[1:].tolist(), times[1:].tolist()):
+                earliest, latest = data['time_windows'][node]
+                assert earliest <= arrival <= latest
+    copy = ts.optimize.RouteResult.from_json(result.to_json())
+    assert [t.tolist() for t in copy.times] == [t.tolist() for t in result.times]
+
+    stale = dict(data, travel_times=data['travel_times'][:, :-1, :-1])
+    try:
+        ts.optimize.route(stale, profile='interactive')
+        raise AssertionError('a tensor that misses nodes must be rejected')
+    except ValueError:
+        pass
+    app = ts.Main()
+    app.initialize_rider('rider', *trips[1])
+    app.dispatch(pool, departure=departure)
+    app.reroute(added_locations=[[39.95, -75.15]], added_demands=[2])
+    n = len(app.model_data['distance_matrix'])
+    assert app.model_data['travel_times'].shape == (24, n, n)
+    assert len(app.model_data['time_windows']) == n and app.output
+    print('TESTING:>>Time Windows {} OK'.format(result))
+
+def test_route_cache():
+    litter = ts.preprocess.get_basic_geo_array(300, seed=1)
+    index = ts.preprocess.LitterIndex(litter, np.arange(300) % 4 + 1)
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(ts.preprocess.get_basic_geo_array(30, seed=2)):
+        pool.update(i, position)
+    origin, destination = ts.preprocess.get_basic_geo_array(2, seed=3)
+    def model(shift=0.0):
+        return ts.dispatch.build_dispatch_model(
+            [{'origin': origin + shift, 'destination': destination}], pool, litter_index=index)
+    data = model()
+    listed = {key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in data.items()}
+    key = ts.optimize.fingerprint(data)
+    assert key == ts.optimize.fingerprint(listed) == ts.optimize.fingerprint(model(1e-7))
+    assert key != ts.optimize.fingerprint(data, profile='interactive')
+    assert key != ts.optimize.fingerprint(model(1e-4))
+
+    with tempfile.TemporaryDirectory() as folder:
+        cache = ts.optimize.RouteCache(max_entries=2, path=folder, version=index.version)
+        first = cache.route(data)
+        assert cache.route(model(1e-7)) is first and cache.stats()['hits'] == 1
+        seeded = cache.route(model(1e-4)) # the rider moved ~10m
+        assert seeded.warm_start and cache.stats()['seeded'] == 1
+        cache.route(model(2e-4))
+        assert len(cache) == 2 and cache.stats()['evictions'] == 1
+
+        restarted = ts.optimize.RouteCache(path=folder, version=index.version)
+        assert len(restarted) == 2
+        assert restarted.get(cache.key(model(1e-4))).to_dict() == seeded.to_dict()
+        assert restarted.get(key) is None # evicted
+        os.makedirs(os.path.join(folder, 'unrelated'))
+        open(os.path.join(folder, 'notes.json'), 'w').close()
+        restarted.set_version('refreshed')
+        assert sorted(os.listdir(folder)) == ['notes.json', 'routes-refreshed', 'unrelated']
+        assert len(restarted) == 0 and restarted.get(cache.key(model(1e-4))) is None
+        assert len(ts.optimize.RouteCache(path=folder, version=index.version)) == 0
+
+    expiring = ts.optimize.RouteCache(ttl=0)
+    expiring.route(data)
+    assert expiring.get(expiring.key(data)) is None
+
+    app = ts.Main(route_cache=ts.optimize.RouteCache())
+    app.initialize_rider('cached', origin, destination)
+    app.dispatch(pool, index)
+    app.dispatch(pool, index)
+    assert app.route_cache.version == index.version
+    assert app.route_cache.stats()['hits'] == 1
+    print('TESTING:>>Route Cache {}'.format(cache.stats()))
+
+def test_route_from_scratch():
+    data = ts.preprocess.build_scenario(60, 3, seed=1)
+    result = ts.optimize.route_from_scratch(data)
+    matrix = np.asarray(data['distance_matrix'], dtype=np.int64)
+    visited = np.concatenate([nodes[1:-1] for nodes in result.routes])
+    assert len(set(visited.tolist())) == len(visited) # no node twice
+    assert len(visited) + len(result.dropped) == 60 - 3 - 1
+    for nodes, loads, capacity in zip(result.routes, result.loads, data['vehicle_capacities']):
+        assert loads[-1] <= capacity
+    assert result.objective == sum(int(matrix[n[:-1], n[1:]].sum()) for n in result.routes) + \
+        ts.optimize.SOLVER_PROFILES['default']['penalty'] * len(result.dropped)
+    reference = ts.optimize.route(data, profile='interactive')
+    assert result.objective <= 1.2 * reference.objective
+
+    # riders: same vehicle, pickup before drop-off, within seats
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(ts.preprocess.get_basic_geo_array(10)):
+        pool.update(i, position, seats=1)
+    trips = ts.preprocess.get_basic_geo_array(8).reshape(4, 2, 2)
+    data = ts.dispatch.build_dispatch_model(
+        [{'origin': o, 'destination': d} for o, d in trips], pool)
+    result = ts.optimize.route_from_scratch(data)
+    for nodes in result.routes:
+        nodes = nodes.tolist()
+        riding = 0
+        for node in nodes:
+            for pickup, delivery in data['rider_nodes']:
+                if node == pickup:
+                    assert delivery in nodes[nodes.index(pickup):]
+                    riding += 1
+                elif node == delivery:
+                    riding -= 1
+            assert riding <= 1
+    assert None not in ts.dispatch.assign_riders(data, result)
+
+    # fallback when OR-Tools isn't available
+    pywrapcp, ts.optimize.pywrapcp = ts.optimize.pywrapcp, None
+    try:
+        fallback = ts.optimize.route(data)
+        scenario = ts.preprocess.build_scenario(30, 2, seed=0)
+        previous = ts.optimize.route(scenario)
+        removed = [int(previous.routes[0][1])]
+        rerouted = ts.optimize.reroute(previous, scenario, removed=removed)
+        for solve in (lambda: ts.optimize.route(scenario, fallback=False),
+            lambda: ts.optimize.reroute(previous, scenario, fallback=False)):
+            try:
+                solve()
+            except ImportError as e:
+                assert 'fallback=True' in str(e)
+                continue
+            raise AssertionError('solved without OR-Tools or a fallback')
+    finally:
+        ts.optimize.pywrapcp = pywrapcp
+    assert fallback.profile == 'heuristic' and fallback.objective == result.objective
+    assert rerouted.profile == 'heuristic'
+    assert not any(removed[0] in nodes for nodes in rerouted.routes)
+    print('TESTING:>>Route From Scratch {} in {:.4f}s'.format(result, result.solve_time))
+
+def test_decomposition():
+    data = ts.preprocess.build_scenario(240, 4, seed=2)
+    labels, centers = ts.preprocess.cluster_locations(data['locations'], 4,
+        weights=data['demands'], limits=[120] * 4)
+    assert len(centers) == 4 and np.bincount(labels, data['demands'], 4).max() <= 120
+
+    result = ts.optimize.route_decomposed(data, time_limit=0.5, workers=1)
+    matrix = np.asarray(data['distance_matrix'], dtype=np.int64)
+    visited = np.concatenate([nodes[1:-1] for nodes in result.routes])
+    assert len(set(visited.tolist())) == len(visited) # no node twice
+    assert len(visited) + len(result.dropped) == 240 - 4 - 1
+    for v, (nodes, loads) in enumerate(zip(result.routes, result.loads)):
+        assert nodes[0] == data['starts'][v] and nodes[-1] == data['ends'][v]
+        assert loads[-1] <= data['vehicle_capacities'][v]
+    assert result.objective == sum(int(matrix[n[:-1], n[1:]].sum()) for n in result.routes) + \
+        ts.optimize.SOLVER_PROFILES['batch']['penalty'] * len(result.dropped)
+
+    # without the all to all matrix: cluster matrices come from the locations
+    sparse = {key: value for key, value in data.items() if key != 'distance_matrix'}
+    assert ts.optimize.route_decomposed(sparse, time_limit=0.5, workers=1).objective > 0
+
+    # repair_time budgets the repair pass alone, not the cluster solves before it
+    repaired = []
+    seed = ts.optimize._LocalSearch.seed
+    def counted(search, routes):
+        repaired.append(len(routes))
+        return seed(search, routes)
+    ts.optimize._LocalSearch.seed = counted
+    try:
+        ts.optimize.route_decomposed(data, time_limit=0.5, workers=1, repair_time=0.05)
+    finally:
+        ts.optimize._LocalSearch.seed = seed
+    assert repaired
+    print('TESTING:>>Decomposition {} in {:.2f}s'.format(result, result.solve_time))
+
+def test_simulation():
+    settings = dict(seed=4, hours=1, start_hour=8, drivers=8, requests_per_hour=20,
+        litter=200, tags_per_hour=30, refresh_minutes=10, trace_memory=False)
+    report = ts.simulate.Simulation(**settings).run()
+    assert report['requests'] == report['served'] + report['unserved'] > 0
+    assert report['completed'] <= report['served'] and report['refreshes'] == 5
+    assert 0 <= report['litter_dropped'] <= report['litter_offered']
+    assert sum(report['statuses'].values()) + report['unserved'] >= report['served']
+    assert set(report['latency_ms']) == {50, 95, 99}
+    again = ts.simulate.Simulation(**settings).run()
+    for key in ('requests', 'served', 'litter_tagged', 'litter_collected', 'points'):
+        assert report[key] == again[key] # seeded
+
+    # CSV scores: the litter store is loaded once, not per tag or refresh
+    loads = []
+    get_litter_store = ts.preprocess.get_litter_store
+    def counted(*args, **kwargs):
+        loads.append(1)
+        return get_litter_store(*args, **kwargs)
+    ts.preprocess.get_litter_store = counted
+    try:
+        scored = ts.simulate.Simulation(**dict(settings, csv_scores=True)).run()
+    finally:
+        ts.preprocess.get_litter_store = get_litter_store
+    assert scored['litter_tagged'] > 0 and len(loads) == 1
+    print('TESTING:>>Simulation {} requests, p95 {:.1f}ms'.format(
+        report['requests'], report['latency_ms'][95]))
+
+def test_service():
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(ts.preprocess.get_basic_geo_array()[:20]):
+        pool.update('driver-{}'.format(i), position)
+    trips = ts.preprocess.get_basic_geo_array(24).reshape(12, 2, 2)
+    async def run():
+        service = ts.service.RideService(pool, window=0.05, max_batch=8, max_queue=4)
+        await service.start()
+        assignments = await asyncio.gather(*[
+            service.request(origin, destination) for origin, destination in trips])
+        await service.stop()
+        return service, assignments
+    assert ts.service.RideService(pool).stats()['throughput'] == 0.0 # not started
+    service, assignments = asyncio.run(run())
+    stats = service.stats()
+    assert stats['requests'] == 12 and stats['batches'] < 12
+    assert max(service.batch_sizes) <= 8
+    for (origin, _), assignment in zip(trips, assignments):
+        assert assignment['driver_id'] is not None
+        assert any(np.allclose(origin, stop) for stop in assignment['stops'])
+        assert not pool.is_available(assignment['driver_id']) # booked
+    service.release(assignments[0]['driver_id'])
+    assert pool.is_available(assignments[0]['driver_id'])
+
+    # two batches solving at once against one driver: only one gets them
+    pool = ts.dispatch.DriverPool()
+    pool.update('driver-0', trips[0, 0])
+    async def race():
+        service = ts.service.RideService(pool, window=0, max_batch=1, concurrency=2)
+        await service.start()
+        results = await asyncio.gather(*[service.request(origin, destination)
+            for origin, destination in trips[:2]], return_exceptions=True)
+        await service.stop()
+        return results
+    results = asyncio.run(race())
+    assert sum(isinstance(result, dict) and result['driver_id'] == 'driver-0'
+        for result in results) == 1
+    assert not pool.is_available('driver-0')
+    print('TESTING:>>Service {} requests in {} batches, p95 {:.3f}s'.format(
+        stats['requests'], stats['batches'], stats['latency'][95]))
+
+def test_matrix_store():
+    rng = np.random.default_rng(5)
+    locations = ts.preprocess.get_basic_geo_array(300, seed=rng)
+    demands = rng.integers(1, 4, 300)
+    with tempfile.TemporaryDirectory() as folder:
+        store = ts.preprocess.MatrixStore.build(locations, folder, demands, tile_size=64)
+        assert pickle.loads(pickle.dumps(store)) is store # opened once per process
+        nodes = rng.choice(300, 30, replace=False)
+        model = store.model(nodes, nodes[:2], [nodes[-1]] * 2, [20, 20])
+        assert len(pickle.dumps(model)) < 1000 # node rows, not the matrix
+        resolved = ts.preprocess.resolve_model(model)
+        assert np.array_equal(resolved['distance_matrix'], ts.preprocess.build_distance_matrix(
+            locations, dtype='int32')[np.ix_(nodes, nodes)])
+        assert np.array_equal(resolved['demands'], demands[nodes])
+        assert resolved['starts'] == [0, 1] and resolved['ends'] == [29, 29]
+
+        results = dict(ts.optimize.route_many([model, model], workers=2, time_limit=0.5))
+        for result in results.values():
+            assert not result.error and result.routes[0][0] == 0 and result.routes[1][-1] == 29
+        assert ts.optimize.route_from_scratch(model).objective > 0
+
+        # a citywide store model is decomposed into node row submodels
+        everything = store.model(np.arange(300), [0, 1, 2], [299] * 3, [150] * 3)
+        result = ts.optimize.route_decomposed(everything, time_limit=0.5, workers=1)
+        visited = np.concatenate([nodes[1:-1] for nodes in result.routes])
+        assert len(visited) + len(result.dropped) == 300 - 3 - 1
+        print('TESTING:>>Matrix store {} OK'.format(result))
+
+def test_route_many():
+    models = []
+    for _ in range(4):
+        locations = ts.preprocess.get_basic_geo_array()
+        data = ts.preprocess.build_model_data(len(locations))
+        data['distance_matrix'] = ts.preprocess.build_distance_matrix(
+            locations, dtype='int32')
+        models.append(data)
+    models.append({'distance_matrix': [[0]]}) # malformed request
+    results = dict(ts.optimize.route_many(models, workers=2, time_limit=1))
+    assert sorted(results) == list(range(len(models)))
+    assert results[len(models) - 1].error
+    for i in range(len(models) - 1):
+        assert results[i].routes[0][0] == 0
+        assert results[i].routes[0][-1] == len(models[i]['demands']) - 1
+
+    # requests still searching at the wall-clock timeout come back as None
+    slow = ts.preprocess.build_scenario(200, 2, seed=0)
+    start = time.perf_counter()
+    timed_out = dict(ts.optimize.route_many(
+        [slow, slow], workers=1, profile='batch', time_limit=5, timeout=0.5))
+    assert timed_out == {0: None, 1: None} and time.perf_counter() - start < 2
+    assert not multiprocessing.active_children() # timed out workers are reaped
+    print('TESTING:>>Route Many ({} requests) OK'.format(len(results)))
+
+def test_ranking(app):
+    data = ts.preprocess.build_scenario(40, 3, seed=2)
+    result = ts.optimize.route(data, profile='interactive')
+    scores = ts.ranking.score_routes(result.routes, data['distance_matrix'], data['demands'])
+    for v, nodes in enumerate(result.routes):
+        assert scores['points'][v] == sum(data['demands'][n] for n in nodes)
+        assert np.isclose(scores['distance_km'][v] * 100, result.distances[v][-1])
+    batch = ts.ranking.score_results([result, result], [data, data])
+    assert np.allclose(batch['points'], np.tile(scores['points'], 2))
+    assert np.allclose(batch['detour_km'], np.tile(scores['detour_km'], 2))
+
+    # leaderboard against a brute force re-sort
+    rng = np.random.default_rng(0)
+    board = ts.ranking.Leaderboard(k=5)
+    totals = {}
+    for user, points in zip(rng.integers(0, 40, 2000), rng.integers(0, 60, 2000)):
+        board.add(int(user), int(points))
+        totals[int(user)] = totals.get(int(user), 0) + int(points)
+    ranked = sorted(totals.values(), reverse=True)
+    assert [total for _, total in board.top()] == ranked[:5]
+    for user, total in totals.items():
+        assert board.rank(user) == 1 + sum(other > total for other in totals.values())
+
+    rankings = ts.ranking.Rankings(k=3, bucket_seconds=10, buckets=2)
+    for t in range(40):
+        rankings.record(1, 0.5, driver='d{}'.format(t % 3), rider='r{}'.format(t % 7), timestamp=t)
+    assert list(rankings.periods) == [2, 3] and rankings.periods[3]['rides'] == 10
+    rankings.record(1, 0.5, timestamp=5) # late: older than every bucket
+    rankings.record(1, 0.5, timestamp=45)
+    assert sorted(rankings.periods) == [3, 4]
+    assert rankings.drivers.top(1)[0][1] == 14
+
+    description = app.describe_route()
+    assert description['points'] == app.output.loads[0][-1]
+    before = app.describe_route()['rank']
+    app.complete_ride(driver_id='driver-1')
+    assert app.rankings.riders.rank(app.rider['name']) == before
+    print('TESTING:>>Ranking {}'.format({k: round(v, 2) for k, v in description.items()}))
+
+def test_route_result(app):
+    result = app.output
+    copy = ts.optimize.RouteResult.from_json(result.to_json())
+    assert copy.to_dict() == result.to_dict()
+    nodes = result.routes[0]
+    matrix = np.asarray(app.model_data['distance_matrix'])
+    assert result.distances[0][-1] == matrix[nodes[:-1], nodes[1:]].sum()
+    visited = set(nodes.tolist()) | set(result.dropped.tolist())
+    assert visited == set(range(len(app.model_data['demands'])))
+    print('TESTING:>>Route Result {} ({} bytes as JSON)'.format(
+        result, len(result.to_json())))
+
+def test_render():
+    routes = [ts.preprocess.get_basic_geo_array()[:10] for _ in range(25)]
+    page = ts.postprocess.render_html(routes)
+    assert page.count('"') >= 50 and '{lat:' not in page
+    encoded = ts.postprocess.encode_polyline([[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]])
+    assert encoded == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    print('TESTING:>>Render ({} routes, {} bytes) OK'.format(len(routes), len(page)))
+
 def test_display(app):
-    locations = get_ouput_sequence_sets(app)[0] # use one
-    app.display_route(sorted(list(locations)))
+    locations = app.output.routes[0] # use one, in route order
+    app.display_route(locations, open_browser=False)
 
 
 if __name__ == '__main__':
+    np.random.seed(0) # reproducible geo arrays and scores across runs
     app = init_app()
 
     # tests
     test_rider(app)
+    test_distance_matrix()
+    test_tiled_distance_matrix()
+    test_candidate_arcs()
+    test_distance_cache()
+    test_litter_store()
+    test_corridor(app)
+    test_network()
     test_routing(app)
+    test_ranking(app)
+    test_route_result(app)
+    test_reroute(app)
+    test_metrics(app)
+    test_dispatch()
+    test_time_windows()
+    test_route_cache()
+    test_route_from_scratch()
+    test_decomposition()
+    test_simulation()
+    test_service()
+    test_matrix_store()
+    test_route_many()
+    test_render()
     test_display(app)
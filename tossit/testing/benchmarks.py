@@ -0,0 +1,699 @@
+import tossit as ts
+import argparse
+import json
+import numpy as np
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+def timeit(func, *args, repeat=3, **kwargs):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_distance_matrix(sizes=(50, 500, 2000)):
+    print('BENCH:>>build_distance_matrix (reference loop vs vectorized)')
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        locations = ts.preprocess.get_basic_geo_array(n, seed=rng)
+        ref_time, ref = timeit(
+            ts.preprocess.build_distance_matrix_reference, locations, repeat=1)
+        vec_time, vec = timeit(ts.preprocess.build_distance_matrix, locations)
+        int_time, _ = timeit(
+            ts.preprocess.build_distance_matrix, locations, dtype='int32')
+        print('n={:>6}  reference {:8.4f}s  vectorized {:8.4f}s  int32 {:8.4f}s'
+              '  speedup {:7.1f}x  max diff {}'.format(
+                  n, ref_time, vec_time, int_time, ref_time / vec_time,
+                  np.abs(ref - vec).max()))
+
+def bench_tiled_distance_matrix(n=8000, tile_sizes=(256, 1024)):
+    print('BENCH:>>build_distance_matrix_tiled (n={}, int32 memmap)'.format(n))
+    locations = ts.preprocess.get_basic_geo_array(n, seed=0)
+    for tile_size in tile_sizes:
+        tracemalloc.start()
+        start = time.perf_counter()
+        matrix = ts.preprocess.build_distance_matrix_tiled(
+            locations, tile_size=tile_size)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('tile={:>5}  {:8.3f}s  peak python memory {:8.1f}MB'
+              '  (dense float64 would be {:.1f}MB)'.format(
+                  tile_size, elapsed, peak / 2**20, n * n * 8 / 2**20))
+        del matrix
+
+def route_cost(result, distance_matrix, penalty=1000):
+    '''true (dense) distance of the solved routes plus dropped node penalties'''
+    matrix = np.asarray(distance_matrix)
+    cost = sum(int(matrix[nodes[:-1], nodes[1:]].sum()) for nodes in result.routes)
+    return cost + len(result.dropped) * penalty, len(result.dropped)
+
+def bench_candidate_arcs(sizes=(100, 1000, 5000), k=8):
+    print('BENCH:>>dense vs k-nearest candidate arcs (k={})'.format(k))
+    for n in sizes:
+        scenario = ts.preprocess.build_scenario(n, seed=0)
+        locations, dense = scenario['locations'], scenario['distance_matrix']
+        start = time.perf_counter()
+        allowed = ts.preprocess.build_candidate_arcs(locations, k=k, keep=[0, n-1])
+        sparse = ts.preprocess.apply_candidate_arcs(dense, allowed)
+        prep_time = time.perf_counter() - start
+        for name, matrix in (('dense', dense), ('sparse', sparse)):
+            data = dict(scenario, distance_matrix=matrix)
+            start = time.perf_counter()
+            result = ts.optimize.route(data)
+            solve_time = time.perf_counter() - start
+            cost, dropped = route_cost(result, dense)
+            print('n={:>6}  {:6}  solve {:8.3f}s  objective {:>8}  dropped {:>6}'
+                  '  arcs {:>9}{}'.format(
+                      n, name, solve_time, cost, dropped,
+                      int(allowed.sum()) if name == 'sparse' else n * n,
+                      '  (candidate build {:.3f}s)'.format(prep_time)
+                      if name == 'sparse' else ''))
+
+def bench_transits(sizes=(50, 200, 1000)):
+    print('BENCH:>>Python transit callbacks vs registered transit matrices')
+    for n in sizes:
+        data = ts.preprocess.build_scenario(n, seed=0)
+        matrix = data['distance_matrix']
+
+        # count arc evaluations through a matrix that records its reads
+        calls = [0]
+        class CountingRow(object):
+            def __init__(self, row):
+                self.row = row
+            def __getitem__(self, j):
+                calls[0] += 1
+                return self.row[j]
+        data['distance_matrix'] = [CountingRow(row) for row in matrix]
+        data['transit_callbacks'] = True
+        ts.optimize.route(data)
+        arcs = calls[0]
+
+        data['distance_matrix'] = matrix
+        callback_time, _ = timeit(ts.optimize.route, data, repeat=1)
+        data['transit_callbacks'] = False
+        matrix_time, _ = timeit(ts.optimize.route, data, repeat=1)
+        print('n={:>6}  arcs {:>9}  callbacks {:8.3f}s ({:>10.0f} arcs/s)'
+              '  matrix {:8.3f}s ({:>10.0f} arcs/s)'.format(
+                  n, arcs, callback_time, arcs / callback_time,
+                  matrix_time, arcs / matrix_time))
+
+def bench_route_many(requests=32, n=200, workers=(1, 2, 4)):
+    print('BENCH:>>route_many ({} requests of {} nodes)'.format(requests, n))
+    models = [ts.preprocess.build_scenario(n, seed=seed) for seed in range(requests)]
+    start = time.perf_counter()
+    for data in models:
+        ts.optimize.route(data)
+    print('sequential route()     {:8.3f}s'.format(time.perf_counter() - start))
+    for count in workers:
+        start = time.perf_counter()
+        results = list(ts.optimize.route_many(models, workers=count))
+        print('route_many workers={:<3} {:8.3f}s  errors {}'.format(
+            count, time.perf_counter() - start,
+            sum(r is None or r.error is not None for _, r in results)))
+
+def bench_profiles(sizes=(5, 50, 500), profiles=('default', 'interactive', 'batch')):
+    print('BENCH:>>solver profiles')
+    for n in sizes:
+        data = ts.preprocess.build_scenario(n, seed=0)
+        for profile in profiles:
+            result = ts.optimize.route(data, profile=profile)
+            print('n={:>6}  {:12} limit {:8.2f}s  solve {:8.3f}s  objective {}'.format(
+                n, profile,
+                ts.optimize.get_time_limit(ts.optimize.SOLVER_PROFILES[profile], n),
+                result.solve_time, result.objective))
+
+def bench_reroute(sizes=(50, 200, 1000)):
+    print('BENCH:>>cold solve vs warm-start reroute (1 added, 1 removed node)')
+    for n in sizes:
+        data = ts.preprocess.build_scenario(n, seed=0, capacity=n // 4)
+        locations = np.append(data['locations'],
+            ts.preprocess.get_basic_geo_array(1, seed=n), axis=0)
+        previous = ts.optimize.route(data, profile='interactive')
+
+        changed = dict(data)
+        changed['demands'] = np.append(data['demands'], 1)
+        changed['distance_matrix'] = ts.preprocess.build_distance_matrix(
+            locations, dtype='int32')
+        removed = [previous.routes[0][1]]
+        cold = ts.optimize.route(changed, profile='interactive')
+        warm = ts.optimize.reroute(previous, changed, removed=removed)
+        print('n={:>6}  cold {:8.4f}s (objective {:>8})  warm {:8.4f}s'
+              ' (objective {:>8}, warm_start={})'.format(
+                  n, cold.solve_time, cold.objective,
+                  warm.solve_time, warm.objective, warm.warm_start))
+
+def bench_distance_cache(n=300, requests=20, shared=0.8):
+    print('BENCH:>>DistanceCache ({} requests of {} points, {:.0%} recurring)'.format(
+        requests, n, shared))
+    rng = np.random.default_rng(0)
+    def points(size):
+        return ts.preprocess.get_basic_geo_array(size, seed=rng)
+    hotspots = points(n)
+    cache = ts.preprocess.DistanceCache()
+    for i in range(requests):
+        fresh = int(n * (1 - shared))
+        locations = np.append(hotspots[fresh:], points(fresh), axis=0)
+        start = time.perf_counter()
+        ts.preprocess.build_distance_matrix(locations, cache=cache)
+        cached_time = time.perf_counter() - start
+        if i in (0, requests - 1):
+            direct_time, _ = timeit(ts.preprocess.build_distance_matrix, locations)
+            print('request {:>3}  cached {:8.4f}s  direct {:8.4f}s  {}'.format(
+                i, cached_time, direct_time, cache.stats()))
+
+def bench_litter_store(path='/tmp/tossit_litter_store'):
+    print('BENCH:>>litter store (ingest CSV vs load memory-mapped store)')
+    ingest_time, store = timeit(
+        ts.preprocess.ingest_litter_index, store_path=path, repeat=1)
+    load_time, _ = timeit(ts.preprocess.LitterStore.load, path)
+    print('rows {}  ingest {:8.4f}s  load {:8.5f}s'.format(
+        len(store), ingest_time, load_time))
+
+def bench_corridor(sizes=(10000, 100000, 1000000), queries=200, k=25):
+    print('BENCH:>>LitterIndex.query_corridor (top {} by score per km of detour)'.format(k))
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        litter = np.column_stack([ # roughly the city limits
+            rng.uniform(low=39.87, high=40.13, size=n),
+            rng.uniform(low=-75.28, high=-74.96, size=n)])
+        build_time, index = timeit(
+            ts.preprocess.LitterIndex, litter, rng.uniform(0, 4, size=n), repeat=1)
+        trips = np.column_stack([
+            rng.uniform(low=39.93, high=39.97, size=(queries, 2)),
+            rng.uniform(low=-75.19, high=-75.13, size=(queries, 2))])
+        start = time.perf_counter()
+        for lat_a, lat_b, lon_a, lon_b in trips:
+            index.query_corridor([lat_a, lon_a], [lat_b, lon_b], 0.5, k)
+        per_query = (time.perf_counter() - start) / queries
+        print('litter={:>8}  build {:8.3f}s  query {:8.3f}ms'.format(
+            n, build_time, per_query * 1000))
+
+def bench_dispatch(drivers=5000, riders=(1, 10, 50), k=3):
+    print('BENCH:>>dispatch ({} live drivers, k={})'.format(drivers, k))
+    rng = np.random.default_rng(0)
+    def points(size):
+        return np.column_stack([
+            rng.uniform(low=39.90, high=40.00, size=size),
+            rng.uniform(low=-75.22, high=-75.10, size=size)])
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(points(drivers)):
+        pool.update(i, position)
+    pool.nearest(points(1)) # build the index once
+    for count in riders:
+        batch = [{'origin': o, 'destination': d}
+            for o, d in zip(points(count), points(count))]
+        nearest_time, _ = timeit(
+            pool.nearest, np.array([r['origin'] for r in batch]), k=k)
+        start = time.perf_counter()
+        data = ts.dispatch.build_dispatch_model(batch, pool, k=k)
+        ts.optimize.route(data, profile='interactive')
+        batch_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for rider in batch:
+            data = ts.dispatch.build_dispatch_model([rider], pool, k=k)
+            ts.optimize.route(data, profile='interactive')
+        single_time = time.perf_counter() - start
+        print('riders={:>4}  nearest {:8.3f}ms  one batch solve {:8.3f}s'
+              '  one solve per rider {:8.3f}s'.format(
+                  count, nearest_time * 1000, batch_time, single_time))
+
+def bench_route_result(sizes=(100, 1000, 3000)):
+    print('BENCH:>>result extraction (node by node SWIG walk vs RouteResult)')
+    def legacy_extract(data, manager, routing, assignment):
+        # the original print_solution/get_ouput_sequence_sets walk
+        dropped = [manager.IndexToNode(node) for node in range(routing.Size())
+            if not (routing.IsStart(node) or routing.IsEnd(node))
+            and assignment.Value(routing.NextVar(node)) == node]
+        index, nodes, distance, load = routing.Start(0), [], 0, 0
+        while not routing.IsEnd(index):
+            nodes.append(manager.IndexToNode(index))
+            load += data['demands'][nodes[-1]]
+            previous_index = index
+            index = assignment.Value(routing.NextVar(index))
+            distance += routing.GetArcCostForVehicle(previous_index, index, 0)
+        return nodes, distance, load, dropped
+    for n in sizes:
+        data = ts.preprocess.build_scenario(n, seed=0, capacity=n // 2)
+        settings = ts.optimize.SOLVER_PROFILES['interactive']
+        manager, routing = ts.optimize._build_model(data, settings)
+        assignment = routing.SolveWithParameters(
+            ts.optimize.get_search_parameters(settings, n))
+        legacy_time, _ = timeit(legacy_extract, data, manager, routing, assignment)
+        result_time, result = timeit(
+            ts.optimize.RouteResult.from_assignment, data, manager, routing, assignment)
+        print('n={:>6}  legacy walk {:8.4f}s  RouteResult {:8.4f}s'
+              '  pickle {:>7} bytes  json {:>7} bytes'.format(
+                  n, legacy_time, result_time, len(pickle.dumps(result)),
+                  len(result.to_json())))
+
+def bench_render(routes=10000, stops=12, target='/tmp/tossit_render'):
+    print('BENCH:>>headless rendering of {} routes of {} stops'.format(routes, stops))
+    rng = np.random.default_rng(0)
+    batch = [ts.preprocess.get_basic_geo_array(stops, seed=rng) for _ in range(routes)]
+    os.makedirs(target, exist_ok=True)
+    for combined in (False, True):
+        start = time.perf_counter()
+        paths = ts.postprocess.render_routes(
+            batch, os.path.join(target, 'batch.html') if combined else target,
+            combined=combined)
+        elapsed = time.perf_counter() - start
+        print('{:16}  {:8.3f}s  {:>6} files  {:>10} bytes'.format(
+            'combined page' if combined else 'page per route', elapsed,
+            len(paths), sum(os.path.getsize(p) for p in paths)))
+    literal_bytes = sum(len(",\n".join( # the old Map.__str__ path format
+        "{{lat: {lat}, lng: {lon}}}".format(lat=lat, lon=lon) for lat, lon in route))
+        for route in batch)
+    encoded_bytes = sum(len(ts.postprocess.encode_polyline(route)) for route in batch)
+    print('path data: JS object literals {:>10} bytes  encoded polylines {:>10} bytes'.format(
+        literal_bytes, encoded_bytes))
+
+def bench_metrics(sizes=(50, 200)):
+    print('BENCH:>>telemetry overhead (route without vs with metrics)')
+    for n in sizes:
+        data = ts.preprocess.build_scenario(n, 2, seed=0)
+        # solution_limit-bound profile so both runs do the same work
+        plain, _ = timeit(ts.optimize.route, data, profile='default')
+        metrics = ts.telemetry.Metrics()
+        watched, _ = timeit(ts.optimize.route, data, profile='default', metrics=metrics)
+        print('  n={:>4}: {:.4f}s plain, {:.4f}s with metrics ({} solutions, {})'.format(
+            n, plain, watched, metrics.solver['solutions'],
+            {name: round(stage['last_wall'], 4) for name, stage in metrics.stages.items()}))
+
+# What tossit/__init__.py imported before submodules loaded lazily (user-016).
+EAGER_IMPORTS = ('import tossit.dispatch, tossit.optimize, tossit.postprocess, '
+    'tossit.preprocess, tossit.telemetry, numpy, webbrowser')
+
+def import_seconds(statement, repeat=5):
+    '''
+    Best of repeat cumulative top-level import seconds of statement, run in
+    a fresh interpreter under python -X importtime.
+    '''
+    import subprocess
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    best = float('inf')
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+            env=env, capture_output=True, text=True, check=True).stderr
+        # cumulative microseconds of every top-level import
+        total = sum(int(line.split('|')[1]) for line in stderr.splitlines()
+            if line.startswith('import time:') and '|' in line
+            and line.split('|')[1].strip().isdigit()
+            and not line.split('|')[2].startswith('  '))
+        best = min(best, total)
+    return best / 1e6
+
+def bench_import_time(repeat=5):
+    print('BENCH:>>import time (python -X importtime, best of {})'.format(repeat))
+    statements = {
+        'before (eager __init__)': EAGER_IMPORTS,
+        'after: import tossit': 'import tossit',
+        'after: preprocess path': 'import tossit; tossit.preprocess'}
+    for name, statement in statements.items():
+        print('  {:>24}: {:8.1f}ms'.format(name, import_seconds(statement, repeat) * 1000))
+
+def bench_service(rates=(50, 500, 2000), requests=400, drivers=60):
+    print('BENCH:>>ride service under Poisson load (one solve per request vs micro-batching)')
+    import asyncio
+    rng = np.random.default_rng(0)
+    positions = ts.preprocess.get_basic_geo_array(drivers, seed=rng)
+    trips = ts.preprocess.get_basic_geo_array(2 * requests, seed=rng).reshape(-1, 2, 2)
+    async def ride(service, origin, destination):
+        # rides end right away so the drivers stay bookable
+        assignment = await service.request(origin, destination)
+        if assignment['driver_id'] is not None:
+            service.release(assignment['driver_id'])
+        return assignment
+    async def load(service, rate):
+        await service.start()
+        loop = asyncio.get_running_loop()
+        # open loop: arrivals follow the schedule even if the loop falls behind
+        arrivals = loop.time() + np.cumsum(rng.exponential(1 / rate, len(trips)))
+        pending = []
+        for (origin, destination), arrival in zip(trips, arrivals):
+            await asyncio.sleep(max(0, arrival - loop.time()))
+            pending.append(asyncio.ensure_future(ride(service, origin, destination)))
+        await asyncio.gather(*pending)
+        await service.stop()
+        return service.stats()
+    for rate in rates:
+        for name, window, max_batch in (
+            ('unbatched', 0, 1), ('batch<=4', 0.01, 4), ('batch<=16', 0.02, 16)):
+            pool = ts.dispatch.DriverPool()
+            for i, position in enumerate(positions):
+                pool.update('driver-{}'.format(i), position)
+            stats = asyncio.run(load(ts.service.RideService(
+                pool, window=window, max_batch=max_batch), rate))
+            latency = stats['latency']
+            print('  {:>4}/s {:>9}: p50 {:.3f}s p95 {:.3f}s p99 {:.3f}s, '
+                '{:.1f} req/s, mean batch {:.1f} (p50 solve {:.3f}s)'.format(
+                    rate, name, latency[50], latency[95], latency[99],
+                    stats['throughput'], stats['mean_batch'], stats['solve'][50]))
+
+def bench_network(size=150, locations=(25, 100, 400)):
+    print('BENCH:>>road network matrices ({0}x{0} street grid, one-way odd rows)'.format(size))
+    spacing = 0.001
+    lat, lon = np.meshgrid(39.94 + spacing * np.arange(size),
+        -75.2 + spacing * np.arange(size), indexing='ij')
+    points = np.column_stack([lat.ravel(), lon.ravel()])
+    node = np.arange(size * size).reshape(size, size)
+    sources = np.concatenate([node[:, :-1].ravel(), node[:-1, :].ravel()])
+    targets = np.concatenate([node[:, 1:].ravel(), node[1:, :].ravel()])
+    oneway = np.concatenate([np.repeat(np.arange(size) % 2 == 1, size - 1),
+        np.zeros((size - 1) * size, dtype=bool)])
+    seconds, network = timeit(ts.network.RoadNetwork.from_edges,
+        points, sources, targets, oneway=oneway, repeat=1)
+    print('  build {}: {:.3f}s'.format(network, seconds))
+    rng = np.random.default_rng(0)
+    for n in locations:
+        geo = points[rng.choice(len(points), n, replace=False)] + 0.0002
+        ts.network.clear_search_cache()
+        cold, matrix = timeit(network.distance_matrix, geo, 'int32', repeat=1)
+        warm, _ = timeit(network.distance_matrix, geo, 'int32', repeat=1)
+        # a new rider: one more location reuses every cached search
+        extra, _ = timeit(network.distance_matrix,
+            np.append(geo, points[rng.choice(len(points), 1)], axis=0), 'int32', repeat=1)
+        haversine = ts.preprocess.build_distance_matrix(geo, dtype='int32')
+        off = ~np.eye(n, dtype=bool)
+        print('  n={:>4}: cold {:.3f}s, cached {:.4f}s, +1 location {:.3f}s '
+            '(road/straight-line {:.2f}x)'.format(n, cold, warm, extra,
+                (matrix[off] / np.maximum(haversine[off], 1)).mean()))
+
+def bench_route_from_scratch(scenarios=((7, 1), (50, 2), (200, 4), (1000, 4))):
+    print('BENCH:>>route_from_scratch (NumPy heuristic) vs optimize.route')
+    for n, vehicles in scenarios:
+        data = ts.preprocess.build_scenario(n, vehicles, seed=0)
+        ts.optimize.route_from_scratch(data) # warm up
+        seconds, result = timeit(ts.optimize.route_from_scratch, data)
+        line = '  n={:>5} vehicles={}: heuristic {:8.2f}ms objective {}'.format(
+            n, vehicles, seconds * 1000, result.objective)
+        for profile in ('interactive', 'default'):
+            reference = ts.optimize.route(data, profile=profile)
+            line += ' | {} {:8.1f}ms gap {:+.1%}'.format(profile, reference.solve_time * 1000,
+                result.objective / reference.objective - 1)
+        print(line)
+
+def bench_time_windows(riders=6, drivers=40, sizes=(30, 1000)):
+    print('BENCH:>>quote latency without vs with travel times and time windows')
+    rng = np.random.default_rng(0)
+    positions = ts.preprocess.get_basic_geo_array(drivers, seed=rng)
+    trips = ts.preprocess.get_basic_geo_array(2 * riders, seed=rng).reshape(-1, 2, 2)
+    batch = [{'origin': o, 'destination': d} for o, d in trips]
+    def quote(**kwargs):
+        data = ts.dispatch.build_dispatch_model(batch, pool, **kwargs)
+        return ts.optimize.route(data, profile='interactive')
+    plain, _ = timeit(quote)
+    timed, _ = timeit(quote, departure=8 * 3600)
+    print('  {} riders / {} drivers: {:.2f}ms plain, {:.2f}ms with the Time dimension'.format(
+        riders, drivers, plain * 1000, timed * 1000))
+    for n in sizes:
+        locations = ts.preprocess.get_basic_geo_array(n, seed=rng)
+        build, tensor = timeit(ts.preprocess.build_travel_time_tensor, locations, repeat=1)
+        lookup, _ = timeit(lambda: np.asarray(tensor[ts.preprocess.time_bucket(8 * 3600)]))
+        print('  n={:>5}: tensor build {:.3f}s ({:.1f}MB int16), bucket lookup {:.3f}ms'.format(
+            n, build, tensor.nbytes / 1e6, lookup * 1000))
+
+def bench_route_cache(requests=300, hotspots=5, drivers=40, litter=2000):
+    print('BENCH:>>quotes around a few hotspots without vs with RouteCache')
+    rng = np.random.default_rng(0)
+    index = ts.preprocess.LitterIndex(
+        ts.preprocess.get_basic_geo_array(litter, seed=rng), rng.integers(1, 5, litter))
+    pool = ts.dispatch.DriverPool()
+    for i, position in enumerate(ts.preprocess.get_basic_geo_array(drivers, seed=rng)):
+        pool.update(i, position)
+    trips = ts.preprocess.get_basic_geo_array(2 * hotspots, seed=rng).reshape(-1, 2, 2)
+    # half the requests repeat a hotspot trip exactly, the rest move the
+    # pickup by up to ~30m
+    picks = rng.integers(0, hotspots, requests)
+    shifts = np.where(rng.random(requests)[:, None] < 0.5, 0, rng.normal(0, 2e-4, (requests, 2)))
+    models = [ts.dispatch.build_dispatch_model([{'origin': trips[p, 0] + shift,
+        'destination': trips[p, 1]}], pool, litter_index=index) for p, shift in zip(picks, shifts)]
+    start = time.perf_counter()
+    plain = [ts.optimize.route(data, profile='interactive') for data in models]
+    plain_seconds = time.perf_counter() - start
+    cache = ts.optimize.RouteCache(version=index.version)
+    latencies = []
+    cached = []
+    for data in models:
+        start = time.perf_counter()
+        cached.append(cache.route(data, profile='interactive'))
+        latencies.append(time.perf_counter() - start)
+    stats = cache.stats()
+    hits = [seconds for seconds in latencies if seconds < 1e-3]
+    print('  {} quotes: {:.2f}ms each uncached, {:.2f}ms each cached (hit rate {:.0%}, '
+        'hit {:.3f}ms, {} seeded), objective {:+.2%}'.format(requests,
+        plain_seconds / requests * 1000, sum(latencies) / requests * 1000, stats['hit_rate'],
+        np.median(hits) * 1000 if hits else float('nan'), stats['seeded'],
+        sum(r.objective for r in cached) / sum(r.objective for r in plain) - 1))
+
+    # warm vs cold solves of a larger model whose rider moved
+    data = ts.preprocess.build_scenario(150, 3, seed=1)
+    cache = ts.optimize.RouteCache()
+    cache.route(data, profile='batch', time_limit=5)
+    moved = dict(data, locations=data['locations'].copy())
+    moved['locations'][1] += 1e-4
+    moved['distance_matrix'] = ts.preprocess.build_distance_matrix(moved['locations'], dtype='int32')
+    cold, reference = timeit(ts.optimize.route, moved, profile='interactive', repeat=1)
+    warm, seeded = timeit(cache.route, moved, profile='interactive', repeat=1)
+    print('  n=150 near miss: cold {:.3f}s objective {} | seeded from cache {:.3f}s '
+        'objective {} (warm start {})'.format(cold, reference.objective, warm,
+        seeded.objective, seeded.warm_start))
+
+def bench_decomposition(scenarios=((1000, 8), (3000, 20)), time_limit=60):
+    print('BENCH:>>route_decomposed vs one monolithic optimize.route (batch profile)')
+    for n, vehicles in scenarios:
+        data = ts.preprocess.build_scenario(n, vehicles, seed=1)
+        metrics = ts.telemetry.Metrics()
+        # per cluster limit so the whole run fits the monolithic budget on one core
+        result = ts.optimize.route_decomposed(data, time_limit=time_limit / vehicles / 3,
+            metrics=metrics)
+        stages = ', '.join('{} {:.2f}s'.format(name, stage['wall'])
+            for name, stage in metrics.stages.items())
+        reference = ts.optimize.route(data, profile='batch', time_limit=time_limit)
+        print('  n={:>5} vehicles={:>3}: decomposed {:6.1f}s objective {} ({}) | '
+            'monolithic {:6.1f}s objective {} gap {:+.1%}'.format(
+            n, vehicles, result.solve_time, result.objective, stages,
+            reference.solve_time, reference.objective,
+            result.objective / reference.objective - 1))
+
+def bench_simulation(hours=24, requests_per_hour=60, drivers=50, litter=2000):
+    print('BENCH:>>seeded simulated day through Main.dispatch')
+    for travel_times in (False, True):
+        report = ts.simulate.Simulation(hours=hours, requests_per_hour=requests_per_hour,
+            drivers=drivers, litter=litter, csv_scores=True, travel_times=travel_times).run()
+        print('  travel_times={!s:<5} {} requests ({} served) in {:.1f}s: {:.1f} quotes/s, '
+            'p50/p95/p99 {:.1f}/{:.1f}/{:.1f}ms, {} timeouts, {} fallbacks, dropped litter '
+            '{:.1%}, peak {:.1f}MB traced / {:.0f}MB rss'.format(travel_times,
+            report['requests'], report['served'], report['wall_seconds'],
+            report['throughput'], *report['latency_ms'].values(), report['timeouts'],
+            report['fallbacks'], report['dropped_litter_rate'], report['peak_mb'],
+            report['max_rss_mb']))
+
+def bench_matrix_store(n=5000, requests=32, size=300, workers=2, time_limit=0.2):
+    print('BENCH:>>route_many payloads: copied matrices vs MatrixStore node rows')
+    rng = np.random.default_rng(0)
+    locations = ts.preprocess.get_basic_geo_array(n, seed=rng)
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        store = ts.preprocess.MatrixStore.build(locations, folder, rng.integers(1, 4, n))
+        print('  store of {} nodes: {:.0f}MB built in {:.2f}s'.format(
+            n, store.distance_matrix.nbytes / 2**20, time.perf_counter() - start))
+        city = {'distance_matrix': np.asarray(store.distance_matrix),
+            'demands': np.asarray(store.demands)}
+        seconds, payload = timeit(pickle.dumps, city, repeat=1)
+        print('  whole city model per task: {:.0f}MB pickled in {:.3f}s'.format(
+            len(payload) / 2**20, seconds))
+        del city, payload
+        subsets = []
+        for _ in range(requests):
+            nodes = rng.choice(n, size, replace=False)
+            subsets.append(store.model(nodes, nodes[:2], [nodes[-1]] * 2, [100, 100]))
+        copies = [{key: value for key, value in ts.preprocess.resolve_model(data).items()
+            if key not in ('matrix_store', 'nodes')} for data in subsets]
+        for name, models in (('copied submatrices', copies), ('store node rows', subsets)):
+            payload = sum(len(pickle.dumps(data)) for data in models) / len(models)
+            start = time.perf_counter()
+            results = list(ts.optimize.route_many(models, workers=workers, time_limit=time_limit))
+            print('  {:<18} {:>9.0f} bytes per task, route_many workers={} {:.2f}s '
+                'errors {}'.format(name, payload, workers, time.perf_counter() - start,
+                sum(r is None or r.error is not None for _, r in results)))
+
+def bench_ranking(routes=20000, rides=1000000, users=100000):
+    print('BENCH:>>route scoring and leaderboard updates')
+    rng = np.random.default_rng(0)
+    n = 200
+    matrix = ts.preprocess.build_distance_matrix(
+        ts.preprocess.get_basic_geo_array(n, seed=rng), dtype='int32')
+    demands = rng.integers(0, 4, n)
+    batch = [rng.choice(n, rng.integers(2, 12), replace=False) for _ in range(routes)]
+    def loop_scores():
+        # per route Python sums (what print_solution did)
+        return [(sum(demands[node] for node in nodes),
+            sum(matrix[a][b] for a, b in zip(nodes[:-1], nodes[1:]))) for nodes in batch]
+    loop, _ = timeit(loop_scores, repeat=1)
+    vectorized, _ = timeit(ts.ranking.score_routes, batch, matrix, demands)
+    print('  {} routes: python loop {:.3f}s, score_routes {:.4f}s'.format(
+        routes, loop, vectorized))
+
+    drivers = rng.integers(0, users, rides).tolist()
+    points = rng.integers(0, 8, rides).tolist()
+    board = ts.ranking.Leaderboard(k=10)
+    start = time.perf_counter()
+    for user, p in zip(drivers, points):
+        board.add(user, p)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for user in drivers[:10000]:
+        board.rank(user)
+    rank_seconds = time.perf_counter() - start
+    # re-sorting every user's total per update, measured on a few updates
+    totals = dict(board.totals)
+    start = time.perf_counter()
+    for _ in range(20):
+        sorted(totals.items(), key=lambda item: -item[1])[:10]
+    resort = (time.perf_counter() - start) / 20
+    print('  {} rides / {} users: {:.2f}us per update, {:.2f}us per rank, '
+        're-sort {:.0f}us per update'.format(rides, len(board), seconds / rides * 1e6,
+            rank_seconds / 10000 * 1e6, resort * 1e6))
+
+def run_suite(node_counts=(10, 100, 1000, 10000), vehicle_counts=(1, 4),
+    route_max_nodes=2000, profile='interactive', seed=0, repeat=3):
+    '''
+    Seeded regression suite. Times every stage of the pipeline for each
+    scenario (best of repeat runs, through the public entry points) and
+    returns machine-readable records:
+    {'stage', 'nodes', 'vehicles', 'seconds', 'objective', 'dropped'}.
+    Solving is skipped above route_max_nodes (a dense 10k model needs
+    ~100M arcs registered with OR-Tools).
+    '''
+    records = []
+    def record(stage, n, vehicles, seconds, **extra):
+        records.append(dict(stage=stage, nodes=n, vehicles=vehicles,
+            seconds=round(seconds, 6), **extra))
+        print('{:24} n={:>6} vehicles={:>3} {:10.4f}s {}'.format(
+            stage, n, vehicles, seconds, extra or ''))
+
+    # startup before (the old eager __init__ imports) and after lazy loading
+    record('import tossit (eager)', 0, 0, import_seconds(EAGER_IMPORTS, repeat))
+    record('import tossit', 0, 0, import_seconds('import tossit', repeat))
+
+    settings = ts.optimize.SOLVER_PROFILES[profile]
+    for n in node_counts:
+        locations = ts.preprocess.get_basic_geo_array(n, seed=seed)
+        seconds, _ = timeit(ts.preprocess.build_distance_matrix, locations,
+            dtype='int32', repeat=repeat)
+        record('build_distance_matrix', n, 0, seconds)
+        if n > route_max_nodes:
+            continue
+        for vehicles in vehicle_counts:
+            data = ts.preprocess.build_scenario(n, vehicles, seed=seed)
+            seconds, result = timeit(ts.optimize.route, data, profile, repeat=repeat)
+            record('optimize.route', n, vehicles, seconds,
+                objective=result.objective, dropped=len(result.dropped))
+            # extraction alone, from a solve outside the timing
+            manager, routing = ts.optimize._build_model(data, settings)
+            assignment = routing.SolveWithParameters(
+                ts.optimize.get_search_parameters(settings, n))
+            seconds, _ = timeit(ts.optimize.RouteResult.from_assignment,
+                data, manager, routing, assignment, repeat=repeat)
+            record('extract_result', n, vehicles, seconds)
+            routes = [data['locations'][nodes] for nodes in result.routes]
+            seconds, _ = timeit(ts.postprocess.render_html, routes, repeat=repeat)
+            record('render', n, vehicles, seconds)
+    return records
+
+def compare_to_baseline(records, baseline, threshold=1.5, tolerance=0.05):
+    '''
+    Stages slower than threshold x baseline and by more than tolerance
+    seconds (solver runs jitter by tens of milliseconds even as best of
+    several) or with an objective worse than threshold x baseline are
+    regressions.
+    '''
+    known = {(r['stage'], r['nodes'], r['vehicles']): r for r in baseline}
+    regressions = []
+    for r in records:
+        base = known.get((r['stage'], r['nodes'], r['vehicles']))
+        if base is None:
+            continue
+        if (r['seconds'] > base['seconds'] * threshold
+            and r['seconds'] - base['seconds'] > tolerance):
+            regressions.append((r, base, 'seconds'))
+        if (r.get('objective') is not None and base.get('objective')
+            and r['objective'] > base['objective'] * threshold):
+            regressions.append((r, base, 'objective'))
+    return regressions
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+def main_suite(args):
+    records = run_suite(tuple(args.nodes), tuple(args.vehicles), seed=args.seed,
+        repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(records, f, indent=1)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(records, f, indent=1)
+        print('baseline written to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline at {} (run with --update-baseline)'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare_to_baseline(
+            records, json.load(f), args.threshold, args.tolerance)
+    for r, base, field in regressions:
+        print('REGRESSION: {} n={} vehicles={} {} {} -> {}'.format(
+            r['stage'], r['nodes'], r['vehicles'], field, base[field], r[field]))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tossit benchmarks')
+    parser.add_argument('--suite', action='store_true',
+        help='run the seeded regression suite instead of the comparisons')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the suite results as json')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=1.5)
+    parser.add_argument('--tolerance', type=float, default=0.05,
+        help='seconds a stage may exceed threshold x baseline by')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per stage; the best one is recorded')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+    if args.suite:
+        sys.exit(main_suite(args))
+    bench_distance_matrix()
+    bench_tiled_distance_matrix()
+    bench_candidate_arcs()
+    bench_transits()
+    bench_route_many()
+    bench_profiles()
+    bench_reroute()
+    bench_distance_cache()
+    bench_litter_store()
+    bench_corridor()
+    bench_dispatch()
+    bench_route_result()
+    bench_render()
+    bench_metrics()
+    bench_import_time()
+    bench_service()
+    bench_network()
+    bench_route_from_scratch()
+    bench_time_windows()
+    bench_route_cache()
+    bench_decomposition()
+    bench_simulation()
+    bench_matrix_store()
+    bench_ranking()